@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands for the analytics backend (uses the same .env as server.py).
+
+    python manage.py rebuild-rollups [--site-id SITE_ID]
+    python manage.py rebuild-sessions [--site-id SITE_ID]
+    python manage.py compact-hits [--site-id SITE_ID] [--batch-size 1000]
+    python manage.py apply-retention
+
+Everything but apply-retention works on MongoDB's derived collections, so needs STORAGE=mongo.
+"""
+
+import argparse
+import asyncio
+
+import server
+
+
+async def _rebuild_rollups(args: argparse.Namespace) -> None:
+    days = await server.rebuild_rollups(args.site_id)
+    print(f"rebuilt {days} daily rollups")
+
+
+async def _rebuild_sessions(args: argparse.Namespace) -> None:
+    n = await server.rebuild_sessions(args.site_id)
+    print(f"rebuilt {n} sessions")
+
+
+async def _compact_hits(args: argparse.Namespace) -> None:
+    n = await server.compact_hits(args.site_id, args.batch_size)
+    print(f"converted {n} hits to the compact layout")
+
+
+async def _apply_retention(args: argparse.Namespace) -> None:
+    res = await server.apply_retention()
+    print(f"dropped {res['droppedPartitions']} hit partitions, deleted {res['deletedHits']} hits")
+
+
+MONGO_ONLY = {"rebuild-rollups", "rebuild-sessions", "compact-hits"}
+
+
+async def _run(args: argparse.Namespace) -> None:
+    try:
+        await args.run(args)
+    finally:
+        await server.storage.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("rebuild-rollups", help="recompute db.daily_rollups from db.hits")
+    p.add_argument("--site-id", default=None, help="only this site (default: all sites)")
+    p.set_defaults(run=_rebuild_rollups)
+
+    p = sub.add_parser("rebuild-sessions", help="recompute db.sessions from db.hits")
+    p.add_argument("--site-id", default=None, help="only this site (default: all sites)")
+    p.set_defaults(run=_rebuild_sessions)
+
+    p = sub.add_parser("compact-hits", help="rewrite stored hits in the compact layout (set HIT_STORAGE=compact first)")
+    p.add_argument("--site-id", default=None, help="only this site (default: all sites)")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(run=_compact_hits)
+
+    p = sub.add_parser("apply-retention", help="delete hits past each site's retentionDays (what the server does hourly)")
+    p.set_defaults(run=_apply_retention)
+
+    args = parser.parse_args()
+    if args.command in MONGO_ONLY and server.STORAGE != "mongo":
+        parser.error(f"{args.command} needs STORAGE=mongo")
+    asyncio.run(_run(args))
+
+
+if __name__ == "__main__":
+    main()
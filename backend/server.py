@@ -1,16 +1,45 @@
+import asyncio
+import base64
+import bisect
+import csv
+import gzip
+import json
+import mmap
 import os
 import logging
+import math
+import re
+import sqlite3
+import struct
+import threading
+import time
 import uuid
 import hashlib
-from datetime import datetime, timezone
+import heapq
+import io
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextvars import ContextVar
+from functools import lru_cache
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Literal, Optional
+from urllib.parse import quote
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Literal, Optional, Set, Tuple
 
+import brotli
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 from fastapi import APIRouter, FastAPI, Header, HTTPException, Query, Request, Response
-from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, Field, ConfigDict
+from fastapi.responses import ORJSONResponse
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pydantic import BaseModel, Field, ConfigDict, ValidationError, model_validator
+from bson import Binary
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import StreamingResponse
 
 
 ROOT_DIR = Path(__file__).parent
@@ -27,11 +56,248 @@ def _require_env(key: str) -> str:
     return v
 
 
+# -----------------------------
+# Metrics
+# -----------------------------
+# GET /api/metrics serves these in the Prometheus text format (METRICS=0 turns them off). Hot
+# paths only add to per-thread rows of numbers: no locks, and no allocation once a label set has
+# been seen. Rows are summed at scrape time. Requests are counted on the event loop thread, Mongo
+# commands on Motor's executor threads.
+METRICS = os.environ.get("METRICS", "1") == "1"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+metrics_registry: List[Any] = []
+
+
+def _metric_labels(names: Tuple[str, ...], values: Tuple[Any, ...]) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class _ShardedMetric:
+    """Label values -> row of numbers, one shard per writing thread; read by summing the shards.
+
+    A thread only ever writes its own shard, so updates need no lock and can't be lost.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], width: int):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._width = width
+        self._local = threading.local()
+        self._shards: List[Dict[Tuple[Any, ...], List[float]]] = []
+        metrics_registry.append(self)
+
+    def _row(self, key: Tuple[Any, ...]) -> List[float]:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            self._shards.append(shard)
+        row = shard.get(key)
+        if row is None:
+            row = shard[key] = [0] * self._width
+        return row
+
+    def totals(self) -> Dict[Tuple[Any, ...], List[float]]:
+        out: Dict[Tuple[Any, ...], List[float]] = {}
+        for shard in list(self._shards):
+            for key, row in list(shard.items()):
+                acc = out.get(key)
+                if acc is None:
+                    out[key] = list(row)
+                else:
+                    for i, v in enumerate(row):
+                        acc[i] += v
+        return out
+
+
+class MetricCounter(_ShardedMetric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help, labels, 1)
+
+    def inc(self, key: Tuple[Any, ...] = (), n: float = 1) -> None:
+        self._row(key)[0] += n
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_metric_labels(self.labels, k)} {row[0]}" for k, row in sorted(self.totals().items())]
+
+
+class MetricHistogram(_ShardedMetric):
+    """Fixed buckets; a row is the per-bucket counts (last one +Inf) followed by the sum."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        super().__init__(name, help, labels, len(buckets) + 2)
+
+    def observe(self, key: Tuple[Any, ...], value: float) -> None:
+        row = self._row(key)
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def samples(self) -> List[str]:
+        out = []
+        names = self.labels + ("le",)
+        for key, row in sorted(self.totals().items()):
+            cum = 0
+            for le, n in zip((*self.buckets, "+Inf"), row):
+                cum += n
+                out.append(f"{self.name}_bucket{_metric_labels(names, key + (le,))} {cum}")
+            out.append(f"{self.name}_sum{_metric_labels(self.labels, key)} {row[-1]}")
+            out.append(f"{self.name}_count{_metric_labels(self.labels, key)} {cum}")
+        return out
+
+
+class MetricCallback:
+    """A value read from elsewhere (e.g. a limiter's own counters) when scraped."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        kind: str,
+        read: Callable[[], float],
+        labels: Optional[Callable[[], Dict[str, str]]] = None,
+    ):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self._read = read
+        self._labels = labels
+        metrics_registry.append(self)
+
+    def samples(self) -> List[str]:
+        labels = self._labels() if self._labels else {}
+        return [f"{self.name}{_metric_labels(tuple(labels), tuple(labels.values()))} {self._read()}"]
+
+
+def render_metrics() -> str:
+    out: List[str] = []
+    for m in metrics_registry:
+        out.append(f"# HELP {m.name} {m.help}")
+        out.append(f"# TYPE {m.name} {m.kind}")
+        out.extend(m.samples())
+    return "\n".join(out) + "\n"
+
+
+http_request_seconds = MetricHistogram(
+    "sa_http_request_duration_seconds", "Time to send the whole response, per route.", ("method", "route")
+)
+http_requests = MetricCounter("sa_http_requests_total", "Responses sent, per route and status.", ("method", "route", "status"))
+mongo_command_seconds = MetricHistogram("sa_mongo_command_duration_seconds", "MongoDB command latency.", ("command",))
+mongo_command_errors = MetricCounter("sa_mongo_command_errors_total", "MongoDB commands that failed.", ("command",))
+overview_docs_scanned = MetricHistogram(
+    "sa_overview_docs_scanned",
+    "Hits, rollups and sessions one overview read from storage (cache misses only).",
+    ("engine",),
+    buckets=(10, 100, 1000, 10_000, 100_000, 1_000_000, 10_000_000),
+)
+
+
+def _limiter_labels() -> Dict[str, str]:
+    # the shared-memory limiter counts for the whole host; the in-memory one only for this worker
+    return {} if limiter_collect.shared else {"pid": str(os.getpid())}
+
+
+MetricCallback(
+    "sa_collect_rate_limited_total",
+    "Hits /collect rejected by the rate limiter.",
+    "counter",
+    lambda: limiter_collect.rejected,
+    _limiter_labels,
+)
+heavy_hitter_flush_errors = MetricCounter(
+    "sa_heavy_hitter_flush_errors_total",
+    "(site, day) heavy-hitter summaries that failed to store and were kept for retry.",
+)
+MetricCallback(
+    "sa_heavy_hitter_pending",
+    "(site, day) heavy-hitter summaries this worker holds unflushed.",
+    "gauge",
+    lambda: len(heavy_hitter_writer) if heavy_hitter_writer is not None else 0,
+    lambda: {"pid": str(os.getpid())},
+)
+MetricCallback(
+    "sa_realtime_tracker_sites",
+    "Sites the realtime tracker holds state for (active visitors or an open stream).",
+    "gauge",
+    lambda: len(realtime_tracker) if realtime_tracker is not None else 0,
+    lambda: {"pid": str(os.getpid())},
+)
+MetricCallback(
+    "sa_collect_rate_limiter_keys", "Keys the /collect rate limiter is tracking.", "gauge", lambda: len(limiter_collect), _limiter_labels
+)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    # called on whichever thread ran the command
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        mongo_command_seconds.observe((event.command_name,), event.duration_micros / 1e6)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        mongo_command_seconds.observe((event.command_name,), event.duration_micros / 1e6)
+        mongo_command_errors.inc((event.command_name,))
+
+
+class RequestMetricsMiddleware:
+    """Latency and status per route template (unmatched paths share one label)."""
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        t0 = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")  # set by the router once a route matched
+            key = (scope["method"], route.path if route is not None else "unmatched")
+            http_request_seconds.observe(key, time.perf_counter() - t0)
+            http_requests.inc((*key, status))
+
+
+# Documents read by the overview being built in this context (see _build_overview)
+_overview_scan: ContextVar[Optional[List[int]]] = ContextVar("overview_scan", default=None)
+
+
+def _count_scanned(n: int) -> None:
+    scanned = _overview_scan.get()
+    if scanned is not None:
+        scanned[0] += n
+
+
+# Storage engine: "mongo" (default) or "sqlite" (see Storage backends below)
+STORAGE: str = os.environ.get("STORAGE", "mongo")
+
 # MongoDB connection (MUST use MONGO_URL from backend/.env)
-mongo_url = _require_env("MONGO_URL")
-db_name = _require_env("DB_NAME")
-client = AsyncIOMotorClient(mongo_url)
-db = client[db_name]
+client: Optional[AsyncIOMotorClient] = None
+db = None
+if STORAGE == "mongo":
+    mongo_url = _require_env("MONGO_URL")
+    db_name = _require_env("DB_NAME")
+    client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandMetrics()] if METRICS else [])
+    db = client[db_name]
 
 
 # Create the main app without a prefix
@@ -65,12 +331,36 @@ class Site(BaseModel):
     createdAt: int
     isActive: bool = True
     sessionTimeoutMin: int = 30
+    # hits older than this many days are deleted (None: HIT_RETENTION_DAYS, or keep forever)
+    retentionDays: Optional[int] = None
 
 
 class SiteCreate(BaseModel):
     name: str
     domain: str
     sessionTimeoutMin: int = 30
+    retentionDays: Optional[int] = Field(None, ge=1)
+
+
+class SiteUpdate(BaseModel):
+    retentionDays: Optional[int] = Field(None, ge=1)
+
+
+JobStatus = Literal["queued", "running", "done", "failed"]
+
+
+class Job(BaseModel):
+    id: str
+    type: Literal["delete_site"]
+    status: JobStatus
+    siteId: Optional[str] = None
+    createdAt: int
+    updatedAt: int
+    finishedAt: Optional[int] = None
+    # collection currently being processed, and documents deleted so far per collection
+    step: Optional[str] = None
+    progress: Dict[str, int] = Field(default_factory=dict)
+    error: Optional[str] = None
 
 
 HitType = Literal["pageview", "event", "outbound"]
@@ -113,11 +403,38 @@ class HitIn(BaseModel):
     eventName: Optional[str] = None
     eventProps: Optional[Dict[str, Any]] = None
 
+    @model_validator(mode="after")
+    def _cut_long_text(self) -> "HitIn":
+        # Basic sanity limits: longer values are cut, not rejected (one check per hit, so
+        # _hit_doc's model_dump() is already the stored doc)
+        if len(self.url) > 2048:
+            self.url = self.url[:2048]
+        if len(self.referrer) > 2048:
+            self.referrer = self.referrer[:2048]
+        if len(self.title) > 512:
+            self.title = self.title[:512]
+        return self
+
 
 class CollectResponse(BaseModel):
     ok: bool
 
 
+CollectItemStatus = Literal["ok", "ignored", "invalid", "invalid_site", "rate_limited", "error"]
+
+
+class CollectBatchItem(BaseModel):
+    index: int
+    id: Optional[str] = None
+    status: CollectItemStatus
+
+
+class CollectBatchResponse(BaseModel):
+    ok: bool
+    accepted: int
+    results: List[CollectBatchItem]
+
+
 class OverviewSeriesPoint(BaseModel):
     day: str
     pageviews: int
@@ -130,6 +447,13 @@ class OverviewTopItem(BaseModel):
     value: int
 
 
+# raw: scan pageviews in Python; rollup: daily_rollups/daily_urls + raw hits for partial days,
+# session KPIs from db.sessions (raw while those stores are off); sessions: same as rollup;
+# aggregate: one $facet pipeline in MongoDB; numpy: projected columns + vectorized math
+OverviewEngine = Literal["raw", "rollup", "aggregate", "numpy", "sessions"]
+OVERVIEW_ENGINE: str = os.environ.get("OVERVIEW_ENGINE", "raw")
+
+
 class OverviewResponse(BaseModel):
     siteId: str
     startTs: int
@@ -140,36 +464,492 @@ class OverviewResponse(BaseModel):
     realtime: List[Dict[str, Any]]
     activeVisitors: int
     topPages: List[OverviewTopItem]
+    # Set when uniques are estimated (approx=true, rollup engine): method and error bound
+    approx: Optional[Dict[str, Any]] = None
+    # Set with compare=previous|yoy
+    compare: Optional["OverviewComparison"] = None
+
+
+# previous: the window of the same length just before; yoy: the same dates a year earlier
+OverviewCompare = Literal["previous", "yoy"]
+
+
+class OverviewComparePoint(OverviewSeriesPoint):
+    # the comparison day this point's counts come from; `day` is the current-window day it lines up with
+    compareDay: str
+
+
+class OverviewComparison(BaseModel):
+    mode: OverviewCompare
+    startTs: int
+    endTs: int
+    kpis: Dict[str, Any]
+    series: List[OverviewComparePoint]
+    # percent change of each KPI from the comparison window; None where the comparison value is 0
+    change: Dict[str, Optional[float]]
+
+
+OverviewResponse.model_rebuild()
+
+
+BreakdownDimension = Literal[
+    "channel",
+    "referrer",
+    "utm_source",
+    "utm_medium",
+    "utm_campaign",
+    "utm_term",
+    "utm_content",
+    "countryHint",
+    "browser",
+    "os",
+    "deviceType",
+    "lang",
+    "url",
+    "title",
+]
+
+
+class BreakdownItem(BaseModel):
+    key: str
+    pageviews: int
+    # not tracked by the approx=true sketches
+    visitors: Optional[int] = None
+
+
+class BreakdownResponse(BaseModel):
+    siteId: str
+    startTs: int
+    endTs: int
+    dimension: BreakdownDimension
+    # all pageviews in the window / distinct non-empty values of the dimension (exact mode only)
+    pageviews: int
+    values: Optional[int] = None
+    items: List[BreakdownItem]
+    # Set for approx=true: pageviews per item are lower bounds, off by at most maxUndercount
+    approx: Optional[Dict[str, Any]] = None
 
 
 # -----------------------------
 # Helpers
 # -----------------------------
-class SimpleRateLimiter:
-    """Very small in-memory limiter (best-effort).
+class SlidingWindowRateLimiter:
+    """In-memory sliding-window-counter limiter (best-effort, per process).
+
+    Each key keeps only [window index, previous count, current count]; the
+    previous window is weighted by how much of it still overlaps the sliding
+    window, so a check is O(1) whatever the limit. Keys are kept in LRU order:
+    idle ones are swept from the front a couple per call, and at most
+    `max_keys` are tracked (evicting the least recently seen key forgets its
+    count, i.e. fails open).
+    """
+
+    shared = False  # counts cover this process only
+
+    def __init__(
+        self,
+        limit: int,
+        window_sec: int,
+        max_keys: int = 100_000,
+        site_limits: Optional[Dict[str, int]] = None,
+    ):
+        self.limit = limit
+        self.window_ms = window_sec * 1000
+        self.max_keys = max_keys
+        self.site_limits: Dict[str, int] = site_limits or {}
+        self._keys: "OrderedDict[str, List[int]]" = OrderedDict()
+        self.rejected = 0
+
+    def limit_for(self, site_id: str) -> int:
+        return self.site_limits.get(site_id, self.limit)
+
+    def allow(self, key: str, now_ms: int, limit: Optional[int] = None) -> bool:
+        limit = self.limit if limit is None else limit
+        win = now_ms // self.window_ms
+        entry = self._keys.get(key)
+        if entry is None:
+            entry = [win, 0, 0]
+            self._keys[key] = entry
+            if len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+        else:
+            self._keys.move_to_end(key)
+            if entry[0] < win:
+                entry[1] = entry[2] if entry[0] == win - 1 else 0
+                entry[2] = 0
+                entry[0] = win
+        self._sweep(win)
+
+        weight = 1 - (now_ms % self.window_ms) / self.window_ms
+        if entry[1] * weight + entry[2] >= limit:
+            self.rejected += 1
+            return False
+        entry[2] += 1
+        return True
 
-    Not meant for multi-instance production; good enough for personal MVP.
+    def _sweep(self, win: int) -> None:
+        # Front of the LRU = least recently seen. A key untouched for two
+        # windows has nothing left to weigh, so drop it. Removing up to two per
+        # call (vs. at most one insert) keeps idle keys from piling up.
+        for _ in range(2):
+            if not self._keys:
+                return
+            key, entry = next(iter(self._keys.items()))
+            if entry[0] >= win - 1:
+                return
+            del self._keys[key]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+class SharedMemoryRateLimiter:
+    """Sliding-window-counter limiter shared by all workers on one host.
+
+    Counters live in a fixed-size open-addressing hash table in a memory-mapped
+    file (``/dev/shm`` by default), so every uvicorn worker sees the same counts.
+    A slot is (key fingerprint u64, window index i64, previous u32, current u32).
+    After the header, each stripe has (slots in use u64, rejected u64) counters,
+    so stats cover all workers and cost O(stripes) to read.
+    The table is split into stripes; a key only probes inside its stripe and each
+    check holds an fcntl byte-range lock on that stripe, which makes the
+    read-modify-write atomic across processes. The first worker to open the file
+    sizes it and later ones map it as it is; it is never truncated, so pages other
+    workers have mapped stay valid. The table size caps tracked keys:
+    when none of a key's probe slots is free or expired, the stalest one is reused
+    (fails open for that key, like eviction in the in-memory limiter).
+    Only PROBES slots are looked at per key, so a check stays O(1).
     """
 
-    def __init__(self, limit: int, window_sec: int):
+    MAGIC = b"SAR2"
+    HEADER = struct.Struct("<4sIQ")  # magic, stripe size, slots
+    COUNTERS = struct.Struct("<QQ")  # per stripe: slots in use, rejected checks
+    SLOT = struct.Struct("<QqII")
+    COUNTERS_OFFSET = 64
+    shared = True  # counts cover every worker on the host
+    STRIPE = 64  # slots per lock stripe
+    PROBES = 8  # slots examined per key, starting at its home slot
+
+    def __init__(
+        self,
+        limit: int,
+        window_sec: int,
+        path: str,
+        max_keys: int = 100_000,
+        site_limits: Optional[Dict[str, int]] = None,
+    ):
+        import fcntl  # POSIX only; imported here so the in-memory limiter works everywhere
+
+        self._fcntl = fcntl
         self.limit = limit
-        self.window_sec = window_sec
-        self._bucket: Dict[str, List[int]] = {}
-
-    def allow(self, key: str, now_ms: int) -> bool:
-        now_sec = now_ms // 1000
-        start = now_sec - self.window_sec
-        arr = self._bucket.get(key) or []
-        arr = [t for t in arr if t >= start]
-        if len(arr) >= self.limit:
-            self._bucket[key] = arr
+        self.window_ms = window_sec * 1000
+        self.site_limits: Dict[str, int] = site_limits or {}
+        self.stripes = max(1, -(-max_keys // self.STRIPE))
+        self.slots = self.stripes * self.STRIPE
+        self.max_keys = self.slots
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Lock offset 0 guards initialization; stripe i locks offset i + 1.
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            header = os.pread(self._fd, self.HEADER.size, 0)
+            magic, stripe, slots = self.HEADER.unpack(header) if len(header) == self.HEADER.size else (b"", 0, 0)
+            if magic == self.MAGIC and stripe == self.STRIPE and slots:
+                # Set up by the first worker: every worker must use its table size
+                if slots != self.slots:
+                    logger.warning("rate_limiter_table: %s has %d slots, using it instead of %d", path, slots, self.slots)
+                self.slots, self.stripes = slots, slots // self.STRIPE
+                self.max_keys = self.slots
+            self._data = self.COUNTERS_OFFSET + self.stripes * self.COUNTERS.size
+            size = self._data + self.slots * self.SLOT.size
+            if magic != self.MAGIC or stripe != self.STRIPE or not slots:
+                # New (or foreign) file: size it once. Never truncate or shrink it: other
+                # workers may have it mapped, and touching pages past the new end is SIGBUS.
+                if os.fstat(self._fd).st_size < size:
+                    os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, bytes(size - self.COUNTERS_OFFSET), self.COUNTERS_OFFSET)
+                os.pwrite(self._fd, self.HEADER.pack(self.MAGIC, self.STRIPE, self.slots), 0)
+            self._mm = mmap.mmap(self._fd, size)
+            self._totals = struct.Struct(f"<{2 * self.stripes}Q")
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+
+    def limit_for(self, site_id: str) -> int:
+        return self.site_limits.get(site_id, self.limit)
+
+    def allow(self, key: str, now_ms: int, limit: Optional[int] = None) -> bool:
+        limit = self.limit if limit is None else limit
+        win = now_ms // self.window_ms
+        # Stable across processes (unlike hash()); 0 marks an empty slot.
+        fp = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+        stripe = fp % self.stripes
+        home = (fp // self.stripes) % self.STRIPE
+        base = self._data + stripe * self.STRIPE * self.SLOT.size
+        counters = self.COUNTERS_OFFSET + stripe * self.COUNTERS.size
+        mm, slot = self._mm, self.SLOT
+
+        self._fcntl.lockf(self._fd, self._fcntl.LOCK_EX, 1, stripe + 1)
+        try:
+            # The key's own slot wins over an earlier free/expired one: claiming that
+            # first would fork the key into two slots and drop its live counts.
+            target = -1
+            free = -1
+            stalest = -1
+            stalest_win = 0
+            for j in range(self.PROBES):
+                off = base + ((home + j) % self.STRIPE) * slot.size
+                s_fp, s_win, _, _ = slot.unpack_from(mm, off)
+                if s_fp == fp:
+                    target = off
+                    break
+                if free < 0 and (s_fp == 0 or s_win < win - 1):
+                    free = off  # free, or idle long enough to carry no weight
+                if stalest < 0 or s_win < stalest_win:
+                    stalest, stalest_win = off, s_win
+            if target < 0:
+                target = free if free >= 0 else stalest
+                if slot.unpack_from(mm, target)[0] == 0:
+                    used, rejected = self.COUNTERS.unpack_from(mm, counters)
+                    self.COUNTERS.pack_into(mm, counters, used + 1, rejected)
+                slot.pack_into(mm, target, fp, win, 0, 0)
+
+            _, s_win, prev, curr = slot.unpack_from(mm, target)
+            if s_win < win:
+                prev = curr if s_win == win - 1 else 0
+                curr = 0
+                s_win = win
+
+            weight = 1 - (now_ms % self.window_ms) / self.window_ms
+            if prev * weight + curr >= limit:
+                slot.pack_into(mm, target, fp, s_win, prev, curr)
+                used, rejected = self.COUNTERS.unpack_from(mm, counters)
+                self.COUNTERS.pack_into(mm, counters, used, rejected + 1)
+                return False
+            slot.pack_into(mm, target, fp, s_win, prev, curr + 1)
+            return True
+        finally:
+            self._fcntl.lockf(self._fd, self._fcntl.LOCK_UN, 1, stripe + 1)
+
+    @property
+    def rejected(self) -> int:
+        """Checks refused by any worker since the file was created."""
+        return sum(self._totals.unpack_from(self._mm, self.COUNTERS_OFFSET)[1::2])
+
+    def __len__(self) -> int:
+        # slots ever claimed (expired keys keep theirs until reused), across workers
+        return sum(self._totals.unpack_from(self._mm, self.COUNTERS_OFFSET)[::2])
+
+
+def _parse_site_limits(raw: str) -> Dict[str, int]:
+    """Parse "site_a:600,site_b:30" into per-site events/window overrides."""
+    out: Dict[str, int] = {}
+    for part in raw.split(","):
+        site_id, _, n = part.strip().partition(":")
+        if site_id and n.strip().isdigit():
+            out[site_id] = int(n)
+    return out
+
+
+def _make_collect_limiter():
+    """Build the /collect limiter; COLLECT_RATE_BACKEND=shm shares counters between workers."""
+    common: Dict[str, Any] = dict(
+        limit=int(os.environ.get("COLLECT_RATE_LIMIT", "120")),
+        window_sec=60,
+        max_keys=int(os.environ.get("COLLECT_RATE_MAX_KEYS", "100000")),
+        site_limits=_parse_site_limits(os.environ.get("COLLECT_RATE_LIMITS", "")),
+    )
+    if os.environ.get("COLLECT_RATE_BACKEND", "memory") == "shm":
+        return SharedMemoryRateLimiter(path=os.environ.get("COLLECT_RATE_SHM_PATH", "/dev/shm/sa_ratelimit"), **common)
+    return SlidingWindowRateLimiter(**common)
+
+
+# 120 events/min per IP+site unless COLLECT_RATE_LIMITS overrides it for a site
+limiter_collect = _make_collect_limiter()
+
+# Max hits accepted in one /collect/batch body (tracker flushes far fewer).
+COLLECT_BATCH_MAX = int(os.environ.get("COLLECT_BATCH_MAX", "200"))
+
+
+class HitWriteBuffer:
+    """Write-behind queue for hit documents.
+
+    Ingest enqueues and returns immediately; a single background task drains the
+    queue into unordered bulk_write batches once `flush_size` docs are waiting or
+    `flush_interval_ms` has passed. A single flusher keeps batches in arrival order,
+    so a pageview is always written before its later duration patch.
+    """
+
+    def __init__(self, max_size: int, flush_size: int, flush_interval_ms: int):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval_ms / 1000
+        self._queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=max_size)
+        self._ready = asyncio.Event()  # queue is non-empty
+        self._full = asyncio.Event()  # a full batch is waiting
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.errors = 0
+        self.last_flush_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def offer(self, docs: List[Dict[str, Any]]) -> bool:
+        """Enqueue all docs or none; False means the caller should shed load."""
+        if self._closing or self.max_size - self._queue.qsize() < len(docs):
+            self.rejected += len(docs)
             return False
-        arr.append(now_sec)
-        self._bucket[key] = arr
+        for doc in docs:
+            self._queue.put_nowait(doc)
+        self.enqueued += len(docs)
+        self._ready.set()
+        if self._queue.qsize() >= self.flush_size:
+            self._full.set()
         return True
 
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def drain(self) -> None:
+        """Stop accepting hits and wait until everything queued is written."""
+        self._closing = True
+        self._ready.set()
+        self._full.set()
+        if self._task is not None:
+            await self._queue.join()
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await self._ready.wait()
+            if not self._closing and self._queue.qsize() < self.flush_size:
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+
+            batch: List[Dict[str, Any]] = []
+            while len(batch) < self.flush_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if self._queue.empty():
+                self._ready.clear()
+            await self._flush(batch)
 
-limiter_collect = SimpleRateLimiter(limit=120, window_sec=60)  # 120 events/min per IP+site
+    async def _flush(self, batch: List[Dict[str, Any]]) -> None:
+        if not batch:
+            return
+        # Later writes to the same hit id win, as with sequential update_one calls.
+        docs = {d["id"]: d for d in batch}
+        t0 = time.perf_counter()
+        try:
+            failed = await storage.write_hits(list(docs.values()))
+            self.errors += len(failed)
+        except Exception as e:
+            self.errors += len(docs)
+            logger.warning("hit_buffer_flush_failed: %s", e)
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            self.flushes += 1
+            self.flushed += len(docs)
+            self.last_flush_size = len(docs)
+            self.last_flush_ms = ms
+            self.max_flush_ms = max(self.max_flush_ms, ms)
+            self.total_flush_ms += ms
+            for _ in batch:
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self._queue.qsize(),
+            "capacity": self.max_size,
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+            "errors": self.errors,
+            "lastFlushSize": self.last_flush_size,
+            "lastFlushMs": self.last_flush_ms,
+            "maxFlushMs": self.max_flush_ms,
+            "avgFlushMs": self.total_flush_ms / self.flushes if self.flushes else 0,
+        }
+
+
+# Optional write-behind ingest (COLLECT_WRITE_BEHIND=1). Off by default: hits
+# queued in memory are lost if the process is killed without a clean shutdown.
+hit_buffer: Optional[HitWriteBuffer] = None
+if os.environ.get("COLLECT_WRITE_BEHIND", "0") == "1":
+    hit_buffer = HitWriteBuffer(
+        max_size=int(os.environ.get("HIT_BUFFER_MAX", "50000")),
+        flush_size=int(os.environ.get("HIT_BUFFER_FLUSH_SIZE", "500")),
+        flush_interval_ms=int(os.environ.get("HIT_BUFFER_FLUSH_MS", "250")),
+    )
+
+
+class SiteRegistry:
+    """In-memory TTL + LRU cache of "is this site active" for the ingest path.
+
+    Unknown/inactive ids are cached too (negative entries, shorter TTL) so floods
+    of bogus siteIds don't reach the database. create_site/delete_site update the local
+    entry; other workers pick up changes when their entry expires.
+    """
+
+    def __init__(self, max_size: int, ttl_sec: float, negative_ttl_sec: float):
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.negative_ttl_sec = negative_ttl_sec
+        self._entries: "OrderedDict[str, Tuple[bool, float]]" = OrderedDict()  # id -> (active, expires_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, site_id: str) -> Optional[bool]:
+        entry = self._entries.get(site_id)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        self._entries.move_to_end(site_id)
+        return entry[0]
+
+    def put(self, site_id: str, active: bool) -> None:
+        ttl = self.ttl_sec if active else self.negative_ttl_sec
+        self._entries[site_id] = (active, time.monotonic() + ttl)
+        self._entries.move_to_end(site_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def active_ids(self, site_ids: List[str]) -> Set[str]:
+        """Return the subset of site_ids that are active, with one query for all misses."""
+        active: Set[str] = set()
+        missing: List[str] = []
+        for sid in site_ids:
+            cached = self.get(sid)
+            if cached is None:
+                missing.append(sid)
+            elif cached:
+                active.add(sid)
+        self.hits += len(site_ids) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            found = await storage.active_site_ids(missing)
+            for sid in missing:
+                self.put(sid, sid in found)
+            active |= found
+        return active
+
+    async def is_active(self, site_id: str) -> bool:
+        return site_id in await self.active_ids([site_id])
+
+
+site_registry = SiteRegistry(
+    max_size=int(os.environ.get("SITE_CACHE_SIZE", "10000")),
+    ttl_sec=float(os.environ.get("SITE_CACHE_TTL_SEC", "60")),
+    negative_ttl_sec=float(os.environ.get("SITE_CACHE_NEGATIVE_TTL_SEC", "30")),
+)
 
 
 def _client_ip(req: Request) -> str:
@@ -187,6 +967,17 @@ def _ip_hash(ip: str, site_id: str) -> str:
     return hashlib.sha256(f"{site_id}:{ip}".encode("utf-8")).hexdigest()
 
 
+def _hit_doc(payload: HitIn, ip: str) -> Dict[str, Any]:
+    """Map a validated hit to the stored document (id, hashed IP); HitIn already cut long text."""
+    doc = payload.model_dump()
+    if not doc["id"]:
+        doc["id"] = f"h_{uuid.uuid4().hex}"  # uuid string
+
+    # Store only hashed IP (privacy). Keep empty if unavailable.
+    doc["ipHash"] = _ip_hash(ip, payload.siteId)
+    return doc
+
+
 def _uniq(arr: List[str]) -> List[str]:
     return list(dict.fromkeys(arr))
 
@@ -268,165 +1059,3302 @@ def _top_by(pageviews: List[Dict[str, Any]], key: str, limit: int = 8) -> List[O
         if not k:
             continue
         m[k] = m.get(k, 0) + 1
-    return [OverviewTopItem(key=k, value=v) for k, v in sorted(m.items(), key=lambda x: x[1], reverse=True)[:limit]]
+    # ties by key, as the other engines order them ($sort _id, ORDER BY k)
+    return [OverviewTopItem(key=k, value=v) for k, v in sorted(m.items(), key=lambda x: (-x[1], x[0]))[:limit]]
 
 
 # -----------------------------
-# Routes
+# Compact hit storage
 # -----------------------------
-@api_router.get("/")
-async def root():
-    return {"message": "Self Analytics API"}
+# HIT_STORAGE=compact writes hits with short keys, without null/empty fields, with per-site
+# integer codes for low-cardinality dimensions and a 16-byte binary ipHash; `python manage.py
+# compact-hits` converts stored hits. Reads accept both layouts. Fields that the overview
+# engines and indexes use (id, siteId, type, ts, url, visitorId, sessionId, durationMs) keep
+# their names in both.
+HIT_STORAGE: str = os.environ.get("HIT_STORAGE", "full")
 
+HIT_SHORT_KEYS: Dict[str, str] = {
+    "title": "ti",
+    "referrer": "r",
+    "scrollMax": "sm",
+    "utm_source": "us",
+    "utm_medium": "um",
+    "utm_campaign": "uc",
+    "utm_term": "ut",
+    "utm_content": "ux",
+    "eventName": "en",
+    "eventProps": "ep",
+    "ipHash": "ip",
+}
+HIT_CODED_KEYS: Dict[str, str] = {
+    "browser": "b",
+    "os": "o",
+    "deviceType": "dt",
+    "lang": "l",
+    "tz": "z",
+    "countryHint": "co",
+    "channel": "ch",
+}
+_HIT_LONG_KEYS: Dict[str, str] = {v: k for k, v in {**HIT_SHORT_KEYS, **HIT_CODED_KEYS}.items()}
+_COMPACTED_FIELDS: Set[str] = set(_HIT_LONG_KEYS.values())
+# API field order, and what a field omitted by compact storage reads back as
+HIT_FIELD_ORDER: List[str] = list(HitIn.model_fields) + ["ipHash"]
+HIT_EMPTY_DEFAULTS: Dict[str, Any] = {"title": "", "referrer": "", "ipHash": ""}
+IP_HASH_BYTES = 16
 
-@api_router.post("/status", response_model=StatusCheck)
-async def create_status_check(input: StatusCheckCreate):
-    status_obj = StatusCheck(**input.model_dump())
-    doc = status_obj.model_dump()
-    doc["timestamp"] = doc["timestamp"].isoformat()
-    _ = await db.status_checks.insert_one(doc)
-    return status_obj
 
+def _stored_keys(field: str) -> List[str]:
+    """Keys a hit field can be stored under, compact first (both during a migration)."""
+    short = HIT_SHORT_KEYS.get(field) or HIT_CODED_KEYS.get(field)
+    return [short, field] if short else [field]
 
-@api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find({}, {"_id": 0}).to_list(1000)
-    for check in status_checks:
-        if isinstance(check.get("timestamp"), str):
-            check["timestamp"] = datetime.fromisoformat(check["timestamp"])
-    return status_checks
 
+def _hit_field_expr(field: str) -> Any:
+    """Aggregation expression reading a hit field from either layout."""
+    keys = _stored_keys(field)
+    return {"$ifNull": [f"${keys[0]}", f"${keys[1]}"]} if len(keys) > 1 else f"${field}"
 
-@api_router.post("/sites", response_model=Site)
-async def create_site(payload: SiteCreate):
-    site_id = f"site_{uuid.uuid4().hex[:12]}"
-    site = Site(
-        id=site_id,
-        name=payload.name.strip(),
-        domain=payload.domain.strip(),
-        createdAt=int(datetime.now(tz=timezone.utc).timestamp() * 1000),
-        isActive=True,
-        sessionTimeoutMin=int(payload.sessionTimeoutMin or 30),
-    )
-    await db.sites.insert_one(site.model_dump())
-    return site
 
+class HitDictionary:
+    """Per-site string <-> small int codes for the HIT_CODED_KEYS fields (db.hit_dicts).
 
-@api_router.get("/sites", response_model=List[Site])
-async def list_sites():
-    rows = await db.sites.find({}, {"_id": 0}).sort("createdAt", -1).to_list(1000)
-    return rows
+    Codes come from a per-(site, field) counter doc; the unique (siteId, field,
+    value) index settles races between processes (the loser re-reads the
+    winner's code, leaving a gap). Mappings never change once written, so both
+    directions are cached for the life of the process, oldest evicted first.
+    """
 
+    def __init__(self, max_entries: int = 100_000):
+        self.max_entries = max_entries
+        self._codes: "OrderedDict[Tuple[str, str, str], int]" = OrderedDict()
+        self._values: "OrderedDict[Tuple[str, str, int], str]" = OrderedDict()
 
-@api_router.delete("/sites/{site_id}")
-async def delete_site(site_id: str):
-    await db.sites.delete_one({"id": site_id})
-    await db.hits.delete_many({"siteId": site_id})
-    return {"ok": True}
+    def _remember(self, site_id: str, field: str, value: str, code: int) -> None:
+        for cache, key, item in (
+            (self._codes, (site_id, field, value), code),
+            (self._values, (site_id, field, code), value),
+        ):
+            cache[key] = item
+            if len(cache) > self.max_entries:
+                cache.popitem(last=False)
 
+    async def _next_code(self, site_id: str, field: str) -> int:
+        counter = {"siteId": site_id, "field": f"#{field}"}
+        for _ in range(2):
+            try:
+                row = await db.hit_dicts.find_one_and_update(
+                    counter, {"$inc": {"code": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+                )
+                return int(row["code"])
+            except DuplicateKeyError:
+                continue  # two first upserts raced; the counter exists now
+        raise RuntimeError(f"hit_dicts counter race: {site_id} {field}")
 
-@api_router.post("/collect", response_model=CollectResponse)
-async def collect_hit(
-    request: Request,
-    payload: HitIn,
-    dnt: Optional[str] = Header(default=None, alias="DNT"),
-):
-    # Respect Do Not Track
-    if dnt == "1":
-        return CollectResponse(ok=True)
+    async def code(self, site_id: str, field: str, value: str) -> int:
+        code = self._codes.get((site_id, field, value))
+        if code is not None:
+            return code
+        entry = {"siteId": site_id, "field": field, "value": value}
+        row = await db.hit_dicts.find_one(entry, {"_id": 0, "code": 1})
+        if row is None:
+            code = await self._next_code(site_id, field)
+            try:
+                await db.hit_dicts.insert_one(dict(entry, code=code))
+                row = {"code": code}
+            except DuplicateKeyError:
+                row = await db.hit_dicts.find_one(entry, {"_id": 0, "code": 1})
+        self._remember(site_id, field, value, int(row["code"]))
+        return int(row["code"])
 
-    now_ms = int(datetime.now(tz=timezone.utc).timestamp() * 1000)
-    ip = _client_ip(request)
+    async def values(self, site_id: str, field: str, codes: Set[int]) -> Dict[int, str]:
+        out: Dict[int, str] = {}
+        missing = []
+        for code in codes:
+            value = self._values.get((site_id, field, code))
+            if value is None:
+                missing.append(code)
+            else:
+                out[code] = value
+        if missing:
+            async for row in db.hit_dicts.find(
+                {"siteId": site_id, "field": field, "code": {"$in": missing}}, {"_id": 0, "value": 1, "code": 1}
+            ):
+                out[row["code"]] = row["value"]
+                self._remember(site_id, field, row["value"], row["code"])
+        return out
 
-    # Best-effort rate limit
-    rl_key = f"{payload.siteId}:{ip}"
-    if not limiter_collect.allow(rl_key, now_ms):
-        raise HTTPException(status_code=429, detail="rate_limited")
 
-    # Validate site exists and active
-    site = await db.sites.find_one({"id": payload.siteId, "isActive": True}, {"_id": 0})
-    if not site:
-        raise HTTPException(status_code=400, detail="invalid_site")
+hit_dict = HitDictionary(int(os.environ.get("HIT_DICT_CACHE_SIZE", "100000")))
 
-    doc = payload.model_dump()
-    if not doc.get("id"):
-        doc["id"] = f"h_{uuid.uuid4().hex}"  # uuid string
 
-    # Store only hashed IP (privacy). Keep empty if unavailable.
-    doc["ipHash"] = _ip_hash(ip, payload.siteId)
+async def _encode_hit(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Compact stored form of a hit doc (either layout in, compact out)."""
+    out: Dict[str, Any] = {}
+    for key, value in doc.items():
+        field = _HIT_LONG_KEYS.get(key, key)
+        if value is None or (value == "" and field in _COMPACTED_FIELDS):
+            continue
+        if field == "ipHash":
+            out["ip"] = value if isinstance(value, bytes) else Binary(bytes.fromhex(value)[:IP_HASH_BYTES])
+        elif field in HIT_CODED_KEYS:
+            code = value if isinstance(value, int) else await hit_dict.code(doc["siteId"], field, str(value))
+            out[HIT_CODED_KEYS[field]] = code
+        else:
+            out[HIT_SHORT_KEYS.get(field, field)] = value
+    return out
 
-    # Basic sanity limits
-    if len(doc.get("url") or "") > 2048:
-        doc["url"] = (doc.get("url") or "")[:2048]
-    if len(doc.get("referrer") or "") > 2048:
-        doc["referrer"] = (doc.get("referrer") or "")[:2048]
-    if len(doc.get("title") or "") > 512:
-        doc["title"] = (doc.get("title") or "")[:512]
 
-    await db.hits.update_one({"id": doc["id"]}, {"$set": doc}, upsert=True)
-    return CollectResponse(ok=True)
+async def _compact_update(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Upsert update writing `doc` in the compact layout.
 
+    Null/empty fields are $unset rather than skipped, so an update clears them
+    as a full-layout $set of None did; full-layout keys are dropped as well.
+    """
+    stored = await _encode_hit(doc)
+    unset = {key: "" for field in doc for key in _stored_keys(field) if key not in stored}
+    return {"$set": stored, "$unset": unset} if unset else {"$set": stored}
 
-@api_router.get("/hits")
-async def list_hits(
-    siteId: str = Query(...),
-    startTs: int = Query(...),
-    endTs: int = Query(...),
-    limit: int = Query(5000, ge=1, le=20000),
-):
-    cur = (
-        db.hits.find({"siteId": siteId, "ts": {"$gte": startTs, "$lte": endTs}}, {"_id": 0})
-        .sort("ts", 1)
-        .limit(limit)
-    )
-    rows = await cur.to_list(length=limit)
-    return {"hits": rows}
 
+async def _decode_hits(
+    site_id: str, docs: List[Dict[str, Any]], fields: Optional[Set[str]] = None
+) -> List[Dict[str, Any]]:
+    """API shape of stored hits of one site, whatever their layout.
 
-@api_router.get("/overview", response_model=OverviewResponse)
-async def overview(
-    siteId: str = Query(...),
-    startTs: int = Query(...),
-    endTs: int = Query(...),
-):
-    # Pull only pageviews for KPI + series; realtime uses last 30m.
-    pageviews = await db.hits.find(
-        {"siteId": siteId, "type": "pageview", "ts": {"$gte": startTs, "$lte": endTs}}, {"_id": 0}
-    ).to_list(length=200000)
+    Hit fields come out in HitIn order. Each field in `fields` (default: all)
+    is present even if compact storage left it out: None, or "" for
+    title/referrer/ipHash. Other keys (e.g. `_id`) pass through.
+    """
+    codes: Dict[str, Set[int]] = {}
+    for d in docs:
+        for field, short in HIT_CODED_KEYS.items():
+            if isinstance(d.get(short), int):
+                codes.setdefault(field, set()).add(d[short])
+    values = {field: await hit_dict.values(site_id, field, c) for field, c in codes.items()}
 
-    series = _group_by_day(pageviews)
-    kpis = _calc_kpis(pageviews)
+    fill = set(HIT_FIELD_ORDER) if fields is None else fields
+    out = []
+    for d in docs:
+        long: Dict[str, Any] = {}
+        for key, value in d.items():
+            field = _HIT_LONG_KEYS.get(key)
+            if field is None:
+                long.setdefault(key, value)  # full layout; compact keys below win
+                continue
+            if field in HIT_CODED_KEYS and isinstance(value, int):
+                value = values[field].get(value)
+            elif field == "ipHash" and isinstance(value, bytes):
+                value = value.hex()
+            long[field] = value
+        row = {f: long[f] if f in long else HIT_EMPTY_DEFAULTS.get(f) for f in HIT_FIELD_ORDER if f in long or f in fill}
+        row.update((k, v) for k, v in long.items() if k not in row)
+        out.append(row)
+    return out
 
-    now_ms = int(datetime.now(tz=timezone.utc).timestamp() * 1000)
-    rt_start = max(startTs, now_ms - 30 * 60 * 1000)
-    realtime_hits = await db.hits.find(
-        {"siteId": siteId, "type": "pageview", "ts": {"$gte": rt_start, "$lte": endTs}}, {"_id": 0}
-    ).sort("ts", -1).limit(50).to_list(length=50)
-
-    active_start = max(startTs, now_ms - 5 * 60 * 1000)
-    active_ids = await db.hits.distinct(
-        "visitorId", {"siteId": siteId, "type": "pageview", "ts": {"$gte": active_start, "$lte": endTs}}
-    )
 
-    top_pages = _top_by(pageviews, "url", limit=8)
+# -----------------------------
+# Hit partitions and retention
+# -----------------------------
+# HIT_PARTITIONS=monthly writes hits to one collection per UTC month (hits_YYYYMM): reads only
+# touch the months a range overlaps, and expired months are dropped whole. Reads always include
+# the unpartitioned `hits` collection as well, so switching needs no migration (old hits age out).
+HIT_PARTITIONS: str = os.environ.get("HIT_PARTITIONS", "none")
+_PARTITION_RE = re.compile(r"^hits_(\d{4})(\d{2})$")
 
-    return OverviewResponse(
-        siteId=siteId,
-        startTs=startTs,
-        endTs=endTs,
-        kpis=kpis,
-        series=series,
-        realtime=realtime_hits,
-        activeVisitors=len(active_ids or []),
-        topPages=top_pages,
-    )
+# Default retention for sites without retentionDays (unset: keep forever)
+HIT_RETENTION_DAYS: Optional[int] = int(os.environ["HIT_RETENTION_DAYS"]) if os.environ.get("HIT_RETENTION_DAYS") else None
+RETENTION_INTERVAL_SEC = float(os.environ.get("RETENTION_INTERVAL_SEC", "3600"))
 
 
-TRACKER_JS = (
-    "!function(){var w=window,d=document;var sc=d.currentScript||function(){var s=d.getElementsByTagName('script');return s[s.length-1]}();"
-    "var sid=(sc&&sc.getAttribute&&sc.getAttribute('data-site'))||'';if(!sid||!w||!d)return;"
-    "if(navigator.doNotTrack==='1'||w.doNotTrack==='1')return;"
-    "function rid(n){var a=new Uint8Array(n);(w.crypto||w.msCrypto).getRandomValues(a);for(var s='',i=0;i<a.length;i++)s+=String.fromCharCode(a[i]);"
+def _partition_name(ts: int) -> str:
+    ts = min(max(0, ts), MAX_DAY * DAY_MS)
+    return "hits_" + datetime.fromtimestamp(ts / 1000, tz=timezone.utc).strftime("%Y%m")
+
+
+def _partition_span(name: str) -> Tuple[int, int]:
+    """[start, end) in ms of a monthly partition."""
+    m = _PARTITION_RE.match(name)
+    year, month = int(m.group(1)), int(m.group(2))
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+
+async def _ensure_hit_indexes(coll: AsyncIOMotorCollection) -> None:
+    await coll.create_index([("siteId", 1), ("ts", 1), ("id", 1)])  # keyset pagination
+    await coll.create_index([("siteId", 1), ("type", 1), ("ts", 1)])
+    await coll.create_index("id", unique=True)
+    for dim in BREAKDOWN_INDEXES:
+        key = _stored_keys(dim)[0] if HIT_STORAGE == "compact" else dim
+        await coll.create_index([("siteId", 1), ("type", 1), ("ts", 1), (key, 1), ("visitorId", 1)])
+
+
+class HitPartitions:
+    """Which hit collections exist, and which of them a ts range touches.
+
+    The collection list is cached for `ttl_sec`; partitions this process
+    creates are added immediately, and a range reaching the present always
+    includes the current month, so a month another process just started is
+    not missed.
+    """
+
+    def __init__(self, ttl_sec: float = 30.0):
+        self.ttl_sec = ttl_sec
+        self._names: Set[str] = set()
+        self._loaded_at = float("-inf")
+        self._indexed: Set[str] = set()
+
+    async def names(self) -> Set[str]:
+        if time.monotonic() - self._loaded_at > self.ttl_sec:
+            names = await db.list_collection_names()
+            self._names = {n for n in names if n == "hits" or _PARTITION_RE.match(n)}
+            self._loaded_at = time.monotonic()
+        return self._names
+
+    def forget(self, name: str) -> None:
+        self._names.discard(name)
+        self._indexed.discard(name)
+
+    async def for_range(self, startTs: Optional[int] = None, endTs: Optional[int] = None) -> List[str]:
+        """Hit collections overlapping [startTs, endTs]: `hits` first, then months in order."""
+        names = set(await self.names())
+        if HIT_PARTITIONS == "monthly":
+            names.add(_partition_name(int(time.time() * 1000)))
+        out = ["hits"] if "hits" in names or HIT_PARTITIONS != "monthly" else []
+        for name in sorted(n for n in names if n != "hits"):
+            lo, hi = _partition_span(name)
+            if (startTs is None or hi > startTs) and (endTs is None or lo <= endTs):
+                out.append(name)
+        return out
+
+    async def for_write(self, ts: int) -> AsyncIOMotorCollection:
+        name = _partition_name(ts) if HIT_PARTITIONS == "monthly" else "hits"
+        if name not in self._indexed:
+            await _ensure_hit_indexes(db[name])
+            self._indexed.add(name)
+            self._names.add(name)
+        return db[name]
+
+
+hit_partitions = HitPartitions(float(os.environ.get("HIT_PARTITIONS_TTL_SEC", "30")))
+
+
+async def _find_hits(
+    query: Dict[str, Any],
+    projection: Dict[str, Any],
+    startTs: Optional[int] = None,
+    endTs: Optional[int] = None,
+    sort: Optional[List[Tuple[str, int]]] = None,
+    limit: Optional[int] = None,
+    batch_size: Optional[int] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """find() across the hit collections overlapping [startTs, endTs] (the query
+    still needs its own ts filter). With `sort` the per-collection results are
+    merged into one ordered stream; sort fields must be projected."""
+    cursors = []
+    for name in await hit_partitions.for_range(startTs, endTs):
+        cur = db[name].find(query, projection)
+        if sort:
+            cur = cur.sort(sort)
+        if limit:
+            cur = cur.limit(limit)
+        if batch_size:
+            cur = cur.batch_size(batch_size)
+        cursors.append(cur)
+
+    n = 0
+    if not sort or len(cursors) <= 1:
+        for cur in cursors:
+            async for doc in cur:
+                yield doc
+                n += 1
+                if limit and n >= limit:
+                    return
+        return
+
+    # k-way merge by linear scan of the heads: there are only a few partitions per range
+    desc = sort[0][1] < 0
+    heads = [await anext(cur, None) for cur in cursors]
+    while True:
+        best = None
+        for i, doc in enumerate(heads):
+            if doc is None:
+                continue
+            if best is None:
+                best = i
+                continue
+            a = tuple(doc.get(f) for f, _ in sort)
+            b = tuple(heads[best].get(f) for f, _ in sort)
+            if (a > b) if desc else (a < b):
+                best = i
+        if best is None:
+            return
+        yield heads[best]
+        n += 1
+        if limit and n >= limit:
+            return
+        heads[best] = await anext(cursors[best], None)
+
+
+async def _aggregate_hits(pipeline: List[Dict[str, Any]], startTs: int, endTs: int):
+    """aggregate() over the hit collections a range touches: the leading $match
+    runs in each of them and $unionWith feeds the rest of the pipeline (MongoDB 4.4+)."""
+    names = await hit_partitions.for_range(startTs, endTs) or ["hits"]
+    match, rest = pipeline[0], pipeline[1:]
+    union = [{"$unionWith": {"coll": name, "pipeline": [match]}} for name in names[1:]]
+    return db[names[0]].aggregate([match, *union, *rest], allowDiskUse=True)
+
+
+async def apply_retention(now_ms: Optional[int] = None) -> Dict[str, int]:
+    """Delete hits (and derived data) past each site's retention, in whichever storage is configured.
+
+    TTL indexes need a Date field, and ts is epoch ms, so this runs as a periodic sweep.
+    """
+    now_ms = now_ms or int(time.time() * 1000)
+    sites = await storage.list_sites(limit=None)
+    retention = {s["id"]: s.get("retentionDays") or HIT_RETENTION_DAYS for s in sites}
+    return await storage.apply_retention(retention, now_ms)
+
+
+async def _apply_retention_mongo(retention: Dict[str, Optional[int]], now_ms: int) -> Dict[str, int]:
+    """Monthly partitions older than every site's retention are dropped whole;
+    what remains is deleted per site on the (siteId, ts) index, along with
+    rollups, sessions and heavy hitters of the expired days."""
+    dropped = 0
+    if retention and all(retention.values()):
+        horizon = now_ms - max(retention.values()) * DAY_MS
+        for name in await hit_partitions.for_range(None, horizon):
+            if name != "hits" and _partition_span(name)[1] <= horizon:
+                await db[name].drop()
+                hit_partitions.forget(name)
+                dropped += 1
+
+    deleted = 0
+    for site_id, days in retention.items():
+        if not days:
+            continue
+        cutoff = now_ms - days * DAY_MS
+        site_deleted = 0
+        for name in await hit_partitions.for_range(None, cutoff - 1):
+            res = await db[name].delete_many({"siteId": site_id, "ts": {"$lt": cutoff}})
+            site_deleted += res.deleted_count
+        # derived data: whole days before the cutoff day, sessions that ended before it
+        await db.daily_rollups.delete_many({"siteId": site_id, "day": {"$lt": _day_key(cutoff)}})
+        await db.daily_urls.delete_many({"siteId": site_id, "day": {"$lt": _day_key(cutoff)}})
+        await db.heavy_hitters.delete_many({"siteId": site_id, "day": {"$lt": _day_key(cutoff)}})
+        await db.sessions.delete_many({"siteId": site_id, "last": {"$lt": cutoff}})
+        if site_deleted and overview_cache is not None:
+            overview_cache.bump(site_id)
+        deleted += site_deleted
+    return {"droppedPartitions": dropped, "deletedHits": deleted}
+
+
+# -----------------------------
+# Sketches
+# -----------------------------
+HLL_P = 12  # 4096 registers: relative standard error 1.04 / sqrt(4096) ~= 1.6%
+_POW2_NEG = [2.0 ** -i for i in range(65)]
+
+
+class HyperLogLog:
+    """HyperLogLog cardinality sketch (Flajolet et al. 2007, 64-bit hash).
+
+    Registers are kept dense in memory; in Mongo they are stored sparse as
+    {hexIndex: rank} so ingest can raise a register with a plain $max and
+    concurrent writers never need to read-modify-write. Sketches merge by
+    register-wise max, so the union of any set of daily sketches is a sketch of
+    the union. With p=12 the relative standard error is ~1.6% (so ~95% of
+    estimates fall within ±3.3%); small cardinalities use linear counting and
+    are near exact.
+    """
+
+    def __init__(self, p: int = HLL_P):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    @staticmethod
+    def position(value: str, p: int = HLL_P) -> Tuple[int, int]:
+        """(register index, rank) for a value: first p hash bits pick the register."""
+        h = int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+        rest = h & ((1 << (64 - p)) - 1)
+        return h >> (64 - p), (64 - p) - rest.bit_length() + 1
+
+    def add(self, value: str) -> None:
+        idx, rank = self.position(value, self.p)
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge_sparse(self, sparse: Dict[str, int]) -> None:
+        for k, rank in sparse.items():
+            idx = int(k, 16)
+            if rank > self.registers[idx]:
+                self.registers[idx] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        m = self.m
+        est = (0.7213 / (1 + 1.079 / m)) * m * m / sum(_POW2_NEG[r] for r in self.registers)
+        zeros = self.registers.count(0)
+        if est <= 2.5 * m and zeros:
+            est = m * math.log(m / zeros)  # linear counting for small ranges
+        return int(round(est))
+
+
+def _hll_sparse_add(sparse: Dict[str, int], value: str) -> None:
+    idx, rank = HyperLogLog.position(value)
+    k = format(idx, "x")
+    if rank > sparse.get(k, 0):
+        sparse[k] = rank
+
+
+HH_CAPACITY = int(os.environ.get("HEAVY_HITTERS_K", "64"))
+
+
+class HeavyHitters:
+    """Misra-Gries frequent-items summary with at most k counters (mergeable form).
+
+    Counts are exact until more than k distinct keys are seen. Past that the
+    summary keeps the k largest counters after subtracting the (k+1)-th largest
+    from all of them, and adds what it subtracted to `err`. Every kept count is
+    then a lower bound: true count is in [count, count + err], err <= n / (k+1),
+    and any key with a true count above err is guaranteed to be kept. Merging
+    two summaries (Agarwal et al. 2012) sums counters and errors and prunes
+    again, so daily summaries combine into a summary of any date range.
+    `n` counts every value offered, including empty ones (which get no counter).
+    """
+
+    __slots__ = ("k", "counts", "n", "err")
+
+    def __init__(self, k: int = HH_CAPACITY):
+        self.k = k
+        self.counts: Dict[str, int] = {}
+        self.n = 0
+        self.err = 0
+
+    def add(self, key: str, weight: int = 1) -> None:
+        self.n += weight
+        if not key:
+            return
+        self.counts[key] = self.counts.get(key, 0) + weight
+        if len(self.counts) > 2 * self.k:  # prune lazily: amortized O(1) per add
+            self._prune()
+
+    def merge(self, other: "HeavyHitters") -> "HeavyHitters":
+        for key, c in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + c
+        self.n += other.n
+        self.err += other.err
+        if len(self.counts) > 2 * self.k:
+            self._prune()
+        return self
+
+    def _prune(self) -> None:
+        if len(self.counts) <= self.k:
+            return
+        cut = sorted(self.counts.values(), reverse=True)[self.k]
+        self.counts = {key: c - cut for key, c in self.counts.items() if c > cut}
+        self.err += cut
+
+    def top(self, limit: int) -> List[Tuple[str, int]]:
+        self._prune()
+        return sorted(self.counts.items(), key=lambda kv: (-kv[1], kv[0]))[:limit]
+
+    def to_doc(self) -> Dict[str, Any]:
+        self._prune()
+        # [key, count] pairs: keys are arbitrary strings, not safe as field names
+        return {"n": self.n, "err": self.err, "c": [[key, c] for key, c in self.counts.items()]}
+
+    @classmethod
+    def from_doc(cls, doc: Optional[Dict[str, Any]], k: int = HH_CAPACITY) -> "HeavyHitters":
+        hh = cls(k)
+        if doc:
+            hh.counts = {key: int(c) for key, c in doc.get("c") or []}
+            hh.n = int(doc.get("n") or 0)
+            hh.err = int(doc.get("err") or 0)
+        return hh
+
+
+# -----------------------------
+# Daily rollups
+# -----------------------------
+DAY_MS = 24 * 60 * 60 * 1000
+MAX_DAY = 2932896  # 9999-12-31, the last day datetime can format
+
+# Maintain db.daily_rollups and db.daily_urls at ingest. On by default only while the rollup
+# engine serves overviews (OVERVIEW_ENGINE=rollup|sessions); DAILY_ROLLUPS=0 turns it off,
+# e.g. during bulk imports followed by `python manage.py rebuild-rollups`.
+ROLLUP_ENGINES = ("rollup", "sessions")
+DAILY_ROLLUPS = os.environ.get("DAILY_ROLLUPS", "1" if OVERVIEW_ENGINE in ROLLUP_ENGINES else "0") == "1"
+
+
+def _day_key(ts: int) -> str:
+    return datetime.fromtimestamp(ts / 1000, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+def _rk(value: str) -> str:
+    """Map an arbitrary string to a safe Mongo field name (no dots / leading $)."""
+    if not value:
+        return "_"
+    return hashlib.blake2b(value.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _rollup_update(doc: Dict[str, Any], inserted: bool) -> Optional[UpdateOne]:
+    """$inc-style update of the (siteId, day) rollup for one new pageview.
+
+    Rollup shape: {siteId, day, pageviews, hll: {v: {hexIndex: rank}, s: {...}}},
+    so a day never holds more than a counter and 2 * 4096 registers however busy
+    the site is. Per-URL counts live in db.daily_urls, per-session state in
+    db.sessions. Updates of an existing hit (the tracker's duration patch) don't
+    touch the rollup.
+    """
+    if not inserted or doc.get("type") != "pageview":
+        return None
+    update: Dict[str, Dict[str, Any]] = {"$inc": {"pageviews": 1}}
+    for field, value in (("v", doc.get("visitorId")), ("s", doc.get("sessionId"))):
+        if value:
+            idx, rank = HyperLogLog.position(value)
+            update.setdefault("$max", {})[f"hll.{field}.{idx:x}"] = rank
+    return UpdateOne({"siteId": doc["siteId"], "day": _day_key(int(doc["ts"]))}, update, upsert=True)
+
+
+def _url_count_update(doc: Dict[str, Any], inserted: bool) -> Optional[UpdateOne]:
+    """+1 on the {siteId, day, k: _rk(url), u: url, n} counter in db.daily_urls for one new pageview."""
+    url = (doc.get("url") or "").strip()
+    if not inserted or doc.get("type") != "pageview" or not url:
+        return None
+    flt = {"siteId": doc["siteId"], "day": _day_key(int(doc["ts"])), "k": _rk(url)}
+    return UpdateOne(flt, {"$inc": {"n": 1}, "$setOnInsert": {"u": url}}, upsert=True)
+
+
+def _rollups_from_hits(pageviews: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Build in-memory rollups (day -> rollup) from raw pageviews; each also carries
+    that day's db.daily_urls counters as urls: {k: {u, n}}."""
+    out: Dict[str, Dict[str, Any]] = {}
+    for h in pageviews:
+        day = _day_key(int(h.get("ts", 0)))
+        r = out.get(day)
+        if r is None:
+            r = out[day] = {
+                "siteId": h.get("siteId"),
+                "day": day,
+                "pageviews": 0,
+                "hll": {"v": {}, "s": {}},
+                "urls": {},
+            }
+        r["pageviews"] += 1
+        if h.get("visitorId"):
+            _hll_sparse_add(r["hll"]["v"], h["visitorId"])
+        if h.get("sessionId"):
+            _hll_sparse_add(r["hll"]["s"], h["sessionId"])
+
+        url = (h.get("url") or "").strip()
+        if url:
+            u = r["urls"].setdefault(_rk(url), {"u": url, "n": 0})
+            u["n"] += 1
+    return out
+
+
+def _overview_from_rollups(
+    rollups: List[Dict[str, Any]],
+    urls: List[Dict[str, Any]],
+    sessions: List[Dict[str, Any]],
+    top_limit: int = 8,
+) -> Tuple[List[OverviewSeriesPoint], Dict[str, Any], List[OverviewTopItem]]:
+    """Series, KPIs and top pages from daily rollups, matching _group_by_day/_calc_kpis/_top_by.
+
+    Visitor/session uniques are HLL estimates (near exact for small counts).
+    `urls` are stored {u, n} counters, added to those the rollups carry; the
+    session KPIs are computed over `sessions` (see _session_kpis).
+    """
+    by_day: Dict[str, Dict[str, Any]] = {}
+    counts: Dict[str, int] = {}
+    pageviews = 0
+    for r in rollups:
+        d = by_day.get(r["day"])
+        if d is None:
+            d = by_day[r["day"]] = {"pv": 0, "visitors": HyperLogLog(), "sessions": HyperLogLog()}
+        n = int(r.get("pageviews") or 0)
+        d["pv"] += n
+        pageviews += n
+        hll = r.get("hll") or {}
+        d["visitors"].merge_sparse(hll.get("v") or {})
+        d["sessions"].merge_sparse(hll.get("s") or {})
+        for u in (r.get("urls") or {}).values():
+            counts[u["u"]] = counts.get(u["u"], 0) + u["n"]
+    for u in urls:
+        counts[u["u"]] = counts.get(u["u"], 0) + int(u.get("n") or 0)
+
+    series: List[OverviewSeriesPoint] = []
+    visitors = HyperLogLog()
+    for day in sorted(by_day.keys()):
+        d = by_day[day]
+        visitors.merge(d["visitors"])
+        series.append(
+            OverviewSeriesPoint(
+                day=day, pageviews=int(d["pv"]), visitors=d["visitors"].count(), sessions=d["sessions"].count()
+            )
+        )
+
+    kpis = {
+        "visits": pageviews,
+        "visitors": visitors.count(),
+        "pageviews": pageviews,
+        **_session_kpis(sessions, pageviews),
+    }
+
+    top = sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))[:top_limit]
+    top_pages = [OverviewTopItem(key=u, value=n) for u, n in top]
+    return series, kpis, top_pages
+
+
+async def _write_derived(
+    coll: AsyncIOMotorCollection, pairs: List[Tuple[Dict[str, Any], UpdateOne]]
+) -> List[Dict[str, Any]]:
+    """bulk_write the (hit doc, update) pairs of one derived store; returns the docs whose update failed."""
+    if not pairs:
+        return []
+    try:
+        await coll.bulk_write([op for _, op in pairs], ordered=False)
+        return []
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        logger.error("%s_write_errors: %d", coll.name, len(errors))
+        return [pairs[err["index"]][0] for err in errors]
+    except PyMongoError as e:
+        logger.error("%s_write_failed: %s", coll.name, e)
+        return [d for d, _ in pairs]
+
+
+async def _mark_stale(days: Set[Tuple[str, str]]) -> None:
+    """Flag (siteId, day) rollups that missed updates; the rollup engine reads windows
+    touching them from the hits until `python manage.py rebuild-rollups` rewrites them."""
+    ops = [UpdateOne({"siteId": s, "day": d}, {"$set": {"stale": True}}, upsert=True) for s, d in sorted(days)]
+    await db.daily_rollups.bulk_write(ops, ordered=False)
+    logger.error("rollups_marked_stale: %s", ", ".join(f"{s}/{d}" for s, d in sorted(days)))
+
+
+async def _persist_hits(docs: List[Dict[str, Any]]) -> Set[str]:
+    """Upsert hit docs with unordered bulk_writes, then update sessions and daily rollups (concurrently,
+    and only the stores that are on) and the in-memory heavy hitters.
+
+    Callers pass at most one doc per hit id. Returns the ids that failed to write,
+    including stored hits whose session or rollup update failed.
+    """
+    # one bulk_write per partition (a single one unless HIT_PARTITIONS=monthly)
+    groups: Dict[int, Tuple[AsyncIOMotorCollection, List[int]]] = {}
+    for i, d in enumerate(docs):
+        coll = await hit_partitions.for_write(int(d["ts"]))
+        groups.setdefault(id(coll), (coll, []))[1].append(i)
+
+    failed: Set[str] = set()
+    upserted: Set[int] = set()
+    for coll, idxs in groups.values():
+        if HIT_STORAGE == "compact":
+            ops = [UpdateOne({"id": docs[i]["id"]}, await _compact_update(docs[i]), upsert=True) for i in idxs]
+        else:
+            ops = [UpdateOne({"id": docs[i]["id"]}, {"$set": docs[i]}, upsert=True) for i in idxs]
+        try:
+            res = await coll.bulk_write(ops, ordered=False)
+            upserted |= {idxs[j] for j in res.upserted_ids}
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            failed |= {docs[idxs[err["index"]]]["id"] for err in errors}
+            upserted |= {idxs[u["index"]] for u in e.details.get("upserted", [])}
+            logger.warning("hits_write_errors: %d", len(errors))
+
+    if overview_cache is not None:
+        for site_id in {d["siteId"] for d in docs if d["id"] not in failed}:
+            overview_cache.bump(site_id)
+
+    # the derived stores are independent of each other: one concurrent round of writes
+    written = [(d, i in upserted) for i, d in enumerate(docs) if d["id"] not in failed]
+    derived: List[Tuple[AsyncIOMotorCollection, Callable[[Dict[str, Any], bool], Optional[UpdateOne]]]] = []
+    if SESSIONS_AT_INGEST:
+        derived.append((db.sessions, _session_update))
+    if DAILY_ROLLUPS:
+        derived += [(db.daily_rollups, _rollup_update), (db.daily_urls, _url_count_update)]
+    writes = [
+        _write_derived(coll, [(d, op) for d, ins in written for op in (update(d, ins),) if op is not None])
+        for coll, update in derived
+    ]
+    lost: List[Dict[str, Any]] = [d for res in await asyncio.gather(*writes) for d in res]
+    if heavy_hitter_writer is not None:
+        # in memory only; HeavyHitterWriter stores them off the request path
+        heavy_hitter_writer.add([d for d, ins in written if ins and d.get("type") == "pageview"])
+    if lost:
+        # The hits are stored but missing from the derived stores: fail them like any other
+        # write, and keep the rollup engine on the raw hits for their days until rebuilt.
+        if DAILY_ROLLUPS:
+            await _mark_stale({(d["siteId"], _day_key(int(d["ts"]))) for d in lost})
+        failed |= {d["id"] for d in lost}
+    return failed
+
+
+async def compact_hits(site_id: Optional[str] = None, batch_size: int = 1000) -> int:
+    """Rewrite full-layout hits (all sites, or one) in the compact layout. Returns hits converted.
+
+    Safe to re-run or interrupt: converted hits no longer have `ipHash`, so they are skipped.
+    """
+    if site_id:
+        site_ids = [site_id]
+    else:
+        site_ids = [s["id"] for s in await db.sites.find({}, {"_id": 0, "id": 1}).to_list(length=None)]
+
+    converted = 0
+    for name in await hit_partitions.for_range():
+        for sid in site_ids:
+            while True:
+                flt = {"siteId": sid, "ipHash": {"$exists": True}}
+                docs = await db[name].find(flt).limit(batch_size).to_list(length=None)
+                if not docs:
+                    break
+                ops = [
+                    ReplaceOne({"_id": d["_id"]}, await _encode_hit({k: v for k, v in d.items() if k != "_id"}))
+                    for d in docs
+                ]
+                await db[name].bulk_write(ops, ordered=False)
+                converted += len(ops)
+    return converted
+
+
+async def rebuild_rollups(site_id: Optional[str] = None) -> int:
+    """Recompute db.daily_rollups, db.daily_urls (and db.heavy_hitters) from the hits (all sites,
+    or one), clearing stale marks. Returns days written.
+
+    Streams pageviews in ts order and keeps only one day in memory. Days being
+    ingested while this runs may lose the increments that race the rewrite.
+    """
+    if site_id:
+        site_ids = [site_id]
+    else:
+        site_ids = [s["id"] for s in await db.sites.find({}, {"_id": 0, "id": 1}).to_list(length=None)]
+
+    fields = {"_id": 0, "siteId": 1, "ts": 1, "url": 1, "visitorId": 1, "sessionId": 1}
+    fields.update({k: 1 for d in HEAVY_HITTER_DIMS for k in _stored_keys(d)})
+    written = 0
+    for sid in site_ids:
+        await db.daily_rollups.delete_many({"siteId": sid})
+        await db.daily_urls.delete_many({"siteId": sid})
+        await db.heavy_hitters.delete_many({"siteId": sid})
+        day_hits: List[Dict[str, Any]] = []
+        cur_day = None
+        async for h in _find_hits({"siteId": sid, "type": "pageview"}, fields, sort=[("ts", 1)]):
+            day = _day_key(int(h["ts"]))
+            if cur_day is not None and day != cur_day:
+                written += await _store_rollups(sid, day_hits)
+                day_hits = []
+            cur_day = day
+            day_hits.append(h)
+        if day_hits:
+            written += await _store_rollups(sid, day_hits)
+    return written
+
+
+async def _store_rollups(site_id: str, pageviews: List[Dict[str, Any]]) -> int:
+    pageviews = await _decode_hits(site_id, pageviews, set(HEAVY_HITTER_DIMS))
+    rollups = _rollups_from_hits(pageviews)
+    for r in rollups.values():
+        urls = r.pop("urls")
+        r["siteId"] = site_id
+        await db.daily_rollups.replace_one({"siteId": site_id, "day": r["day"]}, r, upsert=True)
+        if urls:
+            key = {"siteId": site_id, "day": r["day"]}
+            await db.daily_urls.bulk_write(
+                [ReplaceOne(dict(key, k=k), dict(key, k=k, **u), upsert=True) for k, u in urls.items()],
+                ordered=False,
+            )
+    if HEAVY_HITTER_DIMS:
+        for (_, day), dims in _heavy_hitters_from_hits([dict(h, siteId=site_id) for h in pageviews]).items():
+            await db.heavy_hitters.replace_one(
+                {"siteId": site_id, "day": day, "w": "rebuild"},
+                {"siteId": site_id, "day": day, "w": "rebuild", "dims": {d: hh.to_doc() for d, hh in dims.items()}},
+                upsert=True,
+            )
+    return len(rollups)
+
+
+def _split_window(startTs: int, endTs: int) -> Tuple[Optional[Dict[str, str]], List[Tuple[int, int]]]:
+    """Split [startTs, endTs] into a `day` filter for the whole UTC days inside it
+    (None if there are none) and the non-empty raw ts ranges left at the edges."""
+    first_full = max(0, -(-startTs // DAY_MS))  # first day starting at/after startTs
+    end_full = min(MAX_DAY, (endTs + 1) // DAY_MS)  # days [first_full, end_full) end at/before endTs
+    if first_full >= end_full:
+        return None, [(startTs, endTs)] if startTs <= endTs else []
+    days = {"$gte": _day_key(first_full * DAY_MS), "$lt": _day_key(end_full * DAY_MS)}
+    edges = [(startTs, first_full * DAY_MS - 1), (end_full * DAY_MS, endTs)]
+    return days, [(lo, hi) for lo, hi in edges if lo <= hi]
+
+
+async def _overview_rollup(
+    siteId: str, startTs: int, endTs: int, with_urls: bool = True
+) -> Optional[Tuple[List[OverviewSeriesPoint], Dict[str, Any], List[OverviewTopItem]]]:
+    """Overview from rollups for whole UTC days inside the range, raw hits for the partial edges.
+
+    Session KPIs come from db.sessions and count sessions that started in the
+    window (whole sessions, even if they run past endTs); raw clips sessions to
+    the window instead, so the two agree whenever no session straddles a window
+    edge. with_urls=False skips db.daily_urls (top pages then only cover the
+    edges). Returns None when a day of the window is marked stale.
+    """
+    days, raw_ranges = _split_window(startTs, endTs)
+    # edge days too: a stale mark on any day the window touches sends it to the raw hits
+    span = {"$gte": _day_key(max(0, startTs)), "$lte": _day_key(min(endTs, MAX_DAY * DAY_MS - 1))}
+    projection = {"_id": 0, "day": 1, "pageviews": 1, "hll": 1, "stale": 1}
+    reads = [
+        db.daily_rollups.find({"siteId": siteId, "day": span}, projection).to_list(length=None),
+        db.sessions.find(
+            {"siteId": siteId, "first": {"$gte": startTs, "$lte": endTs}}, SESSION_FIELDS
+        ).to_list(length=None),
+    ]
+    if days and with_urls:
+        reads.append(
+            db.daily_urls.aggregate(
+                [
+                    {"$match": {"siteId": siteId, "day": days}},
+                    {"$group": {"_id": "$k", "u": {"$first": "$u"}, "n": {"$sum": "$n"}}},
+                ]
+            ).to_list(length=None)
+        )
+    stored, sessions, *urls = await asyncio.gather(*reads)
+    if any(r.get("stale") for r in stored):
+        return None
+    rollups = [r for r in stored if days and days["$gte"] <= r["day"] < days["$lt"]]
+    urls = urls[0] if urls else []
+
+    fields = {"_id": 0, "siteId": 1, "ts": 1, "url": 1, "visitorId": 1, "sessionId": 1}
+    pageviews: List[Dict[str, Any]] = []
+    for lo, hi in raw_ranges:
+        q = {"siteId": siteId, "type": "pageview", "ts": {"$gte": lo, "$lte": hi}}
+        pageviews += [h async for h in _find_hits(q, fields, lo, hi, limit=200000)]
+    _count_scanned(len(stored) + len(sessions) + len(urls) + len(pageviews))
+    rollups.extend(_rollups_from_hits(pageviews).values())
+    return _overview_from_rollups(rollups, urls, sessions)
+
+
+# -----------------------------
+# Sessions
+# -----------------------------
+# Maintain db.sessions at ingest. Only the rollup engine reads it, so it is on by default only
+# while that engine serves overviews; MATERIALIZE_SESSIONS=1/0 forces it (backfill with
+# `python manage.py rebuild-sessions`).
+SESSIONS_AT_INGEST = os.environ.get("MATERIALIZE_SESSIONS", "1" if OVERVIEW_ENGINE in ROLLUP_ENGINES else "0") == "1"
+
+SESSION_FIELDS = {"_id": 0, "pageviews": 1, "first": 1, "last": 1, "dur": 1}
+
+
+def _session_update(doc: Dict[str, Any], inserted: bool) -> Optional[UpdateOne]:
+    """Update of the (siteId, sessionId) session doc for one written hit.
+
+    Session shape: {siteId, sessionId, visitorId, pageviews, first, last,
+    entry: {t, url, channel, device}, exit: {t, url}, dur: {t, d}}. entry/exit
+    are compared as documents, so $min/$max keep the earliest/latest pageview;
+    dur is the earliest pageview with an explicit duration, as in _calc_kpis.
+    """
+    sid = doc.get("sessionId") or ""
+    if doc.get("type") != "pageview" or not sid:
+        return None
+    ts = int(doc["ts"])
+    dur = doc.get("durationMs")
+
+    update: Dict[str, Dict[str, Any]] = {}
+    if inserted:
+        url = (doc.get("url") or "").strip()
+        update["$inc"] = {"pageviews": 1}
+        update["$min"] = {
+            "first": ts,
+            "entry": {"t": ts, "url": url, "channel": doc.get("channel"), "device": doc.get("deviceType")},
+        }
+        update["$max"] = {"last": ts, "exit": {"t": ts, "url": url}}
+        update["$setOnInsert"] = {"visitorId": doc.get("visitorId", "")}
+    if isinstance(dur, int) and dur > 0:
+        update.setdefault("$min", {})["dur"] = {"t": ts, "d": dur}
+    if not update:
+        return None
+    return UpdateOne({"siteId": doc["siteId"], "sessionId": sid}, update, upsert=inserted)
+
+
+def _sessions_from_hits(
+    pageviews: List[Dict[str, Any]], out: Optional[Dict[str, Dict[str, Any]]] = None
+) -> Dict[str, Dict[str, Any]]:
+    """Build session docs (sessionId -> doc) from raw pageviews, same shape as _session_update.
+
+    Pass `out` to keep accumulating into sessions built from earlier pageviews.
+    """
+    out = {} if out is None else out
+    for h in pageviews:
+        sid = h.get("sessionId") or ""
+        if not sid:
+            continue
+        ts = int(h.get("ts", 0))
+        url = (h.get("url") or "").strip()
+        entry = {"t": ts, "url": url, "channel": h.get("channel"), "device": h.get("deviceType")}
+        s = out.get(sid)
+        if s is None:
+            s = out[sid] = {
+                "siteId": h.get("siteId"),
+                "sessionId": sid,
+                "visitorId": h.get("visitorId", ""),
+                "pageviews": 0,
+                "first": ts,
+                "last": ts,
+                "entry": entry,
+                "exit": {"t": ts, "url": url},
+            }
+        s["pageviews"] += 1
+        s["first"] = min(s["first"], ts)
+        s["last"] = max(s["last"], ts)
+        # Same order as $min/$max on the {t, url, ...} documents
+        if (ts, url) < (s["entry"]["t"], s["entry"]["url"]):
+            s["entry"] = entry
+        if (ts, url) > (s["exit"]["t"], s["exit"]["url"]):
+            s["exit"] = {"t": ts, "url": url}
+        dur = h.get("durationMs")
+        if isinstance(dur, int) and dur > 0 and ("dur" not in s or (ts, dur) < (s["dur"]["t"], s["dur"]["d"])):
+            s["dur"] = {"t": ts, "d": dur}
+    return out
+
+
+def _session_kpis(sessions: List[Dict[str, Any]], visits: int) -> Dict[str, Any]:
+    """bounceRate / avgSessionMs / pagesPerSession over session docs, with _calc_kpis' rules
+    (pagesPerSession divides all `visits`, including pageviews without a session)."""
+    n = len(sessions)
+    bounced = sum(1 for s in sessions if s.get("pageviews") == 1)
+    total_dur = 0
+    for s in sessions:
+        if s.get("dur"):
+            total_dur += int(s["dur"]["d"])
+        else:
+            total_dur += max(0, int(s.get("last", 0)) - int(s.get("first", 0)))
+    return {
+        "bounceRate": (bounced / n) * 100 if n else 0,
+        "avgSessionMs": total_dur / n if n else 0,
+        "pagesPerSession": visits / max(1, n),
+    }
+
+
+async def rebuild_sessions(site_id: Optional[str] = None) -> int:
+    """Recompute db.sessions from the hits (all sites, or one). Returns sessions written.
+
+    Holds one site's sessions in memory while it streams that site's pageviews.
+    """
+    if site_id:
+        site_ids = [site_id]
+    else:
+        site_ids = [s["id"] for s in await db.sites.find({}, {"_id": 0, "id": 1}).to_list(length=None)]
+
+    fields = {
+        "_id": 0,
+        "siteId": 1,
+        "ts": 1,
+        "url": 1,
+        "visitorId": 1,
+        "sessionId": 1,
+        "durationMs": 1,
+    }
+    fields.update({k: 1 for d in ("channel", "deviceType") for k in _stored_keys(d)})
+    written = 0
+    for sid in site_ids:
+        await db.sessions.delete_many({"siteId": sid})
+        sessions: Dict[str, Dict[str, Any]] = {}
+        chunk: List[Dict[str, Any]] = []
+        async for h in _find_hits({"siteId": sid, "type": "pageview"}, fields):
+            chunk.append(h)
+            if len(chunk) >= 5000:
+                _sessions_from_hits(await _decode_hits(sid, chunk, {"channel", "deviceType"}), sessions)
+                chunk = []
+        _sessions_from_hits(await _decode_hits(sid, chunk, {"channel", "deviceType"}), sessions)
+        docs = list(sessions.values())
+        for i in range(0, len(docs), 1000):
+            await db.sessions.insert_many(docs[i : i + 1000], ordered=False)
+        written += len(docs)
+    return written
+
+
+# -----------------------------
+# Heavy hitters
+# -----------------------------
+# Dimensions with a per-(site, day) Misra-Gries summary in db.heavy_hitters, maintained at ingest
+# for /api/breakdown?approx=true (and approx top pages with "url"). Off unless listed, e.g.
+# HEAVY_HITTER_DIMS=url,referrer; `python manage.py rebuild-rollups` rebuilds them with the rollups.
+HEAVY_HITTER_DIMS = [d for d in os.environ.get("HEAVY_HITTER_DIMS", "").split(",") if d]
+
+# Host part of an absolute URL, like `new URL(ref).hostname` in the dashboard.
+_REFERRER_HOST_RE = r"^[A-Za-z][A-Za-z0-9+.-]*://(?:[^@/?#]*@)?(\[[^\]]*\]|[^:/?#]*)"
+_REFERRER_HOST = re.compile(_REFERRER_HOST_RE)
+
+
+def _dimension_value(doc: Dict[str, Any], dimension: str) -> str:
+    """Python twin of _breakdown_key: the value a hit contributes to a breakdown."""
+    if dimension == "referrer":
+        m = _REFERRER_HOST.match(doc.get("referrer") or "")
+        return m.group(1).lower() if m else ""
+    value = doc.get(dimension)
+    return value.strip() if isinstance(value, str) else ""
+
+
+def _heavy_hitters_from_hits(pageviews: List[Dict[str, Any]]) -> Dict[Tuple[str, str], Dict[str, HeavyHitters]]:
+    """(siteId, day) -> {dimension: summary} for a list of pageviews."""
+    out: Dict[Tuple[str, str], Dict[str, HeavyHitters]] = {}
+    for h in pageviews:
+        key = (h.get("siteId"), _day_key(int(h.get("ts", 0))))
+        dims = out.get(key)
+        if dims is None:
+            dims = out[key] = {d: HeavyHitters() for d in HEAVY_HITTER_DIMS}
+        for d, hh in dims.items():
+            hh.add(_dimension_value(h, d))
+    return out
+
+
+class HeavyHitterWriter:
+    """Ingest-side heavy-hitter summaries, flushed to this process's shard of db.heavy_hitters.
+
+    Ingest only folds new pageviews into in-memory (siteId, day) summaries. Every
+    `flush_interval` seconds a background task merges them into the
+    {siteId, day, w: writer, dims} doc of this process; nothing else writes a doc
+    with this `w`, so the read-merge-replace needs no compare-and-swap. Readers
+    merge all shards of a day plus what this process has not flushed yet. A
+    failed flush keeps its summaries for the next one and counts in
+    sa_heavy_hitter_flush_errors_total; only a killed process loses them.
+    """
+
+    def __init__(self, flush_interval_sec: float):
+        self.flush_interval = flush_interval_sec
+        self.writer = uuid.uuid4().hex
+        self._pending: Dict[Tuple[str, str], Dict[str, HeavyHitters]] = {}
+        self._flushing: Dict[Tuple[str, str], Dict[str, HeavyHitters]] = {}
+        self._closing = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, pageviews: List[Dict[str, Any]]) -> None:
+        for key, dims in _heavy_hitters_from_hits(pageviews).items():
+            self._fold(key, dims)
+
+    def _fold(self, key: Tuple[str, str], dims: Dict[str, HeavyHitters]) -> None:
+        cur = self._pending.get(key)
+        if cur is None:
+            self._pending[key] = dims
+            return
+        for d, hh in dims.items():
+            cur.setdefault(d, HeavyHitters()).merge(hh)
+
+    def unflushed(self, site_id: str, days: Dict[str, str], dimension: str) -> List[HeavyHitters]:
+        """This process's summaries of `dimension` for the days in a _split_window filter not yet stored."""
+        return [
+            dims[dimension]
+            for part in (self._pending, self._flushing)
+            for (sid, day), dims in part.items()
+            if sid == site_id and days["$gte"] <= day < days["$lt"] and dimension in dims
+        ]
+
+    def forget(self, site_id: str) -> None:
+        """Drop a deleted site's summaries, including those a running flush has taken."""
+        for part in (self._pending, self._flushing):
+            for key in [k for k in part if k[0] == site_id]:
+                del part[key]
+
+    def __len__(self) -> int:
+        return len(self._pending) + len(self._flushing)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stop the flush loop after a last flush."""
+        self._closing.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        else:
+            await self.flush()
+
+    async def _run(self) -> None:
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self) -> None:
+        # forget() removes a deleted site's keys from _flushing: each step re-checks, and a
+        # write that raced with it is undone, so the delete job never misses a late doc
+        self._flushing, self._pending = self._pending, {}
+        for key, dims in list(self._flushing.items()):
+            flt = {"siteId": key[0], "day": key[1], "w": self.writer}
+            try:
+                cur = await db.heavy_hitters.find_one(flt, {"_id": 0, "dims": 1})
+                if key not in self._flushing:
+                    continue
+                stored = (cur or {}).get("dims") or {}
+                merged = dict(stored)
+                for d, hh in dims.items():
+                    merged[d] = HeavyHitters.from_doc(stored.get(d)).merge(hh).to_doc()
+                await db.heavy_hitters.replace_one(flt, dict(flt, dims=merged), upsert=True)
+                if key not in self._flushing:
+                    await db.heavy_hitters.delete_one(flt)
+            except PyMongoError as e:
+                heavy_hitter_flush_errors.inc()
+                logger.error("heavy_hitters_flush_failed: %s %s: %s", key[0], key[1], e)
+                if key in self._flushing:
+                    self._fold(key, dims)
+            self._flushing.pop(key, None)
+
+
+async def _heavy_hitters(siteId: str, startTs: int, endTs: int, dimension: str) -> HeavyHitters:
+    """Summary of `dimension` over a window: stored daily summaries for whole days,
+    exact counts from raw hits for the partial edge days."""
+    days, raw_ranges = _split_window(startTs, endTs)
+    hh = HeavyHitters()
+    if days:
+        # one doc per writer and day
+        async for doc in db.heavy_hitters.find({"siteId": siteId, "day": days}, {"_id": 0, f"dims.{dimension}": 1}):
+            hh.merge(HeavyHitters.from_doc((doc.get("dims") or {}).get(dimension)))
+            _count_scanned(1)
+        if heavy_hitter_writer is not None:
+            for local in heavy_hitter_writer.unflushed(siteId, days, dimension):
+                hh.merge(local)
+    projection = {"_id": 0, **{k: 1 for k in _stored_keys(dimension)}}
+    for lo, hi in raw_ranges:
+        q = {"siteId": siteId, "type": "pageview", "ts": {"$gte": lo, "$lte": hi}}
+        rows = [h async for h in _find_hits(q, projection, lo, hi)]
+        _count_scanned(len(rows))
+        for h in await _decode_hits(siteId, rows, {dimension}):
+            hh.add(_dimension_value(h, dimension))
+    return hh
+
+
+# Shard docs lag ingest by up to HEAVY_HITTERS_FLUSH_SEC (plus what other processes hold).
+heavy_hitter_writer: Optional[HeavyHitterWriter] = None
+if HEAVY_HITTER_DIMS:
+    heavy_hitter_writer = HeavyHitterWriter(float(os.environ.get("HEAVY_HITTERS_FLUSH_SEC", "5")))
+
+
+def _heavy_hitters_info(hh: HeavyHitters) -> Dict[str, Any]:
+    # true count of each returned key is in [value, value + maxUndercount]
+    return {"method": "misra-gries", "capacity": hh.k, "maxUndercount": hh.err, "pageviews": hh.n}
+
+
+# -----------------------------
+# Aggregation pipeline engine
+# -----------------------------
+def _overview_facets(top_limit: int = 8, with_urls: bool = True) -> Dict[str, List[Dict[str, Any]]]:
+    """$facet branches computing what _group_by_day, _calc_kpis and _top_by compute in Python."""
+    is_int = {"$in": [{"$type": "$durationMs"}, ["int", "long"]]}
+    facets: Dict[str, List[Dict[str, Any]]] = {
+        "series": [
+            {
+                "$group": {
+                    "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": {"$toDate": "$ts"}}},
+                    "pageviews": {"$sum": 1},
+                    "visitors": {"$addToSet": {"$ifNull": ["$visitorId", ""]}},
+                    "sessions": {"$addToSet": {"$ifNull": ["$sessionId", ""]}},
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "day": "$_id",
+                    "pageviews": 1,
+                    "visitors": {"$size": "$visitors"},
+                    "sessions": {"$size": "$sessions"},
+                }
+            },
+            {"$sort": {"day": 1}},
+        ],
+        "visits": [{"$count": "n"}],
+        "visitors": [
+            {"$match": {"visitorId": {"$nin": [None, ""]}}},
+            {"$group": {"_id": "$visitorId"}},
+            {"$count": "n"},
+        ],
+        "sessions": [
+            {"$match": {"sessionId": {"$nin": [None, ""]}}},
+            {
+                "$group": {
+                    "_id": "$sessionId",
+                    "n": {"$sum": 1},
+                    "f": {"$min": "$ts"},
+                    "l": {"$max": "$ts"},
+                    # earliest pageview with an explicit duration; $min skips nulls
+                    "x": {
+                        "$min": {
+                            "$cond": [
+                                {"$and": [is_int, {"$gt": ["$durationMs", 0]}]},
+                                {"t": "$ts", "d": "$durationMs"},
+                                None,
+                            ]
+                        }
+                    },
+                }
+            },
+            {
+                "$group": {
+                    "_id": None,
+                    "count": {"$sum": 1},
+                    "bounced": {"$sum": {"$cond": [{"$eq": ["$n", 1]}, 1, 0]}},
+                    "totalDur": {
+                        "$sum": {
+                            "$cond": [
+                                {"$ne": [{"$ifNull": ["$x", None]}, None]},
+                                "$x.d",
+                                {"$max": [0, {"$subtract": ["$l", "$f"]}]},
+                            ]
+                        }
+                    },
+                }
+            },
+        ],
+    }
+    if with_urls:
+        facets["topPages"] = [
+            {"$project": {"key": {"$trim": {"input": {"$ifNull": ["$url", ""]}}}}},
+            {"$match": {"key": {"$ne": ""}}},
+            {"$group": {"_id": "$key", "value": {"$sum": 1}}},
+            {"$sort": {"value": -1, "_id": 1}},
+            {"$limit": top_limit},
+        ]
+    return facets
+
+
+def _overview_pipeline(siteId: str, startTs: int, endTs: int, top_limit: int = 8) -> List[Dict[str, Any]]:
+    """$facet pipeline computing one window's overview (see _overview_facets)."""
+    return [
+        {"$match": {"siteId": siteId, "type": "pageview", "ts": {"$gte": startTs, "$lte": endTs}}},
+        {"$facet": _overview_facets(top_limit)},
+    ]
+
+
+def _overview_periods_pipeline(
+    siteId: str, periods: List[Tuple[int, int]], with_urls: bool = True
+) -> List[Dict[str, Any]]:
+    """One pass over several windows: $match their union, then every window's branches as
+    "<facet>_<i>", each behind a $match on that window's range ($facet can't nest)."""
+    facets = {}
+    for i, (s, e) in enumerate(periods):
+        for name, stages in _overview_facets(with_urls=with_urls).items():
+            facets[f"{name}_{i}"] = [{"$match": {"ts": {"$gte": s, "$lte": e}}}, *stages]
+    windows = [{"ts": {"$gte": s, "$lte": e}} for s, e in periods]
+    return [{"$match": {"siteId": siteId, "type": "pageview", "$or": windows}}, {"$facet": facets}]
+
+
+def _overview_from_facets(
+    facets: Dict[str, Any],
+) -> Tuple[List[OverviewSeriesPoint], Dict[str, Any], List[OverviewTopItem]]:
+    def _n(name: str) -> int:
+        items = facets.get(name) or []
+        return int(items[0]["n"]) if items else 0
+
+    visits = _n("visits")
+    _count_scanned(visits)  # the pipeline's $match passes on exactly the window's pageviews
+    sess = (facets.get("sessions") or [{}])[0]
+    session_count = int(sess.get("count") or 0)
+    kpis = {
+        "visits": visits,
+        "visitors": _n("visitors"),
+        "pageviews": visits,
+        "bounceRate": (int(sess.get("bounced") or 0) / session_count) * 100 if session_count else 0,
+        "avgSessionMs": int(sess.get("totalDur") or 0) / session_count if session_count else 0,
+        "pagesPerSession": visits / max(1, session_count),
+    }
+    series = [OverviewSeriesPoint(**p) for p in facets.get("series") or []]
+    top_pages = [OverviewTopItem(key=t["_id"], value=t["value"]) for t in facets.get("topPages") or []]
+    return series, kpis, top_pages
+
+
+async def _overview_aggregate(
+    siteId: str, startTs: int, endTs: int
+) -> Tuple[List[OverviewSeriesPoint], Dict[str, Any], List[OverviewTopItem]]:
+    cur = await _aggregate_hits(_overview_pipeline(siteId, startTs, endTs), startTs, endTs)
+    rows = await cur.to_list(length=1)
+    return _overview_from_facets(rows[0] if rows else {})
+
+
+async def _overview_aggregate_periods(
+    siteId: str, periods: List[Tuple[int, int]], with_urls: bool = True
+) -> List[Tuple[List[OverviewSeriesPoint], Dict[str, Any], List[OverviewTopItem]]]:
+    lo, hi = min(s for s, _ in periods), max(e for _, e in periods)
+    cur = await _aggregate_hits(_overview_periods_pipeline(siteId, periods, with_urls), lo, hi)
+    rows = await cur.to_list(length=1)
+    row = rows[0] if rows else {}
+    names = _overview_facets(with_urls=with_urls)
+    return [_overview_from_facets({name: row.get(f"{name}_{i}") for name in names}) for i in range(len(periods))]
+
+
+# -----------------------------
+# Columnar (NumPy) engine
+# -----------------------------
+NP_FIELDS = {"_id": 0, "ts": 1, "url": 1, "visitorId": 1, "sessionId": 1, "durationMs": 1}
+
+
+def _factorize(values: List[Any]) -> Tuple[np.ndarray, List[Any]]:
+    """Codes in first-seen order (hash based, unlike np.unique's sort of Python strings)."""
+    index: Dict[Any, int] = {}
+    codes = np.fromiter((index.setdefault(v, len(index)) for v in values), dtype=np.int64, count=len(values))
+    return codes, list(index)
+
+
+def _columns(pageviews: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Column arrays for the fields the overview needs."""
+    n = len(pageviews)
+    ts = np.fromiter((int(h.get("ts", 0)) for h in pageviews), dtype=np.int64, count=n)
+    visitor, visitor_keys = _factorize([h.get("visitorId", "") for h in pageviews])
+    session, session_keys = _factorize([h.get("sessionId") or "" for h in pageviews])
+    url, url_keys = _factorize([(h.get("url") or "").strip() for h in pageviews])
+    dur = np.fromiter(
+        (d if isinstance(d, int) and d > 0 else 0 for d in (h.get("durationMs") for h in pageviews)),
+        dtype=np.int64,
+        count=n,
+    )
+    return {
+        "n": n,
+        "ts": ts,
+        "visitor": visitor,
+        "visitor_keys": visitor_keys,
+        "session": session,
+        "session_keys": session_keys,
+        "url": url,
+        "url_keys": url_keys,
+        "dur": dur,
+    }
+
+
+def _distinct_per_group(group: np.ndarray, codes: np.ndarray, n_groups: int, n_codes: int) -> np.ndarray:
+    pairs = np.unique(group * max(1, n_codes) + codes)
+    return np.bincount(pairs // max(1, n_codes), minlength=n_groups)
+
+
+def _np_series(cols: Dict[str, Any]) -> List[OverviewSeriesPoint]:
+    if not cols["n"]:
+        return []
+    days, day_code = np.unique(cols["ts"] // DAY_MS, return_inverse=True)
+    pv = np.bincount(day_code, minlength=len(days))
+    visitors = _distinct_per_group(day_code, cols["visitor"], len(days), len(cols["visitor_keys"]))
+    sessions = _distinct_per_group(day_code, cols["session"], len(days), len(cols["session_keys"]))
+    return [
+        OverviewSeriesPoint(
+            day=_day_key(int(d) * DAY_MS), pageviews=int(pv[i]), visitors=int(visitors[i]), sessions=int(sessions[i])
+        )
+        for i, d in enumerate(days)
+    ]
+
+
+def _np_kpis(cols: Dict[str, Any]) -> Dict[str, Any]:
+    visits = cols["n"]
+    vkeys = cols["visitor_keys"]
+    visitors = sum(1 for v in vkeys if v)
+
+    skeys = cols["session_keys"]
+    named = np.array([bool(k) for k in skeys], dtype=bool)
+    keep = named[cols["session"]] if visits else np.zeros(0, dtype=bool)
+    sess, ts, dur = cols["session"][keep], cols["ts"][keep], cols["dur"][keep]
+    session_count = int(named.sum())
+
+    bounced = 0
+    total_dur = 0
+    if len(sess):
+        # Rows grouped by session, each group in ts order (stable, like sorted()).
+        order = np.lexsort((ts, sess))
+        sess, ts, dur = sess[order], ts[order], dur[order]
+        starts = np.flatnonzero(np.r_[True, sess[1:] != sess[:-1]])
+        ends = np.r_[starts[1:], len(sess)]
+        counts = ends - starts
+        bounced = int((counts == 1).sum())
+
+        span = np.maximum(0, ts[ends - 1] - ts[starts])
+        # First pageview (by ts) with an explicit duration overrides the span.
+        with_dur = np.flatnonzero(dur > 0)
+        group_of = np.repeat(np.arange(len(starts)), counts)
+        first_groups, first_idx = np.unique(group_of[with_dur], return_index=True)
+        span[first_groups] = dur[with_dur[first_idx]]
+        total_dur = int(span.sum())
+
+    return {
+        "visits": visits,
+        "visitors": visitors,
+        "pageviews": visits,
+        "bounceRate": (bounced / session_count) * 100 if session_count else 0,
+        "avgSessionMs": total_dur / session_count if session_count else 0,
+        "pagesPerSession": visits / max(1, session_count),
+    }
+
+
+def _np_top(cols: Dict[str, Any], limit: int = 8) -> List[OverviewTopItem]:
+    keys = cols["url_keys"]
+    if not keys:
+        return []
+    counts = np.bincount(cols["url"], minlength=len(keys))
+    # by count, ties by key (as _top_by)
+    order = np.lexsort((np.array(keys), -counts))
+    out: List[OverviewTopItem] = []
+    for i in order:
+        if len(out) >= limit:
+            break
+        if keys[i]:
+            out.append(OverviewTopItem(key=keys[i], value=int(counts[i])))
+    return out
+
+
+# Drop-in replacements for _group_by_day / _calc_kpis / _top_by(..., "url")
+def _group_by_day_np(pageviews: List[Dict[str, Any]]) -> List[OverviewSeriesPoint]:
+    return _np_series(_columns(pageviews))
+
+
+def _calc_kpis_np(pageviews: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return _np_kpis(_columns(pageviews))
+
+
+def _top_pages_np(pageviews: List[Dict[str, Any]], limit: int = 8) -> List[OverviewTopItem]:
+    return _np_top(_columns(pageviews), limit)
+
+
+async def _overview_numpy(
+    siteId: str, startTs: int, endTs: int
+) -> Tuple[List[OverviewSeriesPoint], Dict[str, Any], List[OverviewTopItem]]:
+    q = {"siteId": siteId, "type": "pageview", "ts": {"$gte": startTs, "$lte": endTs}}
+    pageviews = [h async for h in _find_hits(q, NP_FIELDS, startTs, endTs, limit=200000)]
+    _count_scanned(len(pageviews))
+    cols = _columns(pageviews)
+    del pageviews
+    return _np_series(cols), _np_kpis(cols), _np_top(cols)
+
+
+# -----------------------------
+# Breakdowns
+# -----------------------------
+# Covering indexes (siteId, type, ts, <dimension>, visitorId) let a breakdown run from the
+# index alone. Each one is written on every insert and stored next to the hits (url and
+# referrer ones are large), so none are built by default: list the busiest tabs, e.g.
+# BREAKDOWN_INDEXES=channel,deviceType. Indexes dropped from the list are not removed.
+BREAKDOWN_INDEXES = [d for d in os.environ.get("BREAKDOWN_INDEXES", "").split(",") if d]
+
+
+def _breakdown_key(dimension: str) -> Any:
+    value = _hit_field_expr(dimension)
+    if dimension == "referrer":
+        return {
+            "$let": {
+                "vars": {"m": {"$regexFind": {"input": {"$ifNull": [value, ""]}, "regex": _REFERRER_HOST_RE}}},
+                "in": {"$toLower": {"$ifNull": [{"$arrayElemAt": ["$$m.captures", 0]}, ""]}},
+            }
+        }
+    if dimension in HIT_CODED_KEYS:
+        return value  # dictionary code (or a string, before migration); decoded by _breakdown
+    return {"$trim": {"input": {"$ifNull": [value, ""]}}}
+
+
+def _breakdown_pipeline(siteId: str, startTs: int, endTs: int, dimension: str, limit: int) -> List[Dict[str, Any]]:
+    """Top `limit` values of a hit field over the window's pageviews, with unique visitors per value.
+
+    Grouping by (value, visitor) first keeps each group small, instead of
+    collecting a visitor set per value. Dictionary-coded dimensions stop after
+    the per-value groups (there are few values); _breakdown decodes and ranks them.
+    """
+    groups = [
+        {"$match": {"siteId": siteId, "type": "pageview", "ts": {"$gte": startTs, "$lte": endTs}}},
+        {"$group": {"_id": {"k": _breakdown_key(dimension), "v": "$visitorId"}, "n": {"$sum": 1}}},
+        {
+            "$group": {
+                "_id": "$_id.k",
+                "pageviews": {"$sum": "$n"},
+                "visitors": {"$sum": {"$cond": [{"$eq": [{"$ifNull": ["$_id.v", ""]}, ""]}, 0, 1]}},
+            }
+        },
+    ]
+    if dimension in HIT_CODED_KEYS:
+        return groups
+    return groups + [
+        {
+            "$facet": {
+                "items": [
+                    {"$match": {"_id": {"$ne": ""}}},
+                    {"$sort": {"pageviews": -1, "_id": 1}},
+                    {"$limit": limit},
+                ],
+                "totals": [
+                    {
+                        "$group": {
+                            "_id": None,
+                            "pageviews": {"$sum": "$pageviews"},
+                            "values": {"$sum": {"$cond": [{"$eq": ["$_id", ""]}, 0, 1]}},
+                        }
+                    }
+                ],
+            }
+        },
+    ]
+
+
+async def _coded_breakdown_facets(siteId: str, dimension: str, groups: List[Dict[str, Any]], limit: int) -> Dict[str, Any]:
+    """Decode per-value groups of a dictionary-coded dimension into the facet shape."""
+    values = await hit_dict.values(siteId, dimension, {g["_id"] for g in groups if isinstance(g["_id"], int)})
+    merged: Dict[str, Dict[str, int]] = {}
+    for g in groups:
+        raw = values.get(g["_id"]) if isinstance(g["_id"], int) else g["_id"]
+        key = raw.strip() if isinstance(raw, str) else ""
+        m = merged.setdefault(key, {"pageviews": 0, "visitors": 0})
+        m["pageviews"] += g["pageviews"]
+        # values differing only in whitespace are separate groups: their visitor counts may overlap
+        m["visitors"] += g["visitors"]
+    items = sorted(((k, m) for k, m in merged.items() if k), key=lambda km: (-km[1]["pageviews"], km[0]))
+    return {
+        "items": [{"_id": k, **m} for k, m in items[:limit]],
+        "totals": [{"pageviews": sum(m["pageviews"] for m in merged.values()), "values": len(items)}],
+    }
+
+
+async def _breakdown(siteId: str, startTs: int, endTs: int, dimension: str, limit: int) -> BreakdownResponse:
+    cur = await _aggregate_hits(_breakdown_pipeline(siteId, startTs, endTs, dimension, limit), startTs, endTs)
+    if dimension in HIT_CODED_KEYS:
+        facets = await _coded_breakdown_facets(siteId, dimension, await cur.to_list(length=None), limit)
+    else:
+        rows = await cur.to_list(length=1)
+        facets = rows[0] if rows else {}
+    totals = (facets.get("totals") or [{}])[0]
+    return BreakdownResponse(
+        siteId=siteId,
+        startTs=startTs,
+        endTs=endTs,
+        dimension=dimension,
+        pageviews=int(totals.get("pageviews") or 0),
+        values=int(totals.get("values") or 0),
+        items=[
+            BreakdownItem(key=r["_id"], pageviews=r["pageviews"], visitors=r["visitors"]) for r in facets.get("items") or []
+        ],
+    )
+
+
+# -----------------------------
+# Overview cache
+# -----------------------------
+class OverviewCache:
+    """LRU cache of serialized overview responses with stale-while-revalidate.
+
+    Keys bucket startTs/endTs to `bucket_ms`, so dashboards asking for "last 7
+    days until now" a few seconds apart share an entry (and its computed range).
+    Every write to a site bumps that site's generation; an entry is fresh while
+    its generation is current and it is younger than `ttl_sec`. Otherwise, up
+    to `stale_sec` old, it is still served while one background task
+    recomputes it; older entries are recomputed inline. Generations are per
+    process, so in multi-worker setups other workers' writes are only seen
+    through the TTL. Bounded by entry count and total body bytes.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, bucket_ms: int, ttl_sec: float, stale_sec: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bucket_ms = max(1, bucket_ms)
+        self.ttl_sec = ttl_sec
+        self.stale_sec = stale_sec
+        self._entries: "OrderedDict[Tuple[Any, ...], Tuple[bytes, int, float]]" = OrderedDict()  # body, gen, at
+        self._bytes = 0
+        self._gens: Dict[str, int] = {}
+        self._refreshing: Set[Tuple[Any, ...]] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.evictions = 0
+
+    def key(self, site_id: str, start_ts: int, end_ts: int, variant: str) -> Tuple[Any, ...]:
+        return (site_id, start_ts // self.bucket_ms, end_ts // self.bucket_ms, variant)
+
+    def bump(self, site_id: str) -> None:
+        self._gens[site_id] = self._gens.get(site_id, 0) + 1
+
+    def _put(self, key: Tuple[Any, ...], body: bytes, gen: int) -> None:
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old[0])
+        self._entries[key] = (body, gen, time.monotonic())
+        self._bytes += len(body)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (evicted, _, _) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    async def _compute(self, key: Tuple[Any, ...], site_id: str, compute: Callable[[], Awaitable[bytes]]) -> bytes:
+        # Read the generation first: writes landing during compute leave the entry stale.
+        gen = self._gens.get(site_id, 0)
+        body = await compute()
+        self._put(key, body, gen)
+        return body
+
+    async def _refresh(self, key: Tuple[Any, ...], site_id: str, compute: Callable[[], Awaitable[bytes]]) -> None:
+        try:
+            await self._compute(key, site_id, compute)
+            self.refreshes += 1
+        except Exception as e:
+            logger.warning("overview_cache_refresh_failed: %s", e)
+        finally:
+            self._refreshing.discard(key)
+
+    async def fetch(self, key: Tuple[Any, ...], site_id: str, compute: Callable[[], Awaitable[bytes]]) -> bytes:
+        entry = self._entries.get(key)
+        if entry is not None:
+            body, gen, at = entry
+            age = time.monotonic() - at
+            self._entries.move_to_end(key)
+            if gen == self._gens.get(site_id, 0) and age < self.ttl_sec:
+                self.hits += 1
+                return body
+            if age < self.stale_sec:
+                self.stale_hits += 1
+                if key not in self._refreshing:
+                    self._refreshing.add(key)
+                    task = asyncio.create_task(self._refresh(key, site_id, compute))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                return body
+        self.misses += 1
+        return await self._compute(key, site_id, compute)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "staleHits": self.stale_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "evictions": self.evictions,
+        }
+
+
+# Opt-in (OVERVIEW_CACHE=1): cached dashboards may lag ingest by up to OVERVIEW_CACHE_STALE_SEC.
+overview_cache: Optional[OverviewCache] = None
+if os.environ.get("OVERVIEW_CACHE", "0") == "1":
+    overview_cache = OverviewCache(
+        max_entries=int(os.environ.get("OVERVIEW_CACHE_SIZE", "512")),
+        max_bytes=int(os.environ.get("OVERVIEW_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+        bucket_ms=int(os.environ.get("OVERVIEW_CACHE_BUCKET_MS", "60000")),
+        ttl_sec=float(os.environ.get("OVERVIEW_CACHE_TTL_SEC", "30")),
+        stale_sec=float(os.environ.get("OVERVIEW_CACHE_STALE_SEC", "300")),
+    )
+
+
+# -----------------------------
+# Realtime tracker
+# -----------------------------
+# The overview's realtime feed covers the last 30 minutes, active visitors the last 5
+REALTIME_WINDOW_MS = 30 * 60 * 1000
+ACTIVE_WINDOW_MS = 5 * 60 * 1000
+# How far before server time a window's end may be and still count as "now": the dashboard
+# sends its own clock, refreshed every 15s, so its endTs always trails a little
+REALTIME_END_SLACK_MS = 60 * 1000
+
+
+class _RealtimeSite:
+    __slots__ = ("hits", "by_id", "last_seen", "expiry", "seeded", "listeners")
+
+    def __init__(self) -> None:
+        self.hits: List[Tuple[int, int, Dict[str, Any]]] = []  # (ts, seq, hit), ascending
+        self.by_id: Dict[str, Tuple[int, int, Dict[str, Any]]] = {}
+        self.last_seen: Dict[str, int] = {}  # visitorId -> newest pageview ts
+        self.expiry: List[Tuple[int, str]] = []  # heap of (ts, visitorId); stale entries are skipped
+        self.seeded = False
+        self.listeners: Set[asyncio.Event] = set()
+
+
+class RealtimeTracker:
+    """Latest pageviews and active visitors per site, kept in memory from /collect.
+
+    Each site holds its `size` newest pageviews by ts (a short sorted list, so a
+    late hit still lands in place; a resent hit id replaces its entry) and every
+    visitor's newest pageview ts, expired through a heap once older than
+    ACTIVE_WINDOW_MS. Only ingest (and a stream subscribing to a checked site)
+    creates a site's state; it is seeded from storage the first time it is read
+    and merged with ingest from then on. Sites with no active visitor and no open
+    stream are swept out again, so reads of any other site return None and the
+    caller asks storage. Hits accepted by other workers are not seen, so
+    multi-worker setups should leave it off. /api/realtime/stream waits on the
+    per-site listeners.
+    """
+
+    SWEEP_MS = 60 * 1000
+
+    def __init__(self, size: int):
+        self.size = size
+        self._sites: Dict[str, _RealtimeSite] = {}
+        self._swept = 0
+        self.seq = 0  # bumped per added or changed hit; streams ask for what came after theirs
+        self.closed = False
+
+    def _site(self, site_id: str) -> _RealtimeSite:
+        st = self._sites.get(site_id)
+        if st is None:
+            st = self._sites[site_id] = _RealtimeSite()
+        return st
+
+    def _sweep(self, now_ms: int) -> None:
+        """Drop sites nobody is active on or streaming (at most once per SWEEP_MS)."""
+        if now_ms - self._swept < self.SWEEP_MS:
+            return
+        self._swept = now_ms
+        for site_id, st in list(self._sites.items()):
+            self._expire(st, now_ms)
+            if not st.last_seen and not st.listeners:
+                del self._sites[site_id]
+
+    def __len__(self) -> int:
+        return len(self._sites)
+
+    def _expire(self, st: _RealtimeSite, now_ms: int) -> None:
+        cutoff = now_ms - ACTIVE_WINDOW_MS
+        while st.expiry and st.expiry[0][0] < cutoff:
+            ts, vid = heapq.heappop(st.expiry)
+            if st.last_seen.get(vid) == ts:
+                del st.last_seen[vid]
+
+    @staticmethod
+    def _seen(st: _RealtimeSite, visitor_id: Optional[str], ts: int, now_ms: int) -> bool:
+        """Note a visitor's pageview; True if they just became active."""
+        if not visitor_id or ts < now_ms - ACTIVE_WINDOW_MS:
+            return False
+        last = st.last_seen.get(visitor_id)
+        if last is None or ts > last:
+            st.last_seen[visitor_id] = ts
+            heapq.heappush(st.expiry, (ts, visitor_id))
+        return last is None
+
+    def _merge(self, st: _RealtimeSite, doc: Dict[str, Any], now_ms: int) -> bool:
+        """Add a pageview; True if the active count or the newest hits changed."""
+        ts = int(doc["ts"])
+        arrived = self._seen(st, doc.get("visitorId"), ts, now_ms)
+        old = st.by_id.get(doc["id"])
+        if old is not None:
+            if old[2] == doc:
+                return arrived
+            st.hits.remove(old)
+            del st.by_id[doc["id"]]
+        elif len(st.hits) >= self.size and ts < st.hits[0][0]:
+            return arrived
+        self.seq += 1
+        entry = (ts, self.seq, doc)
+        bisect.insort(st.hits, entry)  # seq is unique: docs are never compared
+        st.by_id[doc["id"]] = entry
+        if len(st.hits) > self.size:
+            del st.by_id[st.hits.pop(0)[2]["id"]]
+        return True
+
+    def add(self, docs: List[Dict[str, Any]], now_ms: int) -> None:
+        """Record accepted hits and wake the sites' stream listeners."""
+        changed: Set[str] = set()
+        for doc in docs:
+            if doc.get("type") != "pageview" or doc["ts"] < now_ms - REALTIME_WINDOW_MS:
+                continue
+            st = self._site(doc["siteId"])
+            # copy: the write path may still add keys (e.g. _id) to the stored doc
+            if self._merge(st, dict(doc), now_ms):
+                changed.add(doc["siteId"])
+            self._expire(st, now_ms)
+        for site_id in changed:
+            for ev in self._sites[site_id].listeners:
+                ev.set()
+        self._sweep(now_ms)
+
+    async def _seed(self, site_id: str, st: _RealtimeSite, now_ms: int) -> None:
+        end = now_ms + DAY_MS  # clock-skewed hits ahead of now are in the feed too
+        for doc in await storage.realtime(site_id, now_ms - REALTIME_WINDOW_MS, end, self.size):
+            self._merge(st, doc, now_ms)
+        async for doc in storage.iter_hits(site_id, now_ms - ACTIVE_WINDOW_MS, end, fields={"type", "visitorId"}):
+            if doc.get("type") == "pageview":
+                self._seen(st, doc.get("visitorId"), doc["ts"], now_ms)
+        st.seeded = True
+
+    async def read(
+        self, site_id: str, startTs: int, endTs: int, limit: int, now_ms: int
+    ) -> Optional[Tuple[List[Dict[str, Any]], int]]:
+        """The overview's realtime hits (newest first) and active visitors, or None for
+        windows the tracker doesn't follow: they must reach now (within
+        REALTIME_END_SLACK_MS) and cover the whole active window. Active visitors are
+        counted up to now. The `size` newest hits hold the newest `limit` of any later start."""
+        if endTs < now_ms - REALTIME_END_SLACK_MS or startTs > now_ms - ACTIVE_WINDOW_MS or limit > self.size:
+            return None
+        self._sweep(now_ms)
+        st = self._sites.get(site_id)
+        if st is None:
+            return None
+        if not st.seeded:
+            await self._seed(site_id, st, now_ms)
+        self._expire(st, now_ms)
+        lo = max(startTs, now_ms - REALTIME_WINDOW_MS)
+        hits = [doc for ts, _, doc in reversed(st.hits) if lo <= ts <= endTs]
+        return hits[:limit], len(st.last_seen)
+
+    def since(self, site_id: str, seq: int) -> Tuple[List[Dict[str, Any]], int]:
+        """Hits added or changed after `seq` (newest first), and the current seq."""
+        st = self._sites.get(site_id)
+        return [doc for _, s, doc in reversed(st.hits) if s > seq] if st else [], self.seq
+
+    def active(self, site_id: str, now_ms: int) -> int:
+        st = self._sites.get(site_id)
+        if st is None:
+            return 0
+        self._expire(st, now_ms)
+        return len(st.last_seen)
+
+    def subscribe(self, site_id: str) -> asyncio.Event:
+        """Listen for a site's hits; callers check the site exists first."""
+        ev = asyncio.Event()
+        self._site(site_id).listeners.add(ev)
+        return ev
+
+    def unsubscribe(self, site_id: str, ev: asyncio.Event) -> None:
+        st = self._sites.get(site_id)
+        if st is not None:
+            st.listeners.discard(ev)
+
+    def is_open(self, site_id: str, ev: asyncio.Event) -> bool:
+        st = self._sites.get(site_id)
+        return not self.closed and st is not None and ev in st.listeners
+
+    def forget(self, site_id: str) -> None:
+        """Drop a deleted site; its open streams end."""
+        st = self._sites.pop(site_id, None)
+        for ev in st.listeners if st else ():
+            ev.set()
+
+    def close(self) -> None:
+        """End open streams (they wait on their events) so shutdown doesn't hang on them."""
+        self.closed = True
+        for st in self._sites.values():
+            for ev in st.listeners:
+                ev.set()
+
+
+# Opt-in (REALTIME_TRACKER=1): overview realtime/active visitors from memory, and SSE updates
+realtime_tracker: Optional[RealtimeTracker] = None
+if os.environ.get("REALTIME_TRACKER", "0") == "1":
+    realtime_tracker = RealtimeTracker(size=int(os.environ.get("REALTIME_BUFFER", "50")))
+REALTIME_STREAM_INTERVAL_SEC = float(os.environ.get("REALTIME_STREAM_INTERVAL_SEC", "1"))
+REALTIME_KEEPALIVE_SEC = float(os.environ.get("REALTIME_KEEPALIVE_SEC", "15"))
+
+
+# -----------------------------
+# Storage backends
+# -----------------------------
+# Route handlers and background tasks reach sites, hits, aggregates and jobs through `storage`.
+# STORAGE=mongo (default) is MongoDB with everything above (rollups, sessions, sketches,
+# partitions, compact layout). STORAGE=sqlite is one embedded SQLite file (SQLITE_PATH) for
+# single-node installs and tests: no mongod to run, every overview engine answers from the
+# same SQL over covering indexes, and approx answers come from sketches built while scanning.
+SQLITE_PATH = os.environ.get("SQLITE_PATH", str(ROOT_DIR / "analytics.db"))
+
+
+class Storage(ABC):
+    """What the API needs from a storage engine; hits come back in the API shape."""
+
+    name = ""
+
+    async def open(self) -> None:
+        """Create indexes/tables (idempotent)."""
+
+    async def close(self) -> None:
+        pass
+
+    # sites
+    @abstractmethod
+    async def insert_site(self, doc: Dict[str, Any]) -> None:
+        """Store a new site record."""
+
+    @abstractmethod
+    async def list_sites(self, limit: Optional[int] = 1000) -> List[Dict[str, Any]]:
+        """Newest first; limit=None for all."""
+
+    @abstractmethod
+    async def update_site(self, site_id: str, changes: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Apply `changes` and return the site as stored, or None if there is no such site."""
+
+    @abstractmethod
+    async def delete_site(self, site_id: str) -> bool:
+        """Remove the site record; False if there was no such site."""
+
+    @abstractmethod
+    async def active_site_ids(self, site_ids: List[str]) -> Set[str]:
+        """Those of `site_ids` that exist and are active."""
+
+    @abstractmethod
+    async def insert_status_check(self, doc: Dict[str, Any]) -> None:
+        """Store a status check."""
+
+    @abstractmethod
+    async def list_status_checks(self, limit: int) -> List[Dict[str, Any]]:
+        """Up to `limit` status checks."""
+
+    # hits
+    @abstractmethod
+    async def write_hits(self, docs: List[Dict[str, Any]]) -> Set[str]:
+        """Upsert hit docs by id; returns the ids that failed."""
+
+    @abstractmethod
+    def iter_hits(
+        self,
+        site_id: str,
+        startTs: int,
+        endTs: int,
+        fields: Optional[Set[str]] = None,
+        after: Optional[Tuple[int, str]] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Hits of a window in (ts, id) order, after the (ts, id) keyset cursor `after`."""
+
+    @abstractmethod
+    async def delete_site_batch(self, site_id: str, batch_size: int) -> Optional[Tuple[str, int]]:
+        """Delete up to batch_size docs of a deleted site: (collection, deleted), None once nothing is left."""
+
+    @abstractmethod
+    async def apply_retention(self, retention: Dict[str, Optional[int]], now_ms: int) -> Dict[str, int]:
+        """Delete hits past each site's retention (None: keep); {droppedPartitions, deletedHits}."""
+
+    # aggregates
+    def sketched(self, engine: str, approx: bool) -> bool:
+        """Whether overview() estimates uniques with HLL sketches for this engine/approx."""
+        return approx
+
+    @abstractmethod
+    async def overview(
+        self, site_id: str, startTs: int, endTs: int, engine: str, approx: bool = False, with_urls: bool = True
+    ) -> Tuple[List[OverviewSeriesPoint], Dict[str, Any], List[OverviewTopItem]]:
+        """Series, KPIs and top pages; approx=True counts uniques with HLL (see _overview_rollup)."""
+
+    async def overview_periods(
+        self,
+        site_id: str,
+        periods: List[Tuple[int, int]],
+        engine: str,
+        approx: bool = False,
+        with_urls: bool = True,
+    ) -> List[Tuple[List[OverviewSeriesPoint], Dict[str, Any], List[OverviewTopItem]]]:
+        """overview() of each (startTs, endTs) window; backends override it to read the windows together."""
+        return list(
+            await asyncio.gather(*(self.overview(site_id, s, e, engine, approx, with_urls) for s, e in periods))
+        )
+
+    @abstractmethod
+    async def realtime(self, site_id: str, startTs: int, endTs: int, limit: int) -> List[Dict[str, Any]]:
+        """Latest pageviews of a window, newest first."""
+
+    @abstractmethod
+    async def active_visitors(self, site_id: str, startTs: int, endTs: int) -> int:
+        """Distinct visitors with a pageview in the window."""
+
+    @abstractmethod
+    async def breakdown(self, site_id: str, startTs: int, endTs: int, dimension: str, limit: int) -> BreakdownResponse:
+        """Top `limit` values of a hit dimension over a window."""
+
+    @abstractmethod
+    async def heavy_hitters(self, site_id: str, startTs: int, endTs: int, dimension: str) -> HeavyHitters:
+        """Misra-Gries summary of a dimension over a window (see _heavy_hitters)."""
+
+    # jobs
+    @abstractmethod
+    async def insert_job(self, doc: Dict[str, Any]) -> None:
+        """Store a new job."""
+
+    @abstractmethod
+    async def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """The job, or None if there is no such job."""
+
+    @abstractmethod
+    async def claim_job(self, job_id: str, owner: str, now_ms: int, lease_until: int) -> Optional[Dict[str, Any]]:
+        """Take a queued/running job whose lease lapsed; the job after the update, or None."""
+
+    @abstractmethod
+    async def update_job(
+        self, job_id: str, owner: Optional[str], changes: Dict[str, Any], progress: Optional[Dict[str, int]] = None
+    ) -> bool:
+        """Set `changes` and add `progress` counts, if `owner` (when given) still holds the job."""
+
+    @abstractmethod
+    async def unfinished_job_ids(self) -> List[str]:
+        """Jobs still queued or running, resumed at startup."""
+
+
+class MongoStorage(Storage):
+    name = "mongo"
+
+    async def open(self) -> None:
+        await db.sites.create_index("id", unique=True)
+        for name in await hit_partitions.for_range():
+            await _ensure_hit_indexes(db[name])
+        await db.daily_rollups.create_index([("siteId", 1), ("day", 1)], unique=True)
+        await db.daily_urls.create_index([("siteId", 1), ("day", 1), ("k", 1)], unique=True)
+        await db.sessions.create_index([("siteId", 1), ("sessionId", 1)], unique=True)
+        await db.sessions.create_index([("siteId", 1), ("first", 1)])
+        await db.sessions.create_index([("siteId", 1), ("last", 1)])
+        # one doc per (site, day, writer); the old one-per-day unique index would reject the shards
+        try:
+            await db.heavy_hitters.drop_index("siteId_1_day_1")
+        except OperationFailure:
+            pass
+        await db.heavy_hitters.create_index([("siteId", 1), ("day", 1), ("w", 1)], unique=True)
+        await db.hit_dicts.create_index([("siteId", 1), ("field", 1), ("value", 1)], unique=True)
+        await db.hit_dicts.create_index([("siteId", 1), ("field", 1), ("code", 1)])
+        await db.jobs.create_index("id", unique=True)
+        await db.jobs.create_index("status")
+
+    async def close(self) -> None:
+        client.close()
+
+    async def insert_site(self, doc: Dict[str, Any]) -> None:
+        await db.sites.insert_one(dict(doc))
+
+    async def list_sites(self, limit: Optional[int] = 1000) -> List[Dict[str, Any]]:
+        return await db.sites.find({}, {"_id": 0}).sort("createdAt", -1).to_list(limit)
+
+    async def update_site(self, site_id: str, changes: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if not changes:
+            return await db.sites.find_one({"id": site_id}, {"_id": 0})
+        return await db.sites.find_one_and_update(
+            {"id": site_id}, {"$set": changes}, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+        )
+
+    async def delete_site(self, site_id: str) -> bool:
+        res = await db.sites.delete_one({"id": site_id})
+        return res.deleted_count > 0
+
+    async def active_site_ids(self, site_ids: List[str]) -> Set[str]:
+        rows = await db.sites.find({"id": {"$in": site_ids}, "isActive": True}, {"_id": 0, "id": 1}).to_list(
+            length=len(site_ids)
+        )
+        return {r["id"] for r in rows}
+
+    async def insert_status_check(self, doc: Dict[str, Any]) -> None:
+        await db.status_checks.insert_one(dict(doc))
+
+    async def list_status_checks(self, limit: int) -> List[Dict[str, Any]]:
+        return await db.status_checks.find({}, {"_id": 0}).to_list(limit)
+
+    async def write_hits(self, docs: List[Dict[str, Any]]) -> Set[str]:
+        return await _persist_hits(docs)
+
+    async def iter_hits(
+        self,
+        site_id: str,
+        startTs: int,
+        endTs: int,
+        fields: Optional[Set[str]] = None,
+        after: Optional[Tuple[int, str]] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        projection: Dict[str, int] = {"_id": 0}
+        if fields:
+            projection.update({k: 1 for f in fields | {"id", "ts"} for k in _stored_keys(f)})
+        query: Dict[str, Any] = {"siteId": site_id, "ts": {"$gte": startTs, "$lte": endTs}}
+        if after:
+            query["$or"] = [{"ts": {"$gt": after[0]}}, {"ts": after[0], "id": {"$gt": after[1]}}]
+        cur = _find_hits(query, projection, startTs, endTs, sort=[("ts", 1), ("id", 1)], limit=limit, batch_size=1000)
+        raw: List[Dict[str, Any]] = []
+        async for doc in cur:
+            raw.append(doc)
+            if len(raw) == 1000:
+                for row in await _decode_hits(site_id, raw, fields):
+                    yield row
+                raw = []
+        for row in await _decode_hits(site_id, raw, fields):
+            yield row
+
+    async def delete_site_batch(self, site_id: str, batch_size: int) -> Optional[Tuple[str, int]]:
+        for name in [*await hit_partitions.for_range(), "daily_rollups", "daily_urls", "sessions", "heavy_hitters", "hit_dicts"]:
+            # select a batch on the siteId index, delete it by _id
+            ids = [d["_id"] async for d in db[name].find({"siteId": site_id}, {"_id": 1}).limit(batch_size)]
+            if ids:
+                res = await db[name].delete_many({"_id": {"$in": ids}})
+                return name, res.deleted_count
+        return None
+
+    async def apply_retention(self, retention: Dict[str, Optional[int]], now_ms: int) -> Dict[str, int]:
+        return await _apply_retention_mongo(retention, now_ms)
+
+    def sketched(self, engine: str, approx: bool) -> bool:
+        # the sketches live in the rollups: with those stores off, approx gets the exact engines
+        return (approx or engine in ROLLUP_ENGINES) and DAILY_ROLLUPS and SESSIONS_AT_INGEST
+
+    async def overview(
+        self, site_id: str, startTs: int, endTs: int, engine: str, approx: bool = False, with_urls: bool = True
+    ) -> Tuple[List[OverviewSeriesPoint], Dict[str, Any], List[OverviewTopItem]]:
+        if self.sketched(engine, approx):
+            res = await _overview_rollup(site_id, startTs, endTs, with_urls=with_urls)
+            if res is not None:
+                return res
+        if engine == "aggregate":
+            return await _overview_aggregate(site_id, startTs, endTs)
+        if engine == "numpy":
+            return await _overview_numpy(site_id, startTs, endTs)
+        # raw, and rollup/sessions while their stores are off or a day is stale
+        q = {"siteId": site_id, "type": "pageview", "ts": {"$gte": startTs, "$lte": endTs}}
+        pageviews = [h async for h in _find_hits(q, {"_id": 0}, startTs, endTs, limit=200000)]
+        _count_scanned(len(pageviews))
+        return _group_by_day(pageviews), _calc_kpis(pageviews), _top_by(pageviews, "url", limit=8)
+
+    async def overview_periods(
+        self,
+        site_id: str,
+        periods: List[Tuple[int, int]],
+        engine: str,
+        approx: bool = False,
+        with_urls: bool = True,
+    ) -> List[Tuple[List[OverviewSeriesPoint], Dict[str, Any], List[OverviewTopItem]]]:
+        # Each engine that scans pageviews reads every window in one pass: raw/numpy fetch them
+        # with one query and split them here, aggregate runs one $facet with branches per window.
+        # Rollup/sessions read small daily docs: those run once per window.
+        if not self.sketched(engine, approx):
+            approx = False
+            if engine in ROLLUP_ENGINES:
+                engine = "raw"
+        if approx or engine not in ("raw", "numpy", "aggregate") or len(periods) < 2:
+            return await super().overview_periods(site_id, periods, engine, approx, with_urls)
+        if engine == "aggregate":
+            return await _overview_aggregate_periods(site_id, periods, with_urls)
+        q = {"siteId": site_id, "type": "pageview", "$or": [{"ts": {"$gte": s, "$lte": e}} for s, e in periods]}
+        lo, hi = min(s for s, _ in periods), max(e for _, e in periods)
+        projection = NP_FIELDS if engine == "numpy" else {"_id": 0}
+        # a single window's 200000 cap applies to each window, so a busy one can't crowd the
+        # other out; reading stops once every window is full
+        cap = 200000
+        parts: List[List[Dict[str, Any]]] = [[] for _ in periods]
+        async for h in _find_hits(q, projection, lo, hi):
+            for (s, e), part in zip(periods, parts):
+                if s <= h["ts"] <= e and len(part) < cap:
+                    part.append(h)
+            if all(len(part) >= cap for part in parts):
+                break
+        _count_scanned(sum(len(part) for part in parts))
+        out = []
+        for part in parts:
+            if engine == "numpy":
+                cols = _columns(part)
+                out.append((_np_series(cols), _np_kpis(cols), _np_top(cols) if with_urls else []))
+            else:
+                top = _top_by(part, "url", limit=8) if with_urls else []
+                out.append((_group_by_day(part), _calc_kpis(part), top))
+        return out
+
+    async def realtime(self, site_id: str, startTs: int, endTs: int, limit: int) -> List[Dict[str, Any]]:
+        q = {"siteId": site_id, "type": "pageview", "ts": {"$gte": startTs, "$lte": endTs}}
+        rows = [h async for h in _find_hits(q, {"_id": 0}, startTs, endTs, sort=[("ts", -1)], limit=limit)]
+        _count_scanned(len(rows))
+        return await _decode_hits(site_id, rows)
+
+    async def active_visitors(self, site_id: str, startTs: int, endTs: int) -> int:
+        active_ids: Set[str] = set()
+        q = {"siteId": site_id, "type": "pageview", "ts": {"$gte": startTs, "$lte": endTs}}
+        for name in await hit_partitions.for_range(startTs, endTs):
+            active_ids.update(await db[name].distinct("visitorId", q))
+        return len(active_ids)
+
+    async def breakdown(self, site_id: str, startTs: int, endTs: int, dimension: str, limit: int) -> BreakdownResponse:
+        return await _breakdown(site_id, startTs, endTs, dimension, limit)
+
+    async def heavy_hitters(self, site_id: str, startTs: int, endTs: int, dimension: str) -> HeavyHitters:
+        return await _heavy_hitters(site_id, startTs, endTs, dimension)
+
+    async def insert_job(self, doc: Dict[str, Any]) -> None:
+        await db.jobs.insert_one(dict(doc))
+
+    async def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await db.jobs.find_one({"id": job_id}, {"_id": 0})
+
+    async def claim_job(self, job_id: str, owner: str, now_ms: int, lease_until: int) -> Optional[Dict[str, Any]]:
+        return await db.jobs.find_one_and_update(
+            {"id": job_id, "status": {"$in": ["queued", "running"]}, "leaseUntil": {"$lt": now_ms}},
+            {"$set": {"status": "running", "owner": owner, "leaseUntil": lease_until, "updatedAt": now_ms}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def update_job(
+        self, job_id: str, owner: Optional[str], changes: Dict[str, Any], progress: Optional[Dict[str, int]] = None
+    ) -> bool:
+        update: Dict[str, Any] = {"$set": changes}
+        if progress:
+            update["$inc"] = {f"progress.{k}": v for k, v in progress.items()}
+        flt = {"id": job_id, **({"owner": owner} if owner else {})}
+        return (await db.jobs.update_one(flt, update)).matched_count > 0
+
+    async def unfinished_job_ids(self) -> List[str]:
+        return [j["id"] async for j in db.jobs.find({"status": {"$in": ["queued", "running"]}}, {"_id": 0, "id": 1})]
+
+
+def _sqlite_ref_host(referrer: Optional[str]) -> str:
+    return _dimension_value({"referrer": referrer}, "referrer")
+
+
+class SQLiteStorage(Storage):
+    """Everything in one SQLite file: WAL mode (readers never wait for the writer), one
+    connection per thread via asyncio.to_thread, writes serialized and batched into one
+    transaction, and covering indexes for the overview and breakdown scans."""
+
+    name = "sqlite"
+    HIT_COLUMNS = HIT_FIELD_ORDER
+    _INTEGER = {"ts", "durationMs"}
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._write_lock = threading.Lock()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    # -- connections
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit mode: _write opens its own transactions
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.create_function("ref_host", 1, _sqlite_ref_host, deterministic=True)
+            with self._schema_lock:
+                if not self._schema_ready:
+                    self._create_schema(conn)
+                    self._schema_ready = True
+                self._connections.append(conn)
+            self._local.conn = conn
+        return conn
+
+    def _create_schema(self, conn: sqlite3.Connection) -> None:
+        cols = ", ".join(
+            f"{c} INTEGER" if c in self._INTEGER else f"{c} REAL" if c == "scrollMax" else f"{c} TEXT"
+            for c in self.HIT_COLUMNS if c != "id"
+        )
+        indexes = [
+            "CREATE INDEX IF NOT EXISTS hits_site_ts ON hits (siteId, ts, id)",
+            # covers the overview: series, KPIs and top pages never touch the table
+            "CREATE INDEX IF NOT EXISTS hits_overview ON hits (siteId, type, ts, visitorId, sessionId, durationMs, url)",
+        ]
+        for dim in BREAKDOWN_INDEXES:
+            if dim != "visitorId" and dim in self.HIT_COLUMNS:
+                indexes.append(f"CREATE INDEX IF NOT EXISTS hits_bd_{dim} ON hits (siteId, type, ts, {dim}, visitorId)")
+        conn.executescript(
+            f"""
+            CREATE TABLE IF NOT EXISTS sites (
+                id TEXT PRIMARY KEY, name TEXT NOT NULL, domain TEXT NOT NULL, createdAt INTEGER NOT NULL,
+                isActive INTEGER NOT NULL DEFAULT 1, sessionTimeoutMin INTEGER NOT NULL DEFAULT 30, retentionDays INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS hits (id TEXT PRIMARY KEY, {cols});
+            {";".join(indexes)};
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, status TEXT NOT NULL, owner TEXT, leaseUntil INTEGER NOT NULL DEFAULT 0, doc TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+            CREATE TABLE IF NOT EXISTS status_checks (id TEXT PRIMARY KEY, client_name TEXT, timestamp TEXT);
+            """
+        )
+
+    async def _read(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.to_thread(lambda: fn(self._conn(), *args))
+
+    async def _write(self, fn: Callable[..., Any], *args: Any) -> Any:
+        def run():
+            conn = self._conn()
+            # one transaction per call; IMMEDIATE takes the write lock up front, so a
+            # read-then-update (claim_job) can't interleave with another process
+            with self._write_lock:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    out = fn(conn, *args)
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                conn.execute("COMMIT")
+                return out
+
+        return await asyncio.to_thread(run)
+
+    async def open(self) -> None:
+        await self._read(lambda conn: None)
+
+    async def close(self) -> None:
+        with self._schema_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    # -- sites
+    @staticmethod
+    def _site(row: sqlite3.Row) -> Dict[str, Any]:
+        return {**dict(row), "isActive": bool(row["isActive"])}
+
+    async def insert_site(self, doc: Dict[str, Any]) -> None:
+        cols = list(Site.model_fields)
+        sql = f"INSERT INTO sites ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})"
+        await self._write(lambda conn: conn.execute(sql, [doc.get(c) for c in cols]))
+
+    async def list_sites(self, limit: Optional[int] = 1000) -> List[Dict[str, Any]]:
+        sql = "SELECT * FROM sites ORDER BY createdAt DESC LIMIT ?"
+        rows = await self._read(lambda conn: conn.execute(sql, (-1 if limit is None else limit,)).fetchall())
+        return [self._site(r) for r in rows]
+
+    async def update_site(self, site_id: str, changes: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        def run(conn):
+            cols = [c for c in changes if c in Site.model_fields and c != "id"]
+            if cols:
+                conn.execute(f"UPDATE sites SET {', '.join(f'{c} = ?' for c in cols)} WHERE id = ?", [changes[c] for c in cols] + [site_id])
+            return conn.execute("SELECT * FROM sites WHERE id = ?", (site_id,)).fetchone()
+
+        row = await self._write(run)
+        return self._site(row) if row else None
+
+    async def delete_site(self, site_id: str) -> bool:
+        cur = await self._write(lambda conn: conn.execute("DELETE FROM sites WHERE id = ?", (site_id,)))
+        return cur.rowcount > 0
+
+    async def active_site_ids(self, site_ids: List[str]) -> Set[str]:
+        sql = f"SELECT id FROM sites WHERE isActive = 1 AND id IN ({', '.join('?' * len(site_ids))})"
+        return {r["id"] for r in await self._read(lambda conn: conn.execute(sql, site_ids).fetchall())}
+
+    async def insert_status_check(self, doc: Dict[str, Any]) -> None:
+        sql = "INSERT INTO status_checks (id, client_name, timestamp) VALUES (?, ?, ?)"
+        await self._write(lambda conn: conn.execute(sql, (doc["id"], doc["client_name"], doc["timestamp"])))
+
+    async def list_status_checks(self, limit: int) -> List[Dict[str, Any]]:
+        rows = await self._read(lambda conn: conn.execute("SELECT * FROM status_checks LIMIT ?", (limit,)).fetchall())
+        return [dict(r) for r in rows]
+
+    # -- hits
+    def _hit(self, row: sqlite3.Row) -> Dict[str, Any]:
+        doc = dict(row)
+        if doc.get("eventProps") is not None:
+            doc["eventProps"] = json.loads(doc["eventProps"])
+        return doc
+
+    async def write_hits(self, docs: List[Dict[str, Any]]) -> Set[str]:
+        cols = self.HIT_COLUMNS
+        sql = (
+            f"INSERT INTO hits ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))}) "
+            f"ON CONFLICT(id) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in cols if c != 'id')}"
+        )
+        rows = [
+            [json.dumps(d[c]) if c == "eventProps" and d.get(c) is not None else d.get(c) for c in cols] for d in docs
+        ]
+        try:
+            await self._write(lambda conn: conn.executemany(sql, rows))
+        except sqlite3.Error as e:
+            logger.warning("hits_write_errors: %s", e)
+            return {d["id"] for d in docs}
+        return set()
+
+    async def iter_hits(
+        self,
+        site_id: str,
+        startTs: int,
+        endTs: int,
+        fields: Optional[Set[str]] = None,
+        after: Optional[Tuple[int, str]] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        # keyset pages: each one is a fresh range scan of (siteId, ts, id), no cursor held open
+        cols = [c for c in self.HIT_COLUMNS if not fields or c in fields or c in ("id", "ts")]
+        base = f"SELECT {', '.join(cols)} FROM hits WHERE siteId = ? AND ts >= ? AND ts <= ?"
+        n = 0
+        while limit is None or n < limit:
+            page = 1000 if limit is None else min(1000, limit - n)
+            if after:
+                sql, args = base + " AND (ts, id) > (?, ?) ORDER BY ts, id LIMIT ?", (site_id, startTs, endTs, *after, page)
+            else:
+                sql, args = base + " ORDER BY ts, id LIMIT ?", (site_id, startTs, endTs, page)
+            rows = await self._read(lambda conn: conn.execute(sql, args).fetchall())
+            for row in rows:
+                yield self._hit(row)
+            n += len(rows)
+            if len(rows) < page:
+                return
+            after = (rows[-1]["ts"], rows[-1]["id"])
+
+    async def delete_site_batch(self, site_id: str, batch_size: int) -> Optional[Tuple[str, int]]:
+        sql = "DELETE FROM hits WHERE rowid IN (SELECT rowid FROM hits WHERE siteId = ? LIMIT ?)"
+        deleted = await self._write(lambda conn: conn.execute(sql, (site_id, batch_size)).rowcount)
+        return ("hits", deleted) if deleted else None
+
+    async def apply_retention(self, retention: Dict[str, Optional[int]], now_ms: int) -> Dict[str, int]:
+        deleted = 0
+        for site_id, days in retention.items():
+            if not days:
+                continue
+            sql = "DELETE FROM hits WHERE siteId = ? AND ts < ?"
+            n = await self._write(lambda conn: conn.execute(sql, (site_id, now_ms - days * DAY_MS)).rowcount)
+            if n and overview_cache is not None:
+                overview_cache.bump(site_id)
+            deleted += n
+        return {"droppedPartitions": 0, "deletedHits": deleted}
+
+    # -- aggregates
+    _PAGEVIEWS = "FROM hits WHERE siteId = ? AND type = 'pageview' AND ts >= ? AND ts <= ?"
+
+    def _overview_sql(
+        self, conn: sqlite3.Connection, site_id: str, startTs: int, endTs: int
+    ) -> Tuple[List[OverviewSeriesPoint], Dict[str, Any], List[OverviewTopItem]]:
+        """_group_by_day / _calc_kpis / _top_by in SQL; only per-day and per-session rows come back."""
+        args = (site_id, startTs, endTs)
+        series = [
+            OverviewSeriesPoint(day=r[0], pageviews=r[1], visitors=r[2], sessions=r[3])
+            for r in conn.execute(
+                "SELECT strftime('%Y-%m-%d', ts / 1000, 'unixepoch') AS day, COUNT(*), COUNT(DISTINCT visitorId), "
+                f"COUNT(DISTINCT sessionId) {self._PAGEVIEWS} GROUP BY day ORDER BY day",
+                args,
+            )
+        ]
+        visits, visitors = conn.execute(
+            f"SELECT COUNT(*), COUNT(DISTINCT NULLIF(visitorId, '')) {self._PAGEVIEWS}", args
+        ).fetchone()
+        sessions = {
+            r[0]: {"pageviews": r[1], "first": r[2], "last": r[3]}
+            for r in conn.execute(
+                f"SELECT sessionId, COUNT(*), MIN(ts), MAX(ts) {self._PAGEVIEWS} AND sessionId != '' GROUP BY sessionId", args
+            )
+        }
+        # a session's duration is its first explicit durationMs, in ts order
+        for sid, d in conn.execute(
+            f"SELECT sessionId, durationMs {self._PAGEVIEWS} AND sessionId != '' AND durationMs > 0 "
+            "ORDER BY sessionId, ts, rowid",
+            args,
+        ):
+            sessions[sid].setdefault("dur", {"d": d})
+        top = [
+            OverviewTopItem(key=r[0], value=r[1])
+            for r in conn.execute(
+                f"SELECT {self._dimension_sql('url')} AS k, COUNT(*) AS n {self._PAGEVIEWS} "
+                "GROUP BY k HAVING k != '' ORDER BY n DESC, k LIMIT 8",
+                args,
+            )
+        ]
+        kpis = {"visits": visits, "visitors": visitors, "pageviews": visits, **_session_kpis(list(sessions.values()), visits)}
+        return series, kpis, top
+
+    async def overview(
+        self, site_id: str, startTs: int, endTs: int, engine: str, approx: bool = False, with_urls: bool = True
+    ) -> Tuple[List[OverviewSeriesPoint], Dict[str, Any], List[OverviewTopItem]]:
+        if not approx:
+            series, kpis, top = await self._read(self._overview_sql, site_id, startTs, endTs)
+            _count_scanned(kpis["visits"])  # index entries each query ranges over
+            return series, kpis, top
+        # no stored sketches: build the daily ones from a scan, as the rollup engine does for edge days
+        sql = f"SELECT siteId, ts, url, visitorId, sessionId, durationMs {self._PAGEVIEWS} ORDER BY rowid"
+        rows = await self._read(lambda conn: [dict(r) for r in conn.execute(sql, (site_id, startTs, endTs))])
+        _count_scanned(len(rows))
+        sessions = list(_sessions_from_hits(rows).values())
+        return _overview_from_rollups(list(_rollups_from_hits(rows).values()), [], sessions)
+
+    async def overview_periods(
+        self,
+        site_id: str,
+        periods: List[Tuple[int, int]],
+        engine: str,
+        approx: bool = False,
+        with_urls: bool = True,
+    ) -> List[Tuple[List[OverviewSeriesPoint], Dict[str, Any], List[OverviewTopItem]]]:
+        if approx:
+            return await super().overview_periods(site_id, periods, engine, approx, with_urls)
+        # each window is one range of the covering hits_overview index; run them in one reader-thread hop
+        results = await self._read(lambda conn: [self._overview_sql(conn, site_id, s, e) for s, e in periods])
+        for _, kpis, _ in results:
+            _count_scanned(kpis["visits"])
+        return results
+
+    async def realtime(self, site_id: str, startTs: int, endTs: int, limit: int) -> List[Dict[str, Any]]:
+        sql = f"SELECT {', '.join(self.HIT_COLUMNS)} {self._PAGEVIEWS} ORDER BY ts DESC LIMIT ?"
+        rows = await self._read(lambda conn: conn.execute(sql, (site_id, startTs, endTs, limit)).fetchall())
+        _count_scanned(len(rows))
+        return [self._hit(r) for r in rows]
+
+    async def active_visitors(self, site_id: str, startTs: int, endTs: int) -> int:
+        sql = f"SELECT COUNT(DISTINCT visitorId) {self._PAGEVIEWS}"
+        return await self._read(lambda conn: conn.execute(sql, (site_id, startTs, endTs)).fetchone()[0])
+
+    @staticmethod
+    def _dimension_sql(dimension: str) -> str:
+        if dimension == "referrer":
+            return "ref_host(referrer)"
+        return f"TRIM(COALESCE({dimension}, ''), char(32, 9, 10, 11, 12, 13))"  # str.strip()
+
+    async def breakdown(self, site_id: str, startTs: int, endTs: int, dimension: str, limit: int) -> BreakdownResponse:
+        key = self._dimension_sql(dimension)
+        args = (site_id, startTs, endTs)
+
+        def run(conn):
+            items = conn.execute(
+                f"SELECT {key} AS k, COUNT(*) AS n, COUNT(DISTINCT NULLIF(visitorId, '')) {self._PAGEVIEWS} "
+                "GROUP BY k HAVING k != '' ORDER BY n DESC, k LIMIT ?",
+                (*args, limit),
+            ).fetchall()
+            totals = conn.execute(f"SELECT COUNT(*), COUNT(DISTINCT NULLIF({key}, '')) {self._PAGEVIEWS}", args).fetchone()
+            return items, totals
+
+        items, (pageviews, values) = await self._read(run)
+        return BreakdownResponse(
+            siteId=site_id,
+            startTs=startTs,
+            endTs=endTs,
+            dimension=dimension,
+            pageviews=pageviews,
+            values=values,
+            items=[BreakdownItem(key=k, pageviews=n, visitors=v) for k, n, v in items],
+        )
+
+    async def heavy_hitters(self, site_id: str, startTs: int, endTs: int, dimension: str) -> HeavyHitters:
+        sql = f"SELECT {self._dimension_sql(dimension)} {self._PAGEVIEWS} ORDER BY ts, rowid"
+
+        def run(conn):
+            hh = HeavyHitters()
+            for (value,) in conn.execute(sql, (site_id, startTs, endTs)):
+                hh.add(value)
+            return hh
+
+        hh = await self._read(run)
+        _count_scanned(hh.n)
+        return hh
+
+    # -- jobs
+    async def insert_job(self, doc: Dict[str, Any]) -> None:
+        sql = "INSERT INTO jobs (id, status, owner, leaseUntil, doc) VALUES (?, ?, ?, ?, ?)"
+        await self._write(
+            lambda conn: conn.execute(sql, (doc["id"], doc["status"], doc.get("owner"), doc.get("leaseUntil", 0), json.dumps(doc)))
+        )
+
+    async def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = await self._read(lambda conn: conn.execute("SELECT doc FROM jobs WHERE id = ?", (job_id,)).fetchone())
+        return json.loads(row["doc"]) if row else None
+
+    def _update_job(
+        self, conn: sqlite3.Connection, job_id: str, where: str, args: Tuple[Any, ...], changes: Dict[str, Any], progress: Optional[Dict[str, int]]
+    ) -> Optional[Dict[str, Any]]:
+        row = conn.execute(f"SELECT doc FROM jobs WHERE id = ? {where}", (job_id, *args)).fetchone()
+        if row is None:
+            return None
+        doc = {**json.loads(row["doc"]), **changes}
+        for k, v in (progress or {}).items():
+            doc["progress"][k] = doc["progress"].get(k, 0) + v
+        conn.execute(
+            "UPDATE jobs SET status = ?, owner = ?, leaseUntil = ?, doc = ? WHERE id = ?",
+            (doc["status"], doc.get("owner"), doc.get("leaseUntil", 0), json.dumps(doc), job_id),
+        )
+        return doc
+
+    async def claim_job(self, job_id: str, owner: str, now_ms: int, lease_until: int) -> Optional[Dict[str, Any]]:
+        changes = {"status": "running", "owner": owner, "leaseUntil": lease_until, "updatedAt": now_ms}
+        where = "AND status IN ('queued', 'running') AND leaseUntil < ?"
+        return await self._write(self._update_job, job_id, where, (now_ms,), changes, None)
+
+    async def update_job(
+        self, job_id: str, owner: Optional[str], changes: Dict[str, Any], progress: Optional[Dict[str, int]] = None
+    ) -> bool:
+        where, args = ("AND owner = ?", (owner,)) if owner else ("", ())
+        return await self._write(self._update_job, job_id, where, args, changes, progress) is not None
+
+    async def unfinished_job_ids(self) -> List[str]:
+        rows = await self._read(lambda conn: conn.execute("SELECT id FROM jobs WHERE status IN ('queued', 'running')").fetchall())
+        return [r["id"] for r in rows]
+
+
+storage: Storage = SQLiteStorage(SQLITE_PATH) if STORAGE == "sqlite" else MongoStorage()
+
+
+# -----------------------------
+# Background jobs
+# -----------------------------
+# Site deletion runs as a stored job: small batches with a pause in between, so a site with
+# tens of millions of hits neither times out the request nor saturates the database. Deleting is
+# idempotent, so a job resumes after a restart by starting over on what is left. A worker holds a
+# job through a lease renewed on every batch and while it waits; jobs whose lease lapsed are picked
+# up again.
+JOB_BATCH_SIZE = int(os.environ.get("DELETE_BATCH_SIZE", "1000"))
+JOB_BATCH_PAUSE_SEC = float(os.environ.get("DELETE_BATCH_PAUSE_SEC", "0.05"))
+JOB_LEASE_SEC = float(os.environ.get("JOB_LEASE_SEC", "60"))
+JOB_POLL_SEC = float(os.environ.get("JOB_POLL_SEC", "30"))
+
+_job_owner = uuid.uuid4().hex
+job_tasks: Dict[str, asyncio.Task] = {}
+
+
+class JobLeaseLost(Exception):
+    pass
+
+
+async def create_job(job_type: str, site_id: str) -> Dict[str, Any]:
+    now_ms = int(time.time() * 1000)
+    job = Job(id=f"job_{uuid.uuid4().hex[:12]}", type=job_type, status="queued", siteId=site_id, createdAt=now_ms, updatedAt=now_ms)
+    doc = {**job.model_dump(), "leaseUntil": 0}
+    await storage.insert_job(doc)
+    _start_job(job.id)
+    return doc
+
+
+def _start_job(job_id: str) -> None:
+    if job_id not in job_tasks:
+        job_tasks[job_id] = asyncio.create_task(_run_job(job_id))
+
+
+async def _claim_job(job_id: str) -> Optional[Dict[str, Any]]:
+    now_ms = int(time.time() * 1000)
+    return await storage.claim_job(job_id, _job_owner, now_ms, now_ms + int(JOB_LEASE_SEC * 1000))
+
+
+async def _delete_site_batches(job: Dict[str, Any]) -> None:
+    """Delete the job's site from every collection holding its data, JOB_BATCH_SIZE docs at a time."""
+    while True:
+        batch = await storage.delete_site_batch(job["siteId"], JOB_BATCH_SIZE)
+        if batch is None:
+            break
+        name, deleted = batch
+        now_ms = int(time.time() * 1000)
+        changes = {"step": name, "updatedAt": now_ms, "leaseUntil": now_ms + int(JOB_LEASE_SEC * 1000)}
+        if not await storage.update_job(job["id"], _job_owner, changes, {name: deleted}):
+            raise JobLeaseLost(job["id"])
+        if JOB_BATCH_PAUSE_SEC > 0:
+            await asyncio.sleep(JOB_BATCH_PAUSE_SEC)
+
+
+async def _wait_holding_lease(job: Dict[str, Any], until_ms: float) -> None:
+    """Sleep until `until_ms`, renewing the job's lease so another worker doesn't take it over."""
+    while True:
+        now_ms = time.time() * 1000
+        if now_ms >= until_ms:
+            return
+        changes = {"updatedAt": int(now_ms), "leaseUntil": int(now_ms + JOB_LEASE_SEC * 1000)}
+        if not await storage.update_job(job["id"], _job_owner, changes):
+            raise JobLeaseLost(job["id"])
+        await asyncio.sleep(min(until_ms - now_ms, JOB_LEASE_SEC * 1000 / 3) / 1000)
+
+
+async def _run_job(job_id: str) -> None:
+    try:
+        job = await _claim_job(job_id)
+        if job is None:
+            return
+        try:
+            await _delete_site_batches(job)
+            # Other workers may accept hits for the site until their registry entry expires:
+            # sweep once more after that.
+            settle_until = job["createdAt"] + site_registry.ttl_sec * 1000
+            if settle_until > time.time() * 1000:
+                await _wait_holding_lease(job, settle_until)
+                await _delete_site_batches(job)
+        except JobLeaseLost:
+            logger.warning("job_lease_lost: %s", job_id)
+            return
+        except asyncio.CancelledError:
+            # shutting down: let the next worker (or this one after restart) resume right away
+            await storage.update_job(job_id, _job_owner, {"leaseUntil": 0})
+            raise
+        except Exception as e:
+            logger.warning("job_failed: %s: %s", job_id, e)
+            now_ms = int(time.time() * 1000)
+            await storage.update_job(
+                job_id, None, {"status": "failed", "error": str(e), "updatedAt": now_ms, "finishedAt": now_ms}
+            )
+            return
+        if overview_cache is not None:
+            overview_cache.bump(job["siteId"])
+        now_ms = int(time.time() * 1000)
+        await storage.update_job(
+            job_id, _job_owner, {"status": "done", "step": None, "updatedAt": now_ms, "finishedAt": now_ms}
+        )
+    finally:
+        job_tasks.pop(job_id, None)
+
+
+async def _job_loop() -> None:
+    """Start unfinished jobs (left by a restart, or by a worker whose lease lapsed)."""
+    while True:
+        try:
+            for job_id in await storage.unfinished_job_ids():
+                _start_job(job_id)
+        except Exception as e:
+            logger.warning("job_poll_failed: %s", e)
+        await asyncio.sleep(JOB_POLL_SEC)
+
+
+# -----------------------------
+# Routes
+# -----------------------------
+@api_router.get("/")
+async def root():
+    return {"message": "Self Analytics API"}
+
+
+@api_router.post("/status", response_model=StatusCheck)
+async def create_status_check(input: StatusCheckCreate):
+    status_obj = StatusCheck(**input.model_dump())
+    doc = status_obj.model_dump()
+    doc["timestamp"] = doc["timestamp"].isoformat()
+    await storage.insert_status_check(doc)
+    return status_obj
+
+
+@api_router.get("/status", response_model=List[StatusCheck])
+async def get_status_checks():
+    status_checks = await storage.list_status_checks(1000)
+    for check in status_checks:
+        if isinstance(check.get("timestamp"), str):
+            check["timestamp"] = datetime.fromisoformat(check["timestamp"])
+    return status_checks
+
+
+@api_router.post("/sites", response_model=Site)
+async def create_site(payload: SiteCreate):
+    site_id = f"site_{uuid.uuid4().hex[:12]}"
+    site = Site(
+        id=site_id,
+        name=payload.name.strip(),
+        domain=payload.domain.strip(),
+        createdAt=int(datetime.now(tz=timezone.utc).timestamp() * 1000),
+        isActive=True,
+        sessionTimeoutMin=int(payload.sessionTimeoutMin or 30),
+        retentionDays=payload.retentionDays,
+    )
+    await storage.insert_site(site.model_dump())
+    site_registry.put(site_id, True)
+    return site
+
+
+@api_router.patch("/sites/{site_id}", response_model=Site)
+async def update_site(site_id: str, payload: SiteUpdate):
+    # only fields present in the body change; {"retentionDays": null} clears it
+    row = await storage.update_site(site_id, payload.model_dump(exclude_unset=True))
+    if not row:
+        raise HTTPException(status_code=404, detail="site_not_found")
+    return row
+
+
+@api_router.get("/sites", response_model=List[Site])
+async def list_sites():
+    return await storage.list_sites()
+
+
+@api_router.delete("/sites/{site_id}")
+async def delete_site(site_id: str):
+    # The site stops accepting hits now; its data goes in a background job (GET /api/jobs/{id}).
+    if not await storage.delete_site(site_id):
+        raise HTTPException(status_code=404, detail="site_not_found")
+    site_registry.put(site_id, False)
+    if overview_cache is not None:
+        overview_cache.bump(site_id)
+    if realtime_tracker is not None:
+        realtime_tracker.forget(site_id)
+    if heavy_hitter_writer is not None:
+        heavy_hitter_writer.forget(site_id)
+    job = await create_job("delete_site", site_id)
+    return {"ok": True, "jobId": job["id"]}
+
+
+@api_router.get("/jobs/{job_id}", response_model=Job)
+async def get_job(job_id: str):
+    job = await storage.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="job_not_found")
+    return job
+
+
+@api_router.post("/collect", response_model=CollectResponse)
+async def collect_hit(
+    request: Request,
+    payload: HitIn,
+    dnt: Optional[str] = Header(default=None, alias="DNT"),
+):
+    # Respect Do Not Track
+    if dnt == "1":
+        return CollectResponse(ok=True)
+
+    now_ms = int(datetime.now(tz=timezone.utc).timestamp() * 1000)
+    ip = _client_ip(request)
+
+    # Best-effort rate limit
+    rl_key = f"{payload.siteId}:{ip}"
+    if not limiter_collect.allow(rl_key, now_ms, limiter_collect.limit_for(payload.siteId)):
+        raise HTTPException(status_code=429, detail="rate_limited")
+
+    # Validate site exists and active
+    if not await site_registry.is_active(payload.siteId):
+        raise HTTPException(status_code=400, detail="invalid_site")
+
+    doc = _hit_doc(payload, ip)
+    if hit_buffer is not None:
+        if not hit_buffer.offer([doc]):
+            raise HTTPException(status_code=503, detail="buffer_full", headers={"Retry-After": "1"})
+    elif await storage.write_hits([doc]):
+        raise HTTPException(status_code=500, detail="write_failed")
+    if realtime_tracker is not None:
+        realtime_tracker.add([doc], now_ms)
+    return CollectResponse(ok=True)
+
+
+@api_router.post("/collect/batch", response_model=CollectBatchResponse)
+async def collect_batch(
+    request: Request,
+    dnt: Optional[str] = Header(default=None, alias="DNT"),
+):
+    """Collect an array of hits in one request.
+
+    The body is read manually so `navigator.sendBeacon` can post it as text/plain
+    (no CORS preflight). Sites are validated with one query per batch and all
+    accepted hits are persisted in a single batched write.
+    """
+    try:
+        items = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid_json")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="expected_array")
+    if len(items) > COLLECT_BATCH_MAX:
+        raise HTTPException(status_code=413, detail="batch_too_large")
+
+    results = [CollectBatchItem(index=i, status="ok") for i in range(len(items))]
+
+    # Respect Do Not Track
+    if dnt == "1":
+        for r in results:
+            r.status = "ignored"
+        return CollectBatchResponse(ok=True, accepted=0, results=results)
+
+    payloads: List[Optional[HitIn]] = []
+    for i, raw in enumerate(items):
+        try:
+            p = HitIn.model_validate(raw)
+        except ValidationError:
+            results[i].status = "invalid"
+            p = None
+        payloads.append(p)
+
+    # Validate every distinct site once
+    active = await site_registry.active_ids(_uniq([p.siteId for p in payloads if p]))
+
+    now_ms = int(datetime.now(tz=timezone.utc).timestamp() * 1000)
+    ip = _client_ip(request)
+
+    # Coalesce by hit id so a pageview and its later duration patch in the same
+    # batch keep their order (unordered bulk writes may apply in any order).
+    docs: Dict[str, Dict[str, Any]] = {}
+    doc_items: Dict[str, List[int]] = {}
+    for i, p in enumerate(payloads):
+        if p is None:
+            continue
+        if p.siteId not in active:
+            results[i].status = "invalid_site"
+            continue
+        # Best-effort rate limit, one token per hit
+        if not limiter_collect.allow(f"{p.siteId}:{ip}", now_ms, limiter_collect.limit_for(p.siteId)):
+            results[i].status = "rate_limited"
+            continue
+        doc = _hit_doc(p, ip)
+        results[i].id = doc["id"]
+        docs[doc["id"]] = doc
+        doc_items.setdefault(doc["id"], []).append(i)
+
+    failed: Set[str] = set()
+    if docs and hit_buffer is not None:
+        if not hit_buffer.offer(list(docs.values())):
+            raise HTTPException(status_code=503, detail="buffer_full", headers={"Retry-After": "1"})
+    elif docs:
+        failed = await storage.write_hits(list(docs.values()))
+        for hid in failed:
+            for i in doc_items[hid]:
+                results[i].status = "error"
+    if realtime_tracker is not None and docs:
+        realtime_tracker.add([d for hid, d in docs.items() if hid not in failed], now_ms)
+
+    accepted = sum(1 for r in results if r.status == "ok")
+    return CollectBatchResponse(ok=accepted == len(results), accepted=accepted, results=results)
+
+
+@api_router.get("/collect/buffer")
+async def collect_buffer_stats():
+    if hit_buffer is None:
+        return {"enabled": False}
+    return {"enabled": True, **hit_buffer.stats()}
+
+
+HIT_FIELDS = set(HitIn.model_fields) | {"ipHash"}
+
+
+def _encode_cursor(ts: int, hit_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([ts, hit_id]).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> Tuple[int, str]:
+    try:
+        ts, hit_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return int(ts), str(hit_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="invalid_cursor")
+
+
+# FAST_JSON=1: /hits, /overview and NDJSON streams skip FastAPI's response validation and
+# jsonable_encoder. Hit rows are encoded by orjson, the overview by its model's own serializer.
+# Opt-in because the bytes change (non-ASCII is sent as UTF-8, not \u escapes), not the data.
+FAST_JSON = os.environ.get("FAST_JSON", "0") == "1"
+
+
+def _ndjson_lines(rows: List[Dict[str, Any]]) -> str:
+    if FAST_JSON:
+        return "".join(orjson.dumps(row).decode("utf-8") + "\n" for row in rows)
+    return "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows)
+
+
+# Same columns and order as the dashboard's exportSiteCsv
+EXPORT_CSV_COLUMNS = [
+    "id", "siteId", "type", "ts", "url", "title", "referrer", "visitorId", "sessionId", "durationMs",
+    "scrollMax", "deviceType", "browser", "os", "lang", "tz", "countryHint", "channel",
+    "utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content", "eventName",
+]
+
+
+def _csv_lines(rows: List[Dict[str, Any]]) -> str:
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerows([row.get(c) for c in EXPORT_CSV_COLUMNS] for row in rows)
+    return out.getvalue()
+
+
+async def _encoded_rows(
+    rows: AsyncIterator[Dict[str, Any]], encode: Callable[[List[Dict[str, Any]]], str]
+) -> AsyncIterator[bytes]:
+    # Encode 1000 hits at a time and coalesce output into ~64KB chunks: one send per chunk, not per document.
+    buf: List[str] = []
+    size = 0
+    batch: List[Dict[str, Any]] = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) < 1000:
+            continue
+        text = encode(batch)
+        buf.append(text)
+        size += len(text)
+        batch = []
+        if size >= 64 * 1024:
+            yield "".join(buf).encode("utf-8")
+            buf, size = [], 0
+    if batch:
+        buf.append(encode(batch))
+    if buf:
+        yield "".join(buf).encode("utf-8")
+
+
+async def _csv_rows(rows: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    yield (",".join(EXPORT_CSV_COLUMNS) + "\n").encode("utf-8")
+    async for chunk in _encoded_rows(rows, _csv_lines):
+        yield chunk
+
+
+EXPORT_GZIP_LEVEL = int(os.environ.get("EXPORT_GZIP_LEVEL", "6"))
+
+
+async def _gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    z = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    async for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+
+@api_router.get("/hits")
+async def list_hits(
+    siteId: str = Query(...),
+    startTs: int = Query(...),
+    endTs: int = Query(...),
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = Query(None),
+    fields: Optional[str] = Query(None),
+    format: Literal["json", "ndjson"] = Query("json"),
+):
+    """Hits in (ts, id) order.
+
+    json: up to `limit` (default 5000, max 20000) hits plus `nextCursor` to pass
+    back for the next page. ndjson: streams one hit per line straight from the
+    storage cursor (no limit unless given). `fields=url,ts,...` projects columns;
+    id and ts are always included since they make up the cursor.
+    """
+    if format == "json":
+        limit = limit or 5000
+        if limit > 20000:
+            raise HTTPException(status_code=422, detail="limit_too_large")
+
+    wanted: Optional[Set[str]] = None
+    if fields:
+        wanted = {f.strip() for f in fields.split(",") if f.strip()}
+        if not wanted <= HIT_FIELDS:
+            raise HTTPException(status_code=400, detail="invalid_fields")
+        wanted |= {"id", "ts"}
+
+    after = _decode_cursor(cursor) if cursor else None
+    hits = storage.iter_hits(siteId, startTs, endTs, fields=wanted, after=after, limit=limit)
+
+    if format == "ndjson":
+        return StreamingResponse(_encoded_rows(hits, _ndjson_lines), media_type="application/x-ndjson")
+
+    rows = [h async for h in hits]
+    next_cursor = _encode_cursor(rows[-1]["ts"], rows[-1]["id"]) if len(rows) == limit else None
+    if FAST_JSON:
+        return ORJSONResponse({"hits": rows, "nextCursor": next_cursor})
+    return {"hits": rows, "nextCursor": next_cursor}
+
+
+def _attachment(filename: str) -> str:
+    """Content-Disposition for a download: an ASCII-safe quoted name for old clients, and the
+    exact one percent-encoded as filename* (RFC 6266), so ids with quotes, ';' or non-ASCII
+    can't break the header."""
+    fallback = re.sub(r"[^A-Za-z0-9._-]", "_", filename)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+
+@api_router.get("/export")
+async def export_hits(
+    siteId: str = Query(...),
+    startTs: int = Query(...),
+    endTs: int = Query(...),
+    format: Literal["ndjson", "csv"] = Query("ndjson"),
+    compress: bool = Query(False, alias="gzip"),
+):
+    """Download every hit of a range, in (ts, id) order, as NDJSON or CSV (gzip=1: gzipped).
+
+    Streams straight off the cursor: documents are fetched 1000 at a time and
+    the next chunk is only encoded once the client has taken the previous one,
+    so server memory stays flat however large the export.
+    """
+    hits = storage.iter_hits(siteId, startTs, endTs)
+    if format == "csv":
+        chunks, media_type = _csv_rows(hits), "text/csv; charset=utf-8"
+    else:
+        chunks, media_type = _encoded_rows(hits, _ndjson_lines), "application/x-ndjson"
+    filename = f"sa_{siteId}_hits.{format}"
+    if compress:
+        chunks, media_type, filename = _gzip_chunks(chunks), "application/gzip", filename + ".gz"
+    return StreamingResponse(chunks, media_type=media_type, headers={"Content-Disposition": _attachment(filename)})
+
+
+def _year_earlier(ts: int) -> int:
+    dt = datetime.fromtimestamp(ts / 1000, tz=timezone.utc)
+    try:
+        prev = dt.replace(year=dt.year - 1)
+    except ValueError:  # Feb 29
+        prev = dt.replace(year=dt.year - 1, day=28)
+    return ts - (dt - prev) // timedelta(milliseconds=1)
+
+
+def _compare_window(startTs: int, endTs: int, mode: str) -> Tuple[int, int]:
+    if mode == "previous":
+        span = endTs - startTs + 1
+        return startTs - span, startTs - 1
+    return _year_earlier(startTs), _year_earlier(endTs)
+
+
+def _aligned_series(series: List[OverviewSeriesPoint], startTs: int, compareStartTs: int) -> List[OverviewComparePoint]:
+    """Move comparison days onto the current window's days by their offset from its first day."""
+    shift = date.fromisoformat(_day_key(startTs)) - date.fromisoformat(_day_key(compareStartTs))
+    return [
+        OverviewComparePoint.model_construct(
+            day=(date.fromisoformat(p.day) + shift).isoformat(),
+            compareDay=p.day,
+            pageviews=p.pageviews,
+            visitors=p.visitors,
+            sessions=p.sessions,
+        )
+        for p in series
+    ]
+
+
+def _kpi_change(kpis: Dict[str, Any], base: Dict[str, Any]) -> Dict[str, Optional[float]]:
+    return {k: (v - base[k]) / base[k] * 100 if base.get(k) else None for k, v in kpis.items()}
+
+
+async def _build_overview(
+    siteId: str, startTs: int, endTs: int, engine: str, approx: bool, compare: Optional[str] = None
+) -> OverviewResponse:
+    scanned = [0]
+    token = _overview_scan.set(scanned)
+    try:
+        return await _compute_overview(siteId, startTs, endTs, engine, approx, compare)
+    finally:
+        _overview_scan.reset(token)
+        overview_docs_scanned.observe(("approx" if approx else engine,), scanned[0])
+
+
+async def _compute_overview(
+    siteId: str, startTs: int, endTs: int, engine: str, approx: bool, compare: Optional[str] = None
+) -> OverviewResponse:
+    # the comparison window is read together with the current one (see Storage.overview_periods)
+    periods = [(startTs, endTs)]
+    if compare:
+        periods.append(_compare_window(startTs, endTs, compare))
+    # approx=true answers exactly (approx stays null) where the backend keeps no sketches
+    sketched = storage.sketched(engine, approx)
+    sketched_urls = approx and sketched and "url" in HEAVY_HITTER_DIMS
+    results = await storage.overview_periods(siteId, periods, engine, approx=approx, with_urls=not sketched_urls)
+    series, kpis, top_pages = results[0]
+    approx_info = None
+    if sketched:
+        approx_info = {"method": "hyperloglog", "precision": HLL_P, "relativeStdError": 1.04 / math.sqrt(1 << HLL_P)}
+    if sketched_urls:
+        hh = await storage.heavy_hitters(siteId, startTs, endTs, "url")
+        top_pages = [OverviewTopItem(key=k, value=v) for k, v in hh.top(8)]
+        approx_info["topPages"] = _heavy_hitters_info(hh)
+
+    comparison = None
+    if compare:
+        (cmp_start, cmp_end), (cmp_series, cmp_kpis, _) = periods[1], results[1]
+        comparison = OverviewComparison.model_construct(
+            mode=compare,
+            startTs=cmp_start,
+            endTs=cmp_end,
+            kpis=cmp_kpis,
+            series=_aligned_series(cmp_series, startTs, cmp_start),
+            change=_kpi_change(kpis, cmp_kpis),
+        )
+
+    now_ms = int(datetime.now(tz=timezone.utc).timestamp() * 1000)
+    live = None
+    if realtime_tracker is not None:
+        live = await realtime_tracker.read(siteId, startTs, endTs, 50, now_ms)
+    if live is not None:
+        realtime_hits, active_visitors = live
+    else:
+        realtime_hits = await storage.realtime(siteId, max(startTs, now_ms - REALTIME_WINDOW_MS), endTs, 50)
+        active_visitors = await storage.active_visitors(siteId, max(startTs, now_ms - ACTIVE_WINDOW_MS), endTs)
+
+    # every part is already a model or the API shape: skip re-validating (FastAPI validates the
+    # response_model on the default path anyway)
+    return OverviewResponse.model_construct(
+        siteId=siteId,
+        startTs=startTs,
+        endTs=endTs,
+        kpis=kpis,
+        series=series,
+        realtime=realtime_hits,
+        activeVisitors=active_visitors,
+        topPages=top_pages,
+        approx=approx_info,
+        compare=comparison,
+    )
+
+
+@api_router.get("/overview", response_model=OverviewResponse)
+async def overview(
+    siteId: str = Query(...),
+    startTs: int = Query(...),
+    endTs: int = Query(...),
+    engine: Optional[OverviewEngine] = Query(None),
+    approx: bool = Query(False),
+    compare: Optional[OverviewCompare] = Query(None),
+):
+    engine = engine or OVERVIEW_ENGINE
+    if overview_cache is None:
+        res = await _build_overview(siteId, startTs, endTs, engine, approx, compare)
+        if FAST_JSON:
+            return Response(content=res.model_dump_json(), media_type="application/json")
+        return res
+
+    async def compute() -> bytes:
+        res = await _build_overview(siteId, startTs, endTs, engine, approx, compare)
+        return res.model_dump_json().encode("utf-8")
+
+    key = overview_cache.key(siteId, startTs, endTs, f"{engine}:{int(approx)}:{compare or ''}")
+    body = await overview_cache.fetch(key, siteId, compute)
+    return Response(content=body, media_type="application/json")
+
+
+@api_router.get("/breakdown", response_model=BreakdownResponse)
+async def breakdown(
+    siteId: str,
+    startTs: int,
+    endTs: int,
+    dimension: BreakdownDimension,
+    limit: int = Query(10, ge=1, le=100),
+    approx: bool = Query(False),
+):
+    if approx:
+        if dimension not in HEAVY_HITTER_DIMS:
+            raise HTTPException(status_code=400, detail="dimension_not_sketched")
+        hh = await storage.heavy_hitters(siteId, startTs, endTs, dimension)
+        return BreakdownResponse(
+            siteId=siteId,
+            startTs=startTs,
+            endTs=endTs,
+            dimension=dimension,
+            pageviews=hh.n,
+            items=[BreakdownItem(key=k, pageviews=v) for k, v in hh.top(limit)],
+            approx=_heavy_hitters_info(hh),
+        )
+    return await storage.breakdown(siteId, startTs, endTs, dimension, limit)
+
+
+@api_router.get("/metrics")
+async def metrics():
+    if not METRICS:
+        raise HTTPException(status_code=404, detail="metrics_disabled")
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@api_router.get("/overview/cache")
+async def overview_cache_stats():
+    if overview_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **overview_cache.stats()}
+
+
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    body = orjson.dumps(data).decode("utf-8") if FAST_JSON else json.dumps(data, separators=(",", ":"))
+    return f"event: {event}\ndata: {body}\n\n"
+
+
+async def _realtime_events(tracker: RealtimeTracker, site_id: str) -> AsyncIterator[str]:
+    ev = tracker.subscribe(site_id)
+    try:
+        now_ms = int(datetime.now(tz=timezone.utc).timestamp() * 1000)
+        hits, active = await tracker.read(site_id, 0, now_ms + DAY_MS, tracker.size, now_ms)
+        seq = tracker.seq
+        yield _sse_event("snapshot", {"activeVisitors": active, "hits": hits})
+        while tracker.is_open(site_id, ev):
+            try:
+                await asyncio.wait_for(ev.wait(), timeout=REALTIME_KEEPALIVE_SEC)
+            except asyncio.TimeoutError:
+                # no hits, but visitors may have gone idle
+                n = tracker.active(site_id, int(datetime.now(tz=timezone.utc).timestamp() * 1000))
+                if n != active:
+                    active = n
+                    yield _sse_event("active", {"activeVisitors": active})
+                else:
+                    yield ": keepalive\n\n"
+                continue
+            if not tracker.is_open(site_id, ev):
+                break
+            # let a burst of hits collect into one event
+            await asyncio.sleep(REALTIME_STREAM_INTERVAL_SEC)
+            ev.clear()
+            hits, seq = tracker.since(site_id, seq)
+            active = tracker.active(site_id, int(datetime.now(tz=timezone.utc).timestamp() * 1000))
+            yield _sse_event("hits", {"activeVisitors": active, "hits": hits})  # hits may be [] (a new visitor only)
+    finally:
+        tracker.unsubscribe(site_id, ev)
+
+
+@api_router.get("/realtime/stream")
+async def realtime_stream(siteId: str = Query(...)):
+    """Server-sent events: a `snapshot` (latest hits, active visitors), then `hits`
+    with the hits added since the last event, and `active` when only the count moved."""
+    if realtime_tracker is None:
+        raise HTTPException(status_code=404, detail="realtime_tracker_disabled")
+    if not await site_registry.is_active(siteId):
+        raise HTTPException(status_code=404, detail="site_not_found")
+    return StreamingResponse(
+        _realtime_events(realtime_tracker, siteId),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+TRACKER_JS = (
+    "!function(){var w=window,d=document;var sc=d.currentScript||function(){var s=d.getElementsByTagName('script');return s[s.length-1]}();"
+    "var sid=(sc&&sc.getAttribute&&sc.getAttribute('data-site'))||'';if(!sid||!w||!d)return;"
+    "if(navigator.doNotTrack==='1'||w.doNotTrack==='1')return;"
+    "function rid(n){var a=new Uint8Array(n);(w.crypto||w.msCrypto).getRandomValues(a);for(var s='',i=0;i<a.length;i++)s+=String.fromCharCode(a[i]);"
     "return btoa(s).replace(/\\+/g,'-').replace(/\\//g,'_').replace(/=+$/,'')}"
     "function key(p){return'sa_'+p+'_'+sid}"
     "var LS=w.localStorage,SS=w.sessionStorage;"
@@ -442,21 +4370,101 @@ TRACKER_JS = (
     "function chan(ref){try{if(!ref)return'Direct';var u=new URL(ref),h=u.hostname||'';if(/(google\\.|bing\\.|duckduckgo\\.)/.test(h))return'Search';if(/(facebook\\.|twitter\\.|x\\.com|t\\.co|instagram\\.|linkedin\\.|tiktok\\.)/.test(h))return'Social';return'Referral'}catch(e){return ref?'Referral':'Direct'}}"
     "function utm(){var o={};try{var p=new URLSearchParams(w.location.search),ks=['utm_source','utm_medium','utm_campaign','utm_term','utm_content'];for(var i=0;i<ks.length;i++){var v=p.get(ks[i]);if(v)o[ks[i]]=v}}catch(e){}return o}"
     "var V=vid(),S=sess(),hitId='',scrollMax=0;"
-    "function send(obj){try{var ep=(sc&&sc.getAttribute&&sc.getAttribute('data-endpoint'))||'/api/collect';"
-    "fetch(ep,{method:'POST',headers:{'content-type':'application/json'},body:JSON.stringify(obj),keepalive:true,mode:'cors',credentials:'omit'}).catch(function(){})}catch(e){}}"
+    "function ep(){return(sc&&sc.getAttribute&&sc.getAttribute('data-endpoint'))||'/api/collect'}"
+    "function post(u,body){fetch(u,{method:'POST',headers:{'content-type':'application/json'},body:body,keepalive:true,mode:'cors',credentials:'omit'}).catch(function(){})}"
+    # data-batch="1": queue hits and flush them to <endpoint>/batch in one request
+    "var B=!!(sc&&sc.getAttribute&&sc.getAttribute('data-batch')==='1'),Q=[],qt=0;"
+    "function flush(beacon){if(qt){clearTimeout(qt);qt=0}if(!Q.length)return;var body=JSON.stringify(Q.splice(0,Q.length)),u=ep()+'/batch';"
+    "try{if(beacon&&navigator.sendBeacon&&navigator.sendBeacon(u,new Blob([body],{type:'text/plain'})))return}catch(e){}try{post(u,body)}catch(e){}}"
+    "function send(obj){try{if(B){Q.push(obj);if(Q.length>=20)flush(false);else if(!qt)qt=setTimeout(function(){flush(false)},5000);return}post(ep(),JSON.stringify(obj))}catch(e){}}"
     "function pv(){S=sess();var now=Date.now(),tzv=tz(),u=utm();hitId=rid(10)+'_'+now;scrollMax=0;send({id:hitId,siteId:sid,type:'pageview',ts:now,url:w.location.href,title:d.title||'',referrer:d.referrer||'',visitorId:V,sessionId:S,durationMs:null,scrollMax:null,deviceType:dev(),browser:br(),os:os(),lang:navigator.language||'',tz:tzv,countryHint:regn(tzv),channel:chan(d.referrer||''),utm_source:u.utm_source||null,utm_medium:u.utm_medium||null,utm_campaign:u.utm_campaign||null,utm_term:u.utm_term||null,utm_content:u.utm_content||null,eventName:null,eventProps:null})}"
     "function patch(){try{if(!hitId)return;var started=parseInt(hitId.split('_')[1]||String(Date.now()),10),dur=Date.now()-started;send({id:hitId,siteId:sid,type:'pageview',ts:started,url:w.location.href,title:d.title||'',referrer:d.referrer||'',visitorId:V,sessionId:S,durationMs:dur,scrollMax:scrollMax,deviceType:dev(),browser:br(),os:os(),lang:navigator.language||'',tz:tz(),countryHint:regn(tz()),channel:chan(d.referrer||'')})}catch(e){}}"
     "function onScroll(){var de=d.documentElement,stp=w.pageYOffset||de.scrollTop||0,h=de.scrollHeight-w.innerHeight,p=h>0?Math.min(100,Math.round(stp/h*100)):100;if(p>scrollMax)scrollMax=p}"
     "function hookHistory(){try{var ps=history.pushState,rs=history.replaceState;history.pushState=function(){ps.apply(history,arguments);setTimeout(pv,0)};history.replaceState=function(){rs.apply(history,arguments);setTimeout(pv,0)};w.addEventListener('popstate',function(){setTimeout(pv,0)})}catch(e){}}"
     "function hookClicks(){d.addEventListener('click',function(e){try{var a=e.target&&e.target.closest?e.target.closest('a'):null;if(!a||!a.href)return;var u=new URL(a.href);if(u.host&&u.host!==w.location.host)send({id:rid(10)+'_'+Date.now(),siteId:sid,type:'outbound',ts:Date.now(),url:w.location.href,title:d.title||'',referrer:d.referrer||'',visitorId:V,sessionId:sess(),deviceType:dev(),browser:br(),os:os(),lang:navigator.language||'',tz:tz(),countryHint:regn(tz()),channel:chan(d.referrer||''),eventName:'outbound',eventProps:{to:a.href}})}catch(err){}},true)}"
     "w.sa=w.sa||{};w.sa.track=function(name,props){send({id:rid(10)+'_'+Date.now(),siteId:sid,type:'event',ts:Date.now(),url:w.location.href,title:d.title||'',referrer:d.referrer||'',visitorId:V,sessionId:sess(),deviceType:dev(),browser:br(),os:os(),lang:navigator.language||'',tz:tz(),countryHint:regn(tz()),channel:chan(d.referrer||''),eventName:String(name||'event'),eventProps:props||null})};"
-    "hookHistory();hookClicks();w.addEventListener('scroll',onScroll,{passive:true});w.addEventListener('visibilitychange',function(){if(d.visibilityState==='hidden')patch()});w.addEventListener('pagehide',patch);pv();}();"
+    "hookHistory();hookClicks();w.addEventListener('scroll',onScroll,{passive:true});w.addEventListener('visibilitychange',function(){if(d.visibilityState==='hidden'){patch();flush(true)}});w.addEventListener('pagehide',function(){patch();flush(true)});pv();}();"
 )
 
 
+# The tracker is built once: content-hash version/ETag plus gzip and brotli bodies. Sites can
+# embed the versioned URL (advertised in Content-Location) and cache it forever.
+TRACKER_VERSION = hashlib.sha256(TRACKER_JS.encode("utf-8")).hexdigest()[:16]
+TRACKER_BODIES: Dict[str, bytes] = {
+    "identity": TRACKER_JS.encode("utf-8"),
+    "gzip": gzip.compress(TRACKER_JS.encode("utf-8"), compresslevel=9, mtime=0),
+    "br": brotli.compress(TRACKER_JS.encode("utf-8"), quality=11, mode=brotli.MODE_TEXT),
+}
+# one strong ETag per representation, all derived from the content hash
+TRACKER_ETAGS: Dict[str, str] = {enc: f'"{TRACKER_VERSION}-{enc}"' for enc in TRACKER_BODIES}
+TRACKER_CACHE_SHORT = "public, max-age=300"
+TRACKER_CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+@lru_cache(maxsize=512)
+def _pick_encoding(accept_encoding: Optional[str]) -> str:
+    """Best of br > gzip > identity allowed by an Accept-Encoding header (q=0 excludes)."""
+    q: Dict[str, float] = {}
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        q[name.strip()] = weight
+    wildcard = q.get("*", 0.0)
+    best, best_q = "identity", 0.0
+    for enc in ("br", "gzip"):
+        weight = q.get(enc, wildcard)
+        if weight > best_q:
+            best, best_q = enc, weight
+    return best
+
+
+def _tracker_headers(encoding: str, cache_control: str) -> Dict[str, str]:
+    headers = {
+        "ETag": TRACKER_ETAGS[encoding],
+        "Cache-Control": cache_control,
+        "Vary": "Accept-Encoding",
+        "Content-Location": f"/api/i.{TRACKER_VERSION}.js",
+    }
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return headers
+
+
+TRACKER_HEADERS = {
+    (enc, cc): _tracker_headers(enc, cc) for enc in TRACKER_BODIES for cc in (TRACKER_CACHE_SHORT, TRACKER_CACHE_IMMUTABLE)
+}
+
+
+def _tracker_response(request: Request, cache_control: str) -> Response:
+    encoding = _pick_encoding(request.headers.get("accept-encoding"))
+    headers = TRACKER_HEADERS[(encoding, cache_control)]
+
+    inm = request.headers.get("if-none-match")
+    if inm:
+        tags = {t.strip().removeprefix("W/") for t in inm.split(",")}
+        # any representation of the current version is still fresh
+        if "*" in tags or not tags.isdisjoint(TRACKER_ETAGS.values()):
+            return Response(status_code=304, headers=headers)
+    return Response(content=TRACKER_BODIES[encoding], media_type="application/javascript", headers=headers)
+
+
 @api_router.get("/i.js")
-async def tracker_js():
-    return Response(content=TRACKER_JS, media_type="application/javascript")
+async def tracker_js(request: Request):
+    return _tracker_response(request, TRACKER_CACHE_SHORT)
+
+
+@api_router.get("/i.{version}.js")
+async def tracker_js_versioned(request: Request, version: str):
+    # An old version still gets the current script, just not pinned as immutable.
+    return _tracker_response(request, TRACKER_CACHE_IMMUTABLE if version == TRACKER_VERSION else TRACKER_CACHE_SHORT)
 
 
 # Include the router in the main app
@@ -469,20 +4477,61 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if METRICS:
+    app.add_middleware(RequestMetricsMiddleware)
 
 
 @app.on_event("startup")
 async def ensure_indexes():
     # Speed up queries
     try:
-        await db.sites.create_index("id", unique=True)
-        await db.hits.create_index([("siteId", 1), ("ts", 1)])
-        await db.hits.create_index([("siteId", 1), ("type", 1), ("ts", 1)])
-        await db.hits.create_index("id", unique=True)
+        await storage.open()
     except Exception as e:
         logger.warning("index_create_failed: %s", e)
 
 
+@app.on_event("startup")
+async def start_hit_buffer():
+    if hit_buffer is not None:
+        hit_buffer.start()
+    if heavy_hitter_writer is not None:
+        heavy_hitter_writer.start()
+
+
+async def _retention_loop() -> None:
+    while True:
+        try:
+            res = await apply_retention()
+            if res["droppedPartitions"] or res["deletedHits"]:
+                logger.info("retention: %s", res)
+        except Exception as e:
+            logger.warning("retention_failed: %s", e)
+        await asyncio.sleep(RETENTION_INTERVAL_SEC)
+
+
+retention_task: Optional[asyncio.Task] = None
+job_loop_task: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    global retention_task, job_loop_task
+    if RETENTION_INTERVAL_SEC > 0:
+        retention_task = asyncio.create_task(_retention_loop())
+    job_loop_task = asyncio.create_task(_job_loop())
+
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    if realtime_tracker is not None:
+        realtime_tracker.close()
+    for task in (retention_task, job_loop_task, *job_tasks.values()):
+        if task is not None:
+            task.cancel()
+    await asyncio.gather(*job_tasks.values(), return_exceptions=True)
+    # Flush queued hits before the client goes away
+    if hit_buffer is not None:
+        await hit_buffer.drain()
+    if heavy_hitter_writer is not None:
+        await heavy_hitter_writer.close()
+    await storage.close()
\ No newline at end of file
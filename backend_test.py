@@ -4,6 +4,9 @@ Backend API Testing for Analytics Phase 1
 Tests all endpoints: sites, collect, overview, tracker js, rate limiting
 """
 
+import csv
+import gzip
+import io
 import json
 import time
 import requests
@@ -94,6 +97,33 @@ def test_list_sites(expected_site_id: str = None):
         log_test("List sites", False, f"Exception: {str(e)}")
         return False
 
+def test_update_site_retention(site_id: str):
+    """Test 3b: PATCH /api/sites/{id} - set, validate and clear retentionDays"""
+    try:
+        response = requests.patch(f"{BASE_URL}/sites/{site_id}", json={"retentionDays": 400}, timeout=10)
+        if response.status_code != 200 or response.json().get("retentionDays") != 400:
+            log_test("Update site retention", False, f"Status: {response.status_code}, Body: {response.text}")
+            return False
+
+        invalid = requests.patch(f"{BASE_URL}/sites/{site_id}", json={"retentionDays": 0}, timeout=10)
+        missing = requests.patch(f"{BASE_URL}/sites/site_missing", json={"retentionDays": 30}, timeout=10)
+        cleared = requests.patch(f"{BASE_URL}/sites/{site_id}", json={"retentionDays": None}, timeout=10)
+        if (
+            invalid.status_code == 422
+            and missing.status_code == 404
+            and cleared.status_code == 200
+            and cleared.json().get("retentionDays") is None
+            and cleared.json().get("name") == response.json().get("name")
+        ):
+            log_test("Update site retention", True, "Set to 400 days, rejected 0, 404 for unknown site, cleared")
+            return True
+        else:
+            log_test("Update site retention", False, f"Invalid: {invalid.status_code}, missing: {missing.status_code}, cleared: {cleared.text}")
+            return False
+    except Exception as e:
+        log_test("Update site retention", False, f"Exception: {str(e)}")
+        return False
+
 def test_tracker_js():
     """Test 4: GET /api/i.js - return JavaScript tracker"""
     try:
@@ -122,6 +152,34 @@ def test_tracker_js():
         log_test("Tracker JS", False, f"Exception: {str(e)}")
         return False
 
+def test_tracker_caching():
+    """Test 4b: GET /api/i.js - compressed, ETag/304 and immutable versioned URL"""
+    try:
+        response = requests.get(f"{BASE_URL}/i.js", headers={"Accept-Encoding": "gzip"}, timeout=10)
+        etag = response.headers.get("etag")
+        location = response.headers.get("content-location", "")
+        if response.status_code != 200 or response.headers.get("content-encoding") != "gzip" or not etag:
+            log_test("Tracker caching", False, f"Status: {response.status_code}, Headers: {dict(response.headers)}")
+            return False
+
+        revalidated = requests.get(f"{BASE_URL}/i.js", headers={"If-None-Match": etag}, timeout=10)
+        versioned = requests.get(f"{BASE_URL}{location.removeprefix('/api')}", timeout=10)
+        cache_control = versioned.headers.get("cache-control", "")
+        if (
+            revalidated.status_code == 304
+            and versioned.status_code == 200
+            and "immutable" in cache_control
+            and versioned.text == response.text
+        ):
+            log_test("Tracker caching", True, f"ETag {etag}, 304 on revalidation, {location}: {cache_control}")
+            return True
+        else:
+            log_test("Tracker caching", False, f"304 status: {revalidated.status_code}, {location}: {versioned.status_code} {cache_control}")
+            return False
+    except Exception as e:
+        log_test("Tracker caching", False, f"Exception: {str(e)}")
+        return False
+
 def test_collect_pageview(site_id: str):
     """Test 5: POST /api/collect - pageview without DNT"""
     try:
@@ -201,6 +259,49 @@ def test_collect_with_dnt(site_id: str):
         log_test("Collect with DNT", False, f"Exception: {str(e)}")
         return False
 
+def test_collect_batch(site_id: str):
+    """Test 6b: POST /api/collect/batch - per-item status for a mixed batch"""
+    try:
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        base = {
+            "siteId": site_id,
+            "type": "pageview",
+            "ts": now_ms,
+            "url": "https://example.com/batch",
+            "title": "Batch",
+            "referrer": "",
+            "visitorId": "batch_visitor",
+            "sessionId": "batch_session",
+            "channel": "Direct"
+        }
+        batch = [
+            dict(base, id=f"batch_{now_ms}_1"),
+            dict(base, id=f"batch_{now_ms}_1", durationMs=1500),
+            {"siteId": site_id, "type": "pageview"},
+            dict(base, id=f"batch_{now_ms}_2", siteId="site_does_not_exist"),
+        ]
+
+        # text/plain is what sendBeacon posts
+        response = requests.post(f"{BASE_URL}/collect/batch", data=json.dumps(batch),
+                                 headers={"content-type": "text/plain"}, timeout=10)
+
+        if response.status_code == 200:
+            data = response.json()
+            statuses = [r.get("status") for r in data.get("results", [])]
+            expected = ["ok", "ok", "invalid", "invalid_site"]
+            if statuses == expected and data.get("accepted") == 2:
+                log_test("Collect batch", True, f"Statuses: {statuses}")
+                return True
+            else:
+                log_test("Collect batch", False, f"Expected {expected}, got {data}")
+                return False
+        else:
+            log_test("Collect batch", False, f"Status: {response.status_code}, Body: {response.text}")
+            return False
+    except Exception as e:
+        log_test("Collect batch", False, f"Exception: {str(e)}")
+        return False
+
 def test_get_hits(site_id: str):
     """Test 7: GET /api/hits - retrieve hits"""
     try:
@@ -275,6 +376,364 @@ def test_overview(site_id: str):
         log_test("Overview", False, f"Exception: {str(e)}")
         return False
 
+def seed_parity_hits(site_id: str):
+    """Seed a varied set of pageviews (multi-day, multi-page sessions, durations) via /collect/batch"""
+    now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+    day_ms = 24 * 60 * 60 * 1000
+    hits = []
+    for i in range(100):
+        ts = now_ms - (i % 5) * day_ms - (i * 7919 % 3600) * 1000
+        hits.append({
+            "id": f"parity_{now_ms}_{i}",
+            "siteId": site_id,
+            "type": "pageview",
+            "ts": ts,
+            "url": f"https://example.com/p{i % 7}",
+            "title": "Parity",
+            "referrer": "",
+            "visitorId": f"pv{i % 13}",
+            "sessionId": f"ps{i % 29}",
+            "durationMs": (i * 37 % 5000) if i % 3 == 0 else None,
+            "channel": "Direct"
+        })
+    response = requests.post(f"{BASE_URL}/collect/batch", json=hits, timeout=30)
+    return response.status_code == 200 and response.json().get("accepted") == len(hits)
+
+def overviews_match(raw: dict, other: dict, whole_sessions: bool = True) -> bool:
+    """raw vs another engine: identical, or when the engine estimates uniques (approx set)
+    identical pageviews, uniques within the HLL error and - if every session lies
+    inside the window - identical session KPIs"""
+    if not other.get("approx"):
+        return raw["kpis"] == other["kpis"] and raw["series"] == other["series"]
+    close = lambda want, got: abs(got - want) <= max(1, 0.05 * want)
+    a, b = raw["kpis"], other["kpis"]
+    if a["pageviews"] != b["pageviews"] or a["visits"] != b["visits"] or not close(a["visitors"], b["visitors"]):
+        return False
+    if whole_sessions and any(a[k] != b[k] for k in ("bounceRate", "avgSessionMs", "pagesPerSession")):
+        return False
+    if [p["day"] for p in raw["series"]] != [p["day"] for p in other["series"]]:
+        return False
+    return all(
+        p["pageviews"] == q["pageviews"] and close(p["visitors"], q["visitors"]) and close(p["sessions"], q["sessions"])
+        for p, q in zip(raw["series"], other["series"])
+    )
+
+def test_overview_engine_parity(site_id: str, engine: str):
+    """Test 8b: GET /api/overview?engine=<engine> matches engine=raw"""
+    name = f"Overview {engine} parity"
+    try:
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        day_ms = 24 * 60 * 60 * 1000
+        # whole range, a window with partial edge days, and a single partial day
+        windows = [
+            (now_ms - 7 * day_ms, now_ms),
+            (now_ms - 3 * day_ms - day_ms // 3, now_ms - day_ms // 2),
+            (now_ms - day_ms // 4, now_ms),
+        ]
+        for i, (start_ts, end_ts) in enumerate(windows):
+            params = {"siteId": site_id, "startTs": start_ts, "endTs": end_ts}
+            raw = requests.get(f"{BASE_URL}/overview", params=dict(params, engine="raw"), timeout=10)
+            other = requests.get(f"{BASE_URL}/overview", params=dict(params, engine=engine), timeout=10)
+            if raw.status_code != 200 or other.status_code != 200:
+                log_test(name, False, f"Status: {raw.status_code}/{other.status_code}")
+                return False
+
+            a, b = raw.json(), other.json()
+            # only the first window holds every seeded session whole; every engine orders
+            # topPages by count, then key
+            if not overviews_match(a, b, whole_sessions=i == 0) or a["topPages"] != b["topPages"]:
+                log_test(name, False, f"Window {start_ts}-{end_ts}: raw={a['kpis']} {engine}={b['kpis']}")
+                return False
+
+        log_test(name, True, f"{len(windows)} windows {'within HLL error' if b.get('approx') else 'identical'}")
+        return True
+    except Exception as e:
+        log_test(name, False, f"Exception: {str(e)}")
+        return False
+
+def test_overview_sessions(site_id: str):
+    """Test 8c: GET /api/overview?engine=sessions - session KPIs from db.sessions match raw"""
+    try:
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        # every seeded session lies inside this window, so both count the same sessions
+        params = {"siteId": site_id, "startTs": now_ms - 7 * 24 * 60 * 60 * 1000, "endTs": now_ms}
+        raw = requests.get(f"{BASE_URL}/overview", params=dict(params, engine="raw"), timeout=10)
+        sess = requests.get(f"{BASE_URL}/overview", params=dict(params, engine="sessions"), timeout=10)
+
+        if raw.status_code == 200 and sess.status_code == 200:
+            a, b = raw.json()["kpis"], sess.json()["kpis"]
+            if overviews_match(raw.json(), sess.json()):
+                log_test("Overview sessions", True, f"bounce={b['bounceRate']:.1f}% avg={b['avgSessionMs']:.0f}ms")
+                return True
+            else:
+                log_test("Overview sessions", False, f"raw={a} sessions={b}")
+                return False
+        else:
+            log_test("Overview sessions", False, f"Status: {raw.status_code}/{sess.status_code}")
+            return False
+    except Exception as e:
+        log_test("Overview sessions", False, f"Exception: {str(e)}")
+        return False
+
+def test_overview_approx(site_id: str):
+    """Test 8d: GET /api/overview?approx=true - HLL uniques close to exact"""
+    try:
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        params = {"siteId": site_id, "startTs": now_ms - 7 * 24 * 60 * 60 * 1000, "endTs": now_ms}
+        exact = requests.get(f"{BASE_URL}/overview", params=params, timeout=10)
+        approx = requests.get(f"{BASE_URL}/overview", params=dict(params, approx="true"), timeout=10)
+
+        if exact.status_code == 200 and approx.status_code == 200:
+            a, b = exact.json(), approx.json()
+            info = b.get("approx") or {}
+            want, got = a["kpis"]["visitors"], b["kpis"]["visitors"]
+            if b.get("approx") is None and a["kpis"] == b["kpis"]:
+                log_test("Overview approx", True, "No sketches on this server (DAILY_ROLLUPS=1): exact answer")
+                return True
+            if info.get("method") == "hyperloglog" and abs(got - want) <= max(1, 0.05 * want):
+                log_test("Overview approx", True, f"visitors exact={want} approx={got}, stdErr={info.get('relativeStdError')}")
+                return True
+            else:
+                log_test("Overview approx", False, f"visitors exact={want} approx={got}, approx={info}")
+                return False
+        else:
+            log_test("Overview approx", False, f"Status: {exact.status_code}/{approx.status_code}")
+            return False
+    except Exception as e:
+        log_test("Overview approx", False, f"Exception: {str(e)}")
+        return False
+
+def test_overview_compare(site_id: str):
+    """Test 8e: GET /api/overview?compare=previous - comparison window matches its own overview"""
+    try:
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        day_ms = 24 * 60 * 60 * 1000
+        params = {"siteId": site_id, "startTs": now_ms - 2 * day_ms, "endTs": now_ms}
+        for engine in ("raw", "numpy", "aggregate"):
+            response = requests.get(f"{BASE_URL}/overview", params=dict(params, engine=engine, compare="previous"), timeout=10)
+            if response.status_code != 200:
+                log_test("Overview compare", False, f"{engine}: Status: {response.status_code}, Body: {response.text}")
+                return False
+            data = response.json()
+            cmp = data.get("compare") or {}
+            if (cmp.get("startTs"), cmp.get("endTs")) != (now_ms - 4 * day_ms - 1, now_ms - 2 * day_ms - 1):
+                log_test("Overview compare", False, f"{engine}: window {cmp.get('startTs')}-{cmp.get('endTs')}")
+                return False
+
+            prev = requests.get(
+                f"{BASE_URL}/overview",
+                params={"siteId": site_id, "startTs": cmp["startTs"], "endTs": cmp["endTs"], "engine": engine},
+                timeout=10,
+            ).json()
+            # shifted points keep the previous window's counts under compareDay
+            shifted = [{"day": p["compareDay"], **{k: p[k] for k in ("pageviews", "visitors", "sessions")}} for p in cmp["series"]]
+            if cmp["kpis"] != prev["kpis"] or shifted != prev["series"]:
+                log_test("Overview compare", False, f"{engine}: compare={cmp['kpis']} previous={prev['kpis']}")
+                return False
+            if not cmp["series"] or cmp["series"][0]["day"] != data["series"][0]["day"]:
+                log_test("Overview compare", False, f"{engine}: series not aligned: {cmp['series'][:1]} vs {data['series'][:1]}")
+                return False
+
+        log_test("Overview compare", True, f"visits {cmp['kpis']['visits']} -> {data['kpis']['visits']} ({cmp['change']['visits']:+.1f}%)")
+        return True
+    except Exception as e:
+        log_test("Overview compare", False, f"Exception: {str(e)}")
+        return False
+
+def test_breakdown(site_id: str):
+    """Test 8e: GET /api/breakdown - url breakdown agrees with overview topPages"""
+    try:
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        params = {"siteId": site_id, "startTs": now_ms - 7 * 24 * 60 * 60 * 1000, "endTs": now_ms}
+        overview = requests.get(f"{BASE_URL}/overview", params=params, timeout=10)
+        pages = requests.get(f"{BASE_URL}/breakdown", params=dict(params, dimension="url", limit=8), timeout=10)
+        channels = requests.get(f"{BASE_URL}/breakdown", params=dict(params, dimension="channel"), timeout=10)
+        bad = requests.get(f"{BASE_URL}/breakdown", params=dict(params, dimension="ipHash"), timeout=10)
+
+        if overview.status_code != 200 or pages.status_code != 200 or channels.status_code != 200:
+            log_test("Breakdown", False, f"Status: {overview.status_code}/{pages.status_code}/{channels.status_code}")
+            return False
+
+        top = {t["key"]: t["value"] for t in overview.json()["topPages"]}
+        items = pages.json()["items"]
+        got = {i["key"]: i["pageviews"] for i in items}
+        channel_items = channels.json()["items"]
+        if (
+            got == top
+            and all(0 < i["visitors"] <= i["pageviews"] for i in items)
+            and channel_items and channel_items[0]["key"] == "Direct"
+            and channel_items[0]["pageviews"] == pages.json()["pageviews"]
+            and bad.status_code == 422
+        ):
+            log_test("Breakdown", True, f"{len(items)} urls, channels={[(i['key'], i['pageviews']) for i in channel_items]}")
+            return True
+        else:
+            log_test("Breakdown", False, f"urls={got} topPages={top} channels={channel_items} bad={bad.status_code}")
+            return False
+    except Exception as e:
+        log_test("Breakdown", False, f"Exception: {str(e)}")
+        return False
+
+def test_breakdown_approx(site_id: str):
+    """Test 8f: GET /api/breakdown?approx=true - heavy-hitter sketch with its error bound"""
+    try:
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        params = {"siteId": site_id, "startTs": now_ms - 7 * 24 * 60 * 60 * 1000, "endTs": now_ms, "dimension": "url"}
+        exact = requests.get(f"{BASE_URL}/breakdown", params=params, timeout=10)
+        approx = requests.get(f"{BASE_URL}/breakdown", params=dict(params, approx="true"), timeout=10)
+        if approx.status_code == 400 and "dimension_not_sketched" in approx.text:
+            log_test("Breakdown approx", True, "url not sketched on this server (HEAVY_HITTER_DIMS=url)")
+            return True
+
+        if exact.status_code == 200 and approx.status_code == 200:
+            want = {i["key"]: i["pageviews"] for i in exact.json()["items"]}
+            got = {i["key"]: i["pageviews"] for i in approx.json()["items"]}
+            info = approx.json().get("approx") or {}
+            err = info.get("maxUndercount")
+            # each approx count is a lower bound within maxUndercount of the exact one
+            if info.get("method") == "misra-gries" and err is not None and all(
+                k in want and want[k] - err <= v <= want[k] for k, v in got.items()
+            ):
+                log_test("Breakdown approx", True, f"{len(got)} urls, maxUndercount={err}")
+                return True
+            else:
+                log_test("Breakdown approx", False, f"exact={want} approx={got} info={info}")
+                return False
+        else:
+            log_test("Breakdown approx", False, f"Status: {exact.status_code}/{approx.status_code}")
+            return False
+    except Exception as e:
+        log_test("Breakdown approx", False, f"Exception: {str(e)}")
+        return False
+
+def test_hits_pagination(site_id: str):
+    """Test 7b: GET /api/hits keyset pages and NDJSON stream return the same hits"""
+    try:
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        params = {
+            "siteId": site_id,
+            "startTs": now_ms - 7 * 24 * 60 * 60 * 1000,
+            "endTs": now_ms + 60 * 60 * 1000,
+            "fields": "url,visitorId"
+        }
+
+        paged = []
+        cursor = None
+        for _ in range(100):
+            page_params = dict(params, limit=30, **({"cursor": cursor} if cursor else {}))
+            response = requests.get(f"{BASE_URL}/hits", params=page_params, timeout=10)
+            if response.status_code != 200:
+                log_test("Hits pagination", False, f"Status: {response.status_code}, Body: {response.text}")
+                return False
+            data = response.json()
+            paged.extend(h["id"] for h in data["hits"])
+            cursor = data.get("nextCursor")
+            if not cursor:
+                break
+
+        response = requests.get(f"{BASE_URL}/hits", params=dict(params, format="ndjson"), timeout=30)
+        streamed = [json.loads(line)["id"] for line in response.text.splitlines() if line]
+
+        if paged and paged == streamed and len(set(paged)) == len(paged):
+            log_test("Hits pagination", True, f"{len(paged)} hits in pages == NDJSON stream")
+            return True
+        else:
+            log_test("Hits pagination", False, f"paged={len(paged)} streamed={len(streamed)}")
+            return False
+    except Exception as e:
+        log_test("Hits pagination", False, f"Exception: {str(e)}")
+        return False
+
+def test_export(site_id: str):
+    """Test 7c: GET /api/export streams the same hits as NDJSON and as gzipped CSV"""
+    try:
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        params = {"siteId": site_id, "startTs": now_ms - 7 * 24 * 60 * 60 * 1000, "endTs": now_ms + 60 * 60 * 1000}
+
+        response = requests.get(f"{BASE_URL}/export", params=params, timeout=30)
+        if response.status_code != 200 or "attachment" not in response.headers.get("content-disposition", ""):
+            log_test("Export", False, f"Status: {response.status_code}, Headers: {dict(response.headers)}")
+            return False
+        exported = [json.loads(line)["id"] for line in response.text.splitlines() if line]
+
+        response = requests.get(f"{BASE_URL}/export", params=dict(params, format="csv", gzip=1), timeout=30)
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(response.content).decode("utf-8"))))
+        streamed = requests.get(f"{BASE_URL}/hits", params=dict(params, format="ndjson"), timeout=30)
+        expected = [json.loads(line)["id"] for line in streamed.text.splitlines() if line]
+
+        if exported and exported == expected and [r["id"] for r in rows] == expected:
+            log_test("Export", True, f"{len(exported)} hits as NDJSON and gzipped CSV ({len(response.content)} bytes)")
+            return True
+        else:
+            log_test("Export", False, f"ndjson={len(exported)} csv={len(rows)} expected={len(expected)}")
+            return False
+    except Exception as e:
+        log_test("Export", False, f"Exception: {str(e)}")
+        return False
+
+def read_sse(response):
+    """Yield (event, data) from a text/event-stream response, skipping comments"""
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line == "":
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].strip())
+
+def test_realtime_stream(site_id: str):
+    """Test 8f: GET /api/realtime/stream - snapshot of recent hits, then collected hits pushed"""
+    try:
+        response = requests.get(f"{BASE_URL}/realtime/stream", params={"siteId": site_id}, stream=True, timeout=10)
+        if response.status_code == 404 and "realtime_tracker_disabled" in response.text:
+            log_test("Realtime stream", True, "Tracker disabled on this server (REALTIME_TRACKER=1)")
+            return True
+        if response.status_code != 200:
+            log_test("Realtime stream", False, f"Status: {response.status_code}, Body: {response.text}")
+            return False
+
+        try:
+            events = read_sse(response)
+            event, snapshot = next(events)
+            # the pageviews collected above are within the last 5 minutes
+            if event != "snapshot" or not snapshot["hits"] or snapshot["activeVisitors"] < 1:
+                log_test("Realtime stream", False, f"First event: {event} {snapshot}")
+                return False
+
+            now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+            hit_id = f"rt_{now_ms}"
+            payload = {
+                "id": hit_id,
+                "siteId": site_id,
+                "type": "pageview",
+                "ts": now_ms,
+                "url": "https://example.com/live",
+                "visitorId": f"rt_visitor_{now_ms}",
+                "sessionId": f"rt_session_{now_ms}",
+            }
+            collected = requests.post(f"{BASE_URL}/collect", json=payload, timeout=10)
+            if collected.status_code != 200:
+                log_test("Realtime stream", False, f"Collect status: {collected.status_code}")
+                return False
+
+            for event, data in events:
+                if event == "hits" and any(h["id"] == hit_id for h in data["hits"]):
+                    if data["activeVisitors"] != snapshot["activeVisitors"] + 1:
+                        log_test("Realtime stream", False, f"Active visitors {snapshot['activeVisitors']} -> {data['activeVisitors']}")
+                        return False
+                    log_test("Realtime stream", True, f"Snapshot of {len(snapshot['hits'])} hits, then {hit_id} pushed")
+                    return True
+            log_test("Realtime stream", False, "Stream ended before the collected hit arrived")
+            return False
+        finally:
+            response.close()
+    except Exception as e:
+        log_test("Realtime stream", False, f"Exception: {str(e)}")
+        return False
+
 def test_rate_limiting(site_id: str):
     """Test 9: Rate limiting - send 130 requests quickly"""
     try:
@@ -367,6 +826,69 @@ def verify_dnt_not_stored(site_id: str):
         log_test("DNT verification", False, f"Exception: {str(e)}")
         return False
 
+def test_metrics():
+    """Test 10: GET /api/metrics - Prometheus text with per-route latency, limiter and overview metrics"""
+    try:
+        response = requests.get(f"{BASE_URL}/metrics", timeout=10)
+        if response.status_code != 200:
+            log_test("Metrics", False, f"Status: {response.status_code}")
+            return False
+        samples = {}
+        for line in response.text.splitlines():
+            if line and not line.startswith("#"):
+                name, _, value = line.rpartition(" ")
+                samples[name] = float(value)
+
+        collect_count = samples.get('sa_http_request_duration_seconds_count{method="POST",route="/api/collect"}', 0)
+        # limiter samples carry a pid label unless the limiter is shared by all workers
+        rejected = sum(v for k, v in samples.items() if k.partition("{")[0] == "sa_collect_rate_limited_total")
+        scanned = [v for k, v in samples.items() if k.startswith("sa_overview_docs_scanned_count")]
+        limiter_keys = [k for k in samples if k.partition("{")[0] == "sa_collect_rate_limiter_keys"]
+        if collect_count > 0 and rejected > 0 and scanned and limiter_keys:
+            log_test("Metrics", True, f"{len(samples)} samples, collect requests={collect_count:.0f}, rate limited={rejected:.0f}")
+            return True
+        else:
+            log_test("Metrics", False, f"collect={collect_count} rejected={rejected} overview={scanned}")
+            return False
+    except Exception as e:
+        log_test("Metrics", False, f"Exception: {str(e)}")
+        return False
+
+def test_delete_site_job(site_id: str):
+    """Test 11: DELETE /api/sites/{id} - returns a job that deletes the site's hits in the background"""
+    try:
+        response = requests.delete(f"{BASE_URL}/sites/{site_id}", timeout=10)
+        job_id = response.json().get("jobId") if response.status_code == 200 else None
+        if not job_id:
+            log_test("Delete site job", False, f"Status: {response.status_code}, Body: {response.text}")
+            return False
+
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        params = {"siteId": site_id, "startTs": 0, "endTs": now_ms + 60 * 60 * 1000}
+        job, hits = {}, None
+        for _ in range(20):
+            job = requests.get(f"{BASE_URL}/jobs/{job_id}", timeout=10).json()
+            hits = requests.get(f"{BASE_URL}/hits", params=params, timeout=10).json().get("hits")
+            # "done" only after a final sweep once other workers' site caches expired
+            if job.get("status") in ("running", "done") and sum(job.get("progress", {}).values()) > 0 and hits == []:
+                break
+            time.sleep(0.5)
+        else:
+            log_test("Delete site job", False, f"Job: {job}, remaining hits: {len(hits or [])}")
+            return False
+
+        sites = requests.get(f"{BASE_URL}/sites", timeout=10).json()
+        missing = requests.get(f"{BASE_URL}/jobs/job_missing", timeout=10)
+        again = requests.delete(f"{BASE_URL}/sites/{site_id}", timeout=10)
+        if any(s.get("id") == site_id for s in sites) or missing.status_code != 404 or again.status_code != 404:
+            log_test("Delete site job", False, f"Site still listed or unknown job/site status {missing.status_code}/{again.status_code}")
+            return False
+        log_test("Delete site job", True, f"Job {job_id} {job['status']}, deleted: {job['progress']}")
+        return True
+    except Exception as e:
+        log_test("Delete site job", False, f"Exception: {str(e)}")
+        return False
+
 def main():
     """Run all backend tests"""
     print("=" * 60)
@@ -388,9 +910,11 @@ def main():
     if site_id:
         # Test 3: List sites
         results.append(test_list_sites(site_id))
+        results.append(test_update_site_retention(site_id))
         
         # Test 4: Tracker JS
         results.append(test_tracker_js())
+        results.append(test_tracker_caching())
         
         # Test 5: Collect pageview (no DNT)
         results.append(test_collect_pageview(site_id))
@@ -398,6 +922,9 @@ def main():
         # Test 6: Collect with DNT
         results.append(test_collect_with_dnt(site_id))
         
+        # Test 6b: Collect batch
+        results.append(test_collect_batch(site_id))
+        
         # Wait a moment for data to be stored
         time.sleep(2)
         
@@ -407,14 +934,40 @@ def main():
         # Test 8: Overview
         results.append(test_overview(site_id))
         
+        # Test 8b: Overview engines agree with the raw scan (separate site: own rate-limit bucket)
+        parity_site_id = test_create_site()
+        if parity_site_id and seed_parity_hits(parity_site_id):
+            results.append(test_overview_engine_parity(parity_site_id, "rollup"))
+            results.append(test_overview_engine_parity(parity_site_id, "aggregate"))
+            results.append(test_overview_engine_parity(parity_site_id, "numpy"))
+            results.append(test_overview_sessions(parity_site_id))
+            results.append(test_overview_approx(parity_site_id))
+            results.append(test_overview_compare(parity_site_id))
+            results.append(test_breakdown(parity_site_id))
+            results.append(test_breakdown_approx(parity_site_id))
+            results.append(test_hits_pagination(parity_site_id))
+            results.append(test_export(parity_site_id))
+        else:
+            log_test("Seed parity hits", False, "Could not create/seed parity site")
+            results.extend([False] * 10)
+        
+        # Test 8f: Realtime stream
+        results.append(test_realtime_stream(site_id))
+
         # Test 9: Rate limiting
         results.append(test_rate_limiting(site_id))
         
         # Verify DNT was not stored
         results.append(verify_dnt_not_stored(site_id))
+
+        # Test 10: Metrics (after rate limiting, so rejections show up)
+        results.append(test_metrics())
+
+        # Test 11: Delete site (last: removes the site used above)
+        results.append(test_delete_site_job(site_id))
     else:
         print("❌ Skipping remaining tests due to site creation failure")
-        results.extend([False] * 7)  # Mark remaining tests as failed
+        results.extend([False] * 23)  # Mark remaining tests as failed
     
     # Summary
     print("=" * 60)
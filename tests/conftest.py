@@ -0,0 +1,10 @@
+"""Shared setup: point the app at throwaway settings and make ``import server`` work."""
+
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://127.0.0.1:27017")
+os.environ.setdefault("DB_NAME", "sa_test")
+os.environ.setdefault("COLLECT_RATE_LIMIT", "1000000")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
@@ -0,0 +1,255 @@
+"""Every overview engine against the Python reducers (_group_by_day, _calc_kpis, _top_by).
+
+The $facet pipelines are run by a small evaluator of the stages and expressions they use,
+with MongoDB's semantics, so this needs no server; test_storage.py runs them on a real one
+when MONGO_URL answers.
+"""
+
+from datetime import datetime, timezone
+
+import pytest
+import server
+
+DAY0 = 1_700_006_400_000  # 2023-11-15T00:00:00Z
+H = 60 * 60 * 1000
+
+
+def _hit(i, ts, url, visitor, session, duration=None):
+    return {
+        "id": f"h{i}",
+        "siteId": "s",
+        "type": "pageview",
+        "ts": ts,
+        "url": url,
+        "visitorId": visitor,
+        "sessionId": session,
+        "durationMs": duration,
+    }
+
+
+# Ties in top pages (first seen in the opposite order of their keys), padded and empty
+# urls, hits without visitor/session, sessions with and without an explicit duration,
+# a session crossing midnight, and sessions of one (bounced), two and three hits.
+HITS = [
+    _hit(0, DAY0 + 1 * H, "/z", "v1", "s1"),
+    _hit(1, DAY0 + 2 * H, "/z", "v1", "s1", 0),
+    _hit(2, DAY0 + 3 * H, "/a", "v2", "s2", 4000),
+    _hit(3, DAY0 + 4 * H, " /a ", "v2", "s2", 9000),
+    _hit(4, DAY0 + 5 * H, "/m", "v3", "s3"),
+    _hit(5, DAY0 + 6 * H, "", "v3", "s3"),
+    _hit(6, DAY0 + 7 * H, "/m", "", ""),
+    _hit(13, DAY0 + 8 * H, "/q", "v3", "s3"),
+    _hit(7, DAY0 + 23 * H, "/b", "v4", "s4"),
+    _hit(8, DAY0 + 25 * H, "/b", "v4", "s4"),
+    _hit(9, DAY0 + 26 * H, "/c", "v5", "s5", 1500),
+    _hit(10, DAY0 + 27 * H, "/a", "v1", "s6"),
+    _hit(11, DAY0 + 49 * H, "/y", "v6", "s7"),
+    _hit(12, DAY0 + 50 * H, "/x", "v6", "s8"),
+]
+START, END = DAY0, DAY0 + 3 * 24 * H - 1
+
+
+# -- a MongoDB aggregation evaluator for the subset the overview pipelines use --------------
+_MISSING = object()
+
+
+def _get(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return _MISSING
+        doc = doc[part]
+    return doc
+
+
+def _bson_type(v):
+    if v is _MISSING:
+        return "missing"
+    if v is None:
+        return "null"
+    if isinstance(v, bool):
+        return "bool"
+    if isinstance(v, int):
+        return "int" if -(2**31) <= v < 2**31 else "long"
+    return {float: "double", str: "string", dict: "object", list: "array"}[type(v)]
+
+
+def _expr(e, doc):
+    if isinstance(e, str) and e.startswith("$"):
+        return _get(doc, e[1:])
+    if isinstance(e, list):
+        return [_expr(x, doc) for x in e]
+    if not isinstance(e, dict):
+        return e
+    if len(e) != 1 or not next(iter(e)).startswith("$"):
+        return {k: _expr(v, doc) for k, v in e.items()}
+    op, arg = next(iter(e.items()))
+    if op == "$type":
+        return _bson_type(_expr(arg, doc))
+    if op == "$trim":
+        return _expr(arg["input"], doc).strip()
+    if op == "$dateToString":
+        assert arg["format"] == "%Y-%m-%d"
+        return _expr(arg["date"], doc).strftime("%Y-%m-%d")
+    if op == "$cond":
+        c, a, b = arg
+        return _expr(a, doc) if _expr(c, doc) else _expr(b, doc)
+    args = [None if v is _MISSING else v for v in _expr(arg, doc)] if isinstance(arg, list) else _expr(arg, doc)
+    if op == "$toDate":
+        return datetime.fromtimestamp(args / 1000, tz=timezone.utc)
+    if op == "$ifNull":
+        return args[0] if args[0] is not None else args[1]
+    if op == "$size":
+        return len(args)
+    if op == "$max":
+        return max((v for v in args if v is not None), default=None)
+    binary = {
+        "$in": lambda a, b: a in b,
+        "$gt": lambda a, b: a is not None and a > b,
+        "$eq": lambda a, b: a == b,
+        "$ne": lambda a, b: a != b,
+        "$subtract": lambda a, b: a - b,
+    }
+    if op in binary:
+        return binary[op](*args)
+    if op == "$and":
+        return all(args)
+    raise NotImplementedError(op)
+
+
+def _matches(query, doc):
+    for field, cond in query.items():
+        if field == "$or":
+            if not any(_matches(q, doc) for q in cond):
+                return False
+            continue
+        v = _get(doc, field)
+        v = None if v is _MISSING else v
+        if not isinstance(cond, dict):
+            cond = {"$eq": cond}
+        for op, x in cond.items():
+            ok = {
+                "$eq": lambda: v == x,
+                "$ne": lambda: v != x,
+                "$nin": lambda: v not in x,
+                "$gte": lambda: v is not None and v >= x,
+                "$lte": lambda: v is not None and v <= x,
+            }[op]()
+            if not ok:
+                return False
+    return True
+
+
+def _order(v):
+    # BSON order for the values these pipelines compare: numbers/strings, and documents by field
+    return tuple(v.values()) if isinstance(v, dict) else v
+
+
+def _group(spec, docs):
+    groups = {}
+    for doc in docs:
+        key = _expr(spec["_id"], doc)
+        g = groups.setdefault(_order(key), {"_id": key})
+        for name, acc in spec.items():
+            if name == "_id":
+                continue
+            (op, arg), v = next(iter(acc.items())), _expr(next(iter(acc.values())), doc)
+            if op == "$sum":
+                g[name] = g.get(name, 0) + v
+            elif op == "$addToSet":
+                g.setdefault(name, [])
+                if v not in g[name]:
+                    g[name].append(v)
+            elif op in ("$min", "$max"):
+                g.setdefault(name, None)
+                cur = g[name]
+                if v is _MISSING or v is None:  # $min/$max skip nulls
+                    continue
+                if cur is None or (_order(v) < _order(cur) if op == "$min" else _order(v) > _order(cur)):
+                    g[name] = v
+            else:
+                raise NotImplementedError(op)
+    return list(groups.values())
+
+
+def _project(spec, doc):
+    out = {} if spec.get("_id", 1) == 0 else {"_id": doc.get("_id")}
+    for name, e in spec.items():
+        if name == "_id":
+            continue
+        out[name] = doc.get(name) if e == 1 else _expr(e, doc)
+    return out
+
+
+def _sort(spec, docs):
+    for field, direction in reversed(list(spec.items())):
+        docs = sorted(docs, key=lambda d: _order(d.get(field)), reverse=direction < 0)
+    return docs
+
+
+def aggregate(pipeline, docs):
+    for stage in pipeline:
+        (op, arg), = stage.items()
+        if op == "$match":
+            docs = [d for d in docs if _matches(arg, d)]
+        elif op == "$facet":
+            docs = [{name: aggregate(sub, docs) for name, sub in arg.items()}]
+        elif op == "$group":
+            docs = _group(arg, docs)
+        elif op == "$project":
+            docs = [_project(arg, d) for d in docs]
+        elif op == "$sort":
+            docs = _sort(arg, docs)
+        elif op == "$limit":
+            docs = docs[:arg]
+        elif op == "$count":
+            docs = [{arg: len(docs)}] if docs else []
+        else:
+            raise NotImplementedError(op)
+    return docs
+
+
+def _expected(hits, top_limit=8):
+    return server._group_by_day(hits), server._calc_kpis(hits), server._top_by(hits, "url", limit=top_limit)
+
+
+def _assert_same(got, want):
+    (series, kpis, top), (w_series, w_kpis, w_top) = got, want
+    assert [p.model_dump() for p in series] == [p.model_dump() for p in w_series]
+    assert kpis == pytest.approx(w_kpis)
+    assert [(t.key, t.value) for t in top] == [(t.key, t.value) for t in w_top]
+
+
+def test_top_by_breaks_ties_by_key():
+    top = server._top_by(HITS, "url")
+    assert [(t.key, t.value) for t in top] == [
+        ("/a", 3), ("/b", 2), ("/m", 2), ("/z", 2), ("/c", 1), ("/q", 1), ("/x", 1), ("/y", 1)
+    ]
+
+
+@pytest.mark.parametrize("top_limit", [8, 3])
+def test_pipeline_matches_reducers(top_limit):
+    rows = aggregate(server._overview_pipeline("s", START, END, top_limit=top_limit), HITS)
+    _assert_same(server._overview_from_facets(rows[0]), _expected(HITS, top_limit))
+
+
+def test_periods_pipeline_matches_each_window():
+    periods = [(DAY0 + 24 * H, END), (START, DAY0 + 24 * H - 1)]
+    rows = aggregate(server._overview_periods_pipeline("s", periods), HITS)
+    names = server._overview_facets()
+    for i, (s, e) in enumerate(periods):
+        got = server._overview_from_facets({name: rows[0].get(f"{name}_{i}") for name in names})
+        _assert_same(got, _expected([h for h in HITS if s <= h["ts"] <= e]))
+
+
+def test_numpy_matches_reducers():
+    cols = server._columns(HITS)
+    _assert_same((server._np_series(cols), server._np_kpis(cols), server._np_top(cols)), _expected(HITS))
+
+
+def test_rollups_match_reducers():
+    # The sketches skip hits without a visitor/session, where _group_by_day counts "" as one
+    hits = [h for h in HITS if h["visitorId"] and h["sessionId"]]
+    rollups = list(server._rollups_from_hits(hits).values())
+    sessions = list(server._sessions_from_hits(hits).values())
+    # HLL uniques are exact at these counts
+    _assert_same(server._overview_from_rollups(rollups, [], sessions), _expected(hits))
@@ -0,0 +1,30 @@
+"""The shared-memory limiter must make the same decisions as the in-memory one."""
+
+import hashlib
+import itertools
+
+import server
+
+
+def _home(key: str, limiter: server.SharedMemoryRateLimiter) -> int:
+    fp = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+    return (fp // limiter.stripes) % limiter.STRIPE
+
+
+def _decisions(limiter, steps):
+    return [limiter.allow(key, now_ms, limit=3) for key, now_ms in steps]
+
+
+def test_shared_limiter_keeps_count_past_expired_collision(tmp_path):
+    shared = server.SharedMemoryRateLimiter(3, 1, str(tmp_path / "rl"), max_keys=64)  # one stripe
+    a = "a"
+    b = next(k for k in (f"b{i}" for i in itertools.count()) if _home(k, shared) == _home(a, shared))
+
+    # A takes the home slot in window 0; B (same home) probes past it in window 1 and
+    # uses up its limit. Early in window 2, A's slot has expired but B's previous
+    # window still weighs just under 3: one more request fits, then B is refused.
+    steps = [(a, 0)] + [(b, 1000)] * 3 + [(b, 2001)] * 4
+    expected = _decisions(server.SlidingWindowRateLimiter(3, 1), steps)
+    assert expected[-4:] == [True, False, False, False]
+    assert _decisions(shared, steps) == expected
+    assert len(shared) == 2
@@ -0,0 +1,56 @@
+"""Overview realtime data comes from the in-memory tracker once it follows a site."""
+
+from datetime import datetime, timezone
+
+import pytest
+import server
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "storage", server.SQLiteStorage(str(tmp_path / "analytics.db")))
+    monkeypatch.setattr(server, "realtime_tracker", server.RealtimeTracker(size=50))
+    monkeypatch.setattr(server, "overview_cache", None)
+    with TestClient(server.app) as client:
+        yield client
+
+
+def test_overview_realtime_skips_storage_for_dashboard_end(api, monkeypatch):
+    site_id = api.post("/api/sites", json={"name": "Live", "domain": "live.test"}).json()["id"]
+    now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+    hit = {
+        "siteId": site_id,
+        "type": "pageview",
+        "ts": now_ms - 5000,
+        "url": "https://live.test/",
+        "visitorId": "v1",
+        "sessionId": "s1",
+    }
+    assert api.post("/api/collect", json=hit).status_code == 200
+
+    # the dashboard's endTs is its own clock from a moment ago
+    params = {"siteId": site_id, "startTs": now_ms - server.DAY_MS, "endTs": now_ms - 1000}
+    api.get("/api/overview", params=params)  # first read seeds the tracker from storage
+
+    calls = []
+    storage = server.storage
+    for name in ("realtime", "active_visitors"):
+        real = getattr(storage, name)
+
+        async def spy(*args, _name=name, _real=real, **kwargs):
+            calls.append(_name)
+            return await _real(*args, **kwargs)
+
+        monkeypatch.setattr(storage, name, spy)
+
+    hit2 = dict(hit, ts=now_ms - 3000, visitorId="v2", sessionId="s2", url="https://live.test/b")
+    assert api.post("/api/collect", json=hit2).status_code == 200
+    data = api.get("/api/overview", params=params).json()
+    assert calls == []
+    assert data["activeVisitors"] == 2
+    assert [h["url"] for h in data["realtime"]] == ["https://live.test/b", "https://live.test/"]
+
+    # a window that ended well before now still reads storage
+    api.get("/api/overview", params=dict(params, endTs=now_ms - 10 * 60 * 1000))
+    assert set(calls) == {"realtime", "active_visitors"}
@@ -0,0 +1,171 @@
+"""API behaviour on each storage backend, run in-process (no server, no network).
+
+backend_test.py exercises a deployed server; this drives the app with TestClient
+against STORAGE=sqlite (a temp file) and MongoDB (MONGO_URL, skipped when no
+server answers there), so a change to one backend can be checked against the other:
+    python -m pytest -q tests
+"""
+
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+import server
+from fastapi.testclient import TestClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def _mongo_reachable(url: str) -> bool:
+    try:
+        MongoClient(url, serverSelectionTimeoutMS=500).admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+
+@pytest.fixture(scope="module", params=["sqlite", "mongo"])
+def api(request, tmp_path_factory):
+    """TestClient on a fresh database of one backend (startup/shutdown run around the module)."""
+    saved = server.storage, server.client, server.db, server.hit_partitions
+    if request.param == "sqlite":
+        server.storage = server.SQLiteStorage(str(tmp_path_factory.mktemp("sqlite") / "analytics.db"))
+    else:
+        url = os.environ["MONGO_URL"]
+        if not _mongo_reachable(url):
+            pytest.skip(f"no MongoDB at {url}")
+        server.client = AsyncIOMotorClient(url)
+        server.db = server.client[f"sa_test_{uuid.uuid4().hex[:8]}"]
+        server.hit_partitions = server.HitPartitions(server.hit_partitions.ttl_sec)
+        server.storage = server.MongoStorage()
+    try:
+        with TestClient(server.app) as client:
+            yield client
+            if request.param == "mongo":
+                client.portal.call(server.client.drop_database, server.db.name)
+    finally:
+        server.storage, server.client, server.db, server.hit_partitions = saved
+
+
+@pytest.fixture(scope="module")
+def seeded(api):
+    """A site with 60 pageviews over 3 days: 7 visitors, 12 sessions, 4 urls."""
+    site_id = api.post("/api/sites", json={"name": "Storage", "domain": "storage.test"}).json()["id"]
+    now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+    hits = [
+        {
+            "id": f"st_{i}",
+            "siteId": site_id,
+            "type": "pageview",
+            "ts": now_ms - (i % 3) * DAY_MS - i * 1000,
+            "url": f"https://storage.test/p{i % 4}",
+            "referrer": "https://ref.test/x" if i % 2 else "",
+            "visitorId": f"v{i % 7}",
+            "sessionId": f"s{i % 12}",
+            "durationMs": 1000 + i if i % 5 == 0 else None,
+            "channel": "Referral" if i % 2 else "Direct",
+        }
+        for i in range(60)
+    ]
+    res = api.post("/api/collect/batch", json=hits)
+    assert res.status_code == 200 and res.json()["accepted"] == len(hits)
+    return site_id, now_ms, hits
+
+
+def test_sites_lifecycle(api):
+    site = api.post("/api/sites", json={"name": " Blog ", "domain": "blog.test"}).json()
+    assert site["name"] == "Blog" and site["isActive"]
+    assert any(s["id"] == site["id"] for s in api.get("/api/sites").json())
+
+    changed = api.patch(f"/api/sites/{site['id']}", json={"retentionDays": 30}).json()
+    assert changed["retentionDays"] == 30 and changed["domain"] == "blog.test"
+    assert api.patch("/api/sites/site_missing", json={"retentionDays": 30}).status_code == 404
+
+    assert api.delete(f"/api/sites/{site['id']}").status_code == 200
+    assert api.delete(f"/api/sites/{site['id']}").status_code == 404
+    assert all(s["id"] != site["id"] for s in api.get("/api/sites").json())
+
+
+def test_hits_roundtrip(api, seeded):
+    site_id, now_ms, hits = seeded
+    params = {"siteId": site_id, "startTs": now_ms - 4 * DAY_MS, "endTs": now_ms}
+    got = api.get("/api/hits", params=params).json()["hits"]
+    assert [h["id"] for h in got] == [h["id"] for h in sorted(hits, key=lambda h: (h["ts"], h["id"]))]
+    assert {k: got[0][k] for k in ("url", "visitorId", "sessionId", "channel")} == {
+        k: next(h for h in hits if h["id"] == got[0]["id"])[k] for k in ("url", "visitorId", "sessionId", "channel")
+    }
+
+    page = api.get("/api/hits", params=dict(params, limit=25)).json()
+    rest = api.get("/api/hits", params=dict(params, limit=100, cursor=page["nextCursor"])).json()
+    assert [h["id"] for h in page["hits"] + rest["hits"]] == [h["id"] for h in got]
+
+
+@pytest.mark.parametrize("engine", ["raw", "aggregate", "numpy", "rollup"])
+def test_overview(api, seeded, engine):
+    site_id, now_ms, hits = seeded
+    params = {"siteId": site_id, "startTs": now_ms - 4 * DAY_MS, "endTs": now_ms, "engine": engine}
+    data = api.get("/api/overview", params=params).json()
+    sessions = {h["sessionId"] for h in hits}
+    assert data["kpis"]["pageviews"] == 60
+    assert data["kpis"]["visitors"] == 7
+    assert data["kpis"]["pagesPerSession"] == pytest.approx(60 / len(sessions))
+    assert sum(p["pageviews"] for p in data["series"]) == 60
+    assert sorted(t["value"] for t in data["topPages"]) == [15, 15, 15, 15]
+    if engine != "raw":
+        raw = api.get("/api/overview", params=dict(params, engine="raw")).json()
+        assert data["kpis"] == pytest.approx(raw["kpis"])
+
+
+@pytest.mark.parametrize("engine", ["raw", "aggregate", "numpy"])
+def test_overview_compare(api, seeded, engine):
+    site_id, now_ms, _ = seeded
+    start = now_ms - 3 * DAY_MS // 2
+    params = {"siteId": site_id, "startTs": start, "endTs": now_ms, "engine": engine, "compare": "previous"}
+    data = api.get("/api/overview", params=params).json()
+    cmp = data["compare"]
+    alone = api.get(
+        "/api/overview", params={"siteId": site_id, "startTs": cmp["startTs"], "endTs": cmp["endTs"], "engine": engine}
+    ).json()
+    current = api.get("/api/overview", params={k: v for k, v in params.items() if k != "compare"}).json()
+    assert cmp["startTs"] == start - (now_ms - start + 1)
+    assert cmp["kpis"] == pytest.approx(alone["kpis"]) and cmp["kpis"]["pageviews"] > 0
+    assert data["kpis"] == pytest.approx(current["kpis"])
+    assert [p["pageviews"] for p in cmp["series"]] == [p["pageviews"] for p in alone["series"]]
+    assert data["topPages"] == current["topPages"]
+
+
+def test_breakdown(api, seeded):
+    site_id, now_ms, _ = seeded
+    params = {"siteId": site_id, "startTs": now_ms - 4 * DAY_MS, "endTs": now_ms, "dimension": "referrer"}
+    data = api.get("/api/breakdown", params=params).json()
+    assert data["pageviews"] == 60
+    # hits without a referrer count in pageviews but get no item
+    assert {i["key"]: i["pageviews"] for i in data["items"]} == {"ref.test": 30}
+
+
+def test_export_filename_is_escaped(api):
+    params = {"siteId": 'a";b é', "startTs": 0, "endTs": 1, "format": "csv", "gzip": 1}
+    res = api.get("/api/export", params=params)
+    assert res.status_code == 200
+    assert res.headers["content-disposition"] == (
+        "attachment; filename=\"sa_a__b___hits.csv.gz\"; filename*=UTF-8''sa_a%22%3Bb%20%C3%A9_hits.csv.gz"
+    )
+
+
+def test_delete_site_job(api, seeded):
+    site_id, now_ms, _ = seeded
+    job_id = api.delete(f"/api/sites/{site_id}").json()["jobId"]
+    for _ in range(50):
+        job = api.get(f"/api/jobs/{job_id}").json()
+        if sum(job["progress"].values()) >= 60:
+            break
+        time.sleep(0.1)
+    assert job["status"] in ("running", "done")
+    params = {"siteId": site_id, "startTs": 0, "endTs": now_ms + DAY_MS}
+    assert api.get("/api/hits", params=params).json()["hits"] == []
+